@@ -58,4 +58,100 @@ TRAINING_AUGEMENTATION_MULTIPLY = 1
 TEST_TRAING_SPLIT = 0.15
 
 PREVENT_BLURRED_OBJECTS = True
-        
\ No newline at end of file
+
+# Length of the longer side of the backgrounds, the objects are merged into. Larger
+# images and objects are decoded at a reduced resolution (see load_image).
+BACKGROUND_SIZE = 416
+        
+
+# Data type of the image and mask arrays of all messages ('uint8', 'float32' or the legacy 'float64')
+IMAGE_DTYPE = 'uint8'
+
+# Number of threads decoding images ahead of the pipelines, see ImageLoader
+LOADER_WORKERS = 4
+# Maximum number of images decoded ahead of the pipelines
+LOADER_READ_AHEAD = 16
+
+# Encode and write the saved images in background threads, see ImageWriter
+WRITER_ASYNC = True
+# Number of threads encoding and writing images
+WRITER_WORKERS = 2
+# Maximum number of images waiting to be written, before saving blocks
+WRITER_QUEUE_SIZE = 16
+# PNG compression level from 0 (fastest) to 9 (smallest)
+WRITER_PNG_COMPRESSION = 1
+# Sync the written images to the disk after this many files (0 leaves it to the operating system)
+WRITER_FSYNC_BATCH = 0
+
+# Only process the inputs which are new or changed since the last run, see Manifest
+INCREMENTAL_PROCESSING = True
+# Store the intermediate datasets (1_masked, 2_blended) in shard files instead of PNG files, see ShardStore
+INTERMEDIATE_PACKED = False
+# zlib compression level of the images and masks in shard files (0 stores them raw)
+SHARD_COMPRESSION_LEVEL = 1
+
+# Folder of the cache of the greenscreen removal results, see StageCache (None disables it).
+# Delete it to pick the green values again.
+STAGE_CACHE_FOLDER = './output/.stage_cache'
+# Maximum size of the cache in bytes, the least recently used results are evicted first
+STAGE_CACHE_MAX_BYTES = 4 * 2**30
+
+# Maximum number of bytes of the temporary arrays every worker keeps for reuse, see BufferPool
+BUFFER_POOL_MAX_BYTES = 64 * 2**20
+
+# Remove the greenscreen without interaction, the green values are estimated from the image borders (see estimate_green)
+GREENSCREEN_HEADLESS = False
+# Number of worker processes removing the greenscreen in headless and per run mode
+GREENSCREEN_HEADLESS_WORKERS = os.cpu_count() or 1
+# Width of the image border the green value is estimated from, relative to the shorter side of the image
+GREEN_ESTIMATION_BORDER = 0.05
+# Maximum difference of the hue of the greenscreen pixels to the most frequent hue of the border (OpenCV hue from 0 to 179)
+GREEN_ESTIMATION_HUE_RANGE = 10
+# Minimum saturation of the border pixels considered as greenscreen (from 0 to 255)
+GREEN_ESTIMATION_MIN_SATURATION = 40
+# Minimum share of the border removed with the estimated green value, the green values of less confident images are picked interactively
+GREEN_ESTIMATION_MIN_CONFIDENCE = 0.9
+
+# Pick or estimate the green value once per acquisition run and apply it to all images of the run, see GreenCache
+GREEN_PER_RUN = True
+# Maximum decrease of the mask quality of an image compared to the image its run's green value was picked in, before it is picked for the image itself
+GREEN_RUN_MAX_QUALITY_DROP = 0.05
+# Mask values up to this share of full intensity from 0.0 or 1.0 count as clearly removed or kept, see mask_quality
+MASK_QUALITY_MARGIN = 0.05
+
+# Length of the longer side of the previews the green values are picked in, see GreenPreview
+PICK_PREVIEW_SIZE = 640
+# Number of images decoded and prepared for picking ahead of the shown one, see prefetch_preview
+PICK_PREFETCH = 2
+
+# Review the masks of the parallel greenscreen removal sheet by sheet before they are processed further, see ContactSheet
+GREENSCREEN_BATCH_REVIEW = False
+# Number of images per row of a review sheet
+REVIEW_SHEET_COLUMNS = 4
+# Number of rows of a review sheet
+REVIEW_SHEET_ROWS = 3
+# Length of the longer side of the images on a review sheet
+REVIEW_TILE_SIZE = 320
+
+# Push every message depth-first through the pipelines instead of filter by filter. The results of a message are
+# still collected until it finished, thus a saving last filter should drop their arrays (see save_message)
+PIPELINE_STREAMING = True
+# Maximum number of messages handed to batch processing filters in streaming mode
+PIPELINE_MICRO_BATCH_SIZE = 4
+# Maximum number of messages waiting for or in processing, before execute() blocks
+PIPELINE_MAX_IN_FLIGHT = 16
+# Collect per filter statistics, print them with Pipeline.stats()
+PIPELINE_INSTRUMENT = False
+
+# Execution backend of the augmentation pipeline ('inline', 'threads' or 'processes')
+AUGMENTATION_BACKEND = 'processes'
+# Run the augmentation filters as parallel stages with their own worker processes
+AUGMENTATION_STAGED = False
+# Number of messages the augmentation pipeline collects across execute() calls for its batch processing filters
+AUGMENTATION_BATCH_SIZE = 4
+# Maximum number of seconds a message waits for the other messages of its batch
+AUGMENTATION_BATCH_TIMEOUT = 0.5
+# Number of worker processes per stage of the staged augmentation pipeline
+AUGMENTATION_STAGE_WORKERS = {'prepare': 1, 'merge': 5, 'augment': 2, 'save': 1}
+# Maximum number of tasks waiting in front of each stage
+AUGMENTATION_STAGE_QUEUE_SIZE = 4
@@ -23,6 +23,9 @@ import cv2
 
 from ImageBot.infrastructure.ImageMessage import ImageMessage
 from ImageBot.infrastructure.Pipeline import Pipeline
+from ImageBot.infrastructure.StagedPipeline import StagedPipeline
+from ImageBot.infrastructure.ShardStore import ShardStore
+from ImageBot.infrastructure.Manifest import Manifest
 from ImageBot.infrastructure.filter import *
 from ImageBot.data_augmentation.poisson_merge.poisson_image_editing import poisson_edit
 
@@ -31,10 +34,12 @@ from ImageBot.data_augmentation.augmentations import *
 from ImageBot.image_processing.general import expand_canvas
 
 Loader : 'Queue[Path]' = Queue()
+Store : ShardStore = None
 Backgrounds : List[Path] = []
 manager : Manager = None
 
-def load_images(source_folder : Path, bgs_folder : Path, mask_suffix='_mask', extension='png'):
+def load_images(source_folder : Path, bgs_folder : Path, mask_suffix='_mask', extension='png', packed : bool = INTERMEDIATE_PACKED,
+                manifest : Manifest = None):
     """Load images paths into loader queue.
 
     Args:
@@ -42,9 +47,22 @@ def load_images(source_folder : Path, bgs_folder : Path, mask_suffix='_mask', ex
         bgs_folder (Path): Path to backgrounds folder.
         mask_suffix (str, optional): Suffix for mask image files. Defaults to '_mask'.
         extension (str, optional): File extension and therefore codec to load. Defaults to 'png'.
+        packed (bool, optional): The source directory is a shard store. Then, the loader queue gets the
+            message ids, which are read from Store (see load_stored). Defaults to INTERMEDIATE_PACKED.
+        manifest (Manifest, optional): Only load the images which are new or changed since they were recorded
+            in the manifest. The outputs of changed and deleted images are removed. Not supported for packed
+            sources, because their messages are never changed. Defaults to None.
     """
-    for file in source_folder.iterdir():
-        if not (mask_suffix) in file.stem:
+    global Store
+    if packed:
+        Store = ShardStore(source_folder)
+        for message_id in Store.ids():
+            Loader.put(message_id)
+    else:
+        files = [file for file in source_folder.iterdir() if not (mask_suffix) in file.stem]
+        if manifest is not None:
+            files = manifest.pending(files)
+        for file in files:
             Loader.put(file)
 
     for file in bgs_folder.iterdir():
@@ -53,7 +71,16 @@ def load_images(source_folder : Path, bgs_folder : Path, mask_suffix='_mask', ex
 # TODO: Fix threadpool issue
 AugmentationPipeline : Pipeline = None
 
-def init(dest_folder : Path = None):
+def _stage(name : str):
+    """Start a new stage, if the augmentation pipeline runs its filters as parallel stages.
+
+    Args:
+        name (str): Name of the stage in AUGMENTATION_STAGE_WORKERS
+    """
+    if isinstance(AugmentationPipeline, StagedPipeline):
+        AugmentationPipeline.add_stage(name, AUGMENTATION_STAGE_WORKERS[name])
+
+def init(dest_folder : Path = None, staged : bool = AUGMENTATION_STAGED, backend : str = AUGMENTATION_BACKEND, packed : bool = INTERMEDIATE_PACKED):
     """Initialize image augmentation pipeline.
 
     Initialize the image augmentation pipeline by creating an pipeline object and adding the necessary filters to it.
@@ -61,9 +88,22 @@ def init(dest_folder : Path = None):
     Args:
         dest_folder (Path, optional): Path to folder to store images in. If the folder doesn´t exist, it will be created. 
             If not provided (None), no images will be saved. Defaults to None.
+        staged (bool, optional): Run the filters as parallel stages with the number of workers given
+            in AUGMENTATION_STAGE_WORKERS. See AugmentationPipeline.utilisation_report(). Defaults to AUGMENTATION_STAGED.
+        backend (str, optional): Execution backend, if not staged. See Pipeline. Defaults to AUGMENTATION_BACKEND.
+        packed (bool, optional): Save the images in shard files instead of PNG files, see ShardStore. Defaults to INTERMEDIATE_PACKED.
     """
     global AugmentationPipeline, manager, Backgrounds
-    AugmentationPipeline = Pipeline(with_multiprocessing=True)
+    if staged:
+        AugmentationPipeline = StagedPipeline(queue_size=AUGMENTATION_STAGE_QUEUE_SIZE, streaming=PIPELINE_STREAMING,
+                                              micro_batch_size=PIPELINE_MICRO_BATCH_SIZE, max_in_flight=PIPELINE_MAX_IN_FLIGHT,
+                                              instrument=PIPELINE_INSTRUMENT, batch_size=AUGMENTATION_BATCH_SIZE,
+                                              batch_timeout=AUGMENTATION_BATCH_TIMEOUT)
+    else:
+        AugmentationPipeline = Pipeline(backend=backend, streaming=PIPELINE_STREAMING,
+                                        micro_batch_size=PIPELINE_MICRO_BATCH_SIZE, max_in_flight=PIPELINE_MAX_IN_FLIGHT,
+                                        instrument=PIPELINE_INSTRUMENT, batch_size=AUGMENTATION_BATCH_SIZE,
+                                        batch_timeout=AUGMENTATION_BATCH_TIMEOUT)
     manager = Manager()
     bgs = manager.list(Backgrounds)
     
@@ -73,6 +113,7 @@ def init(dest_folder : Path = None):
     #AugmentationPipeline.add(show)
 
     # Convert to grayscale
+    _stage('prepare')
     AugmentationPipeline.add(to_grayscale_image)
     #AugmentationPipeline.add(show)
 
@@ -81,10 +122,12 @@ def init(dest_folder : Path = None):
         AugmentationPipeline.add(w_enlarge_mask)
 
     # Apply merging filter (poisson_merge)
+    _stage('merge')
     AugmentationPipeline.add(partial(merge_with_bg_at_random_pos, bg_img_pool=bgs))
     #AugmentationPipeline.add(show)
 
     # Last augmentation step
+    _stage('augment')
     AugmentationPipeline.add(augment_training_images, True)
 
     # Convert to grayscale again
@@ -93,4 +136,6 @@ def init(dest_folder : Path = None):
     # If given, save image to folder
     if dest_folder is not None:
         dest_folder.mkdir(parents=True, exist_ok=True)
-        AugmentationPipeline.add(partial(save_message, dest_folder=dest_folder, save_mask=True))
\ No newline at end of file
+        _stage('save')
+        # The arrays of the saved results are freed right away, only their files are returned
+        AugmentationPipeline.add(partial(save_message, dest_folder=dest_folder, save_mask=True, packed=packed, keep_arrays=False))
\ No newline at end of file
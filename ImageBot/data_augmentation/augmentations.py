@@ -20,7 +20,10 @@ from .poisson_merge.poisson_image_editing import poisson_edit
 from ..infrastructure.Pipeline import Pipeline
 from ..image_processing.general import expand_canvas
 from ..image_processing.masks import combine_images, mask_bounding_box
-from ..infrastructure.ImageMessage import ImageMessage
+from ..infrastructure.ImageMessage import ImageMessage, ImageFile
+from ..infrastructure.dtypes import as_uint8, as_unit, to_policy
+from ..infrastructure.conversions import color_of, convert, convert_image, requires
+from ..infrastructure.BufferPool import default_pool
 from ..Config import *
 
 import imgaug.augmenters as iaa
@@ -54,6 +57,7 @@ def image_resize(image : np.ndarray, height=None, width=None) -> np.ndarray:
 
     return cv2.resize(image, target_size)
 
+@requires(color='GRAY')
 def merge_with_bg_at_random_pos(message : ImageMessage, bg_img_pool : List[Path]) -> List[ImageMessage]:
     """Insert the given image into random selected backgrounds using poisson_merge.
 
@@ -70,16 +74,16 @@ def merge_with_bg_at_random_pos(message : ImageMessage, bg_img_pool : List[Path]
     
     for _ in range(MODEL_MULTIPLY_MESSAGE_BACKGROUND_ASSIGNMENT):
         
-        new_message = ImageMessage(uuid.uuid4())
+        new_message = ImageMessage(uuid.uuid4(), origin=message.origin)
         
         # Randomly select an image from the image bg pool
         bg_index = np.random.randint(0, len(bg_img_pool))
-        # Load the backkground image
-        bg = cv2.imread(bg_img_pool[bg_index].as_posix(), cv2.IMREAD_GRAYSCALE) / 255.0
+        # Load the backkground image, large images are decoded at a reduced resolution right away
+        bg = ImageFile(bg_img_pool[bg_index], cv2.IMREAD_GRAYSCALE, BACKGROUND_SIZE).decode()
         if(bg.shape[0] > bg.shape[1]):
-            bg = image_resize(bg, height=416)
+            bg = image_resize(bg, height=BACKGROUND_SIZE)
         else:
-            bg = image_resize(bg, width=416)
+            bg = image_resize(bg, width=BACKGROUND_SIZE)
 
     
         
@@ -94,17 +98,24 @@ def merge_with_bg_at_random_pos(message : ImageMessage, bg_img_pool : List[Path]
         else:
             dsize = (int(message.image.shape[1]/factor2*scale), int(message.image.shape[0]/factor2*scale))
         
-        new_message.image = cv2.resize(message.image, dsize=dsize, interpolation=cv2.INTER_AREA)
+        image = cv2.resize(message.image, dsize=dsize, interpolation=cv2.INTER_AREA)
         new_message.mask = cv2.resize(message.mask, dsize=dsize, interpolation=cv2.INTER_AREA)
 
         # Now add the image at a random position
         pos = (np.random.randint(0, max(1, bg.shape[0]-dsize[1])), np.random.randint(0, max(1, bg.shape[1]-dsize[0])))
         canvas_expand = [ (pos[0], bg.shape[0]-dsize[1]-pos[0]), (pos[1], bg.shape[1]-dsize[0]-pos[1]) ]
-        # Expand the canvas of the orignal image
-        new_message.image = expand_canvas(new_message.image, canvas_expand)
+        # Expand the canvas of the orignal image. The image canvas is only needed by the poisson merge,
+        # thus it is borrowed from the pool of this worker, as it has the size of the background every time.
+        pool = default_pool()
+        canvas_shape = (dsize[1] + sum(canvas_expand[0]), dsize[0] + sum(canvas_expand[1])) + image.shape[2:]
+        canvas = expand_canvas(image, canvas_expand, out=pool.take(canvas_shape, image.dtype))
         new_message.mask = expand_canvas(new_message.mask, canvas_expand)
 
-        new_message.image = poisson_edit(np.uint8(new_message.image*255), np.uint8(bg*255), np.uint8(new_message.mask*255), (0, 0)) / 255.0
+        # The poisson merge binarises the mask in place, thus it gets a pooled copy
+        mask = pool.take(new_message.mask.shape, np.uint8)
+        np.copyto(mask, as_uint8(new_message.mask))
+        new_message.image = to_policy(poisson_edit(as_uint8(canvas), as_uint8(bg), mask, (0, 0)))
+        pool.give(canvas, mask)
 
         # Append it to the results
         result.append(new_message)
@@ -123,12 +134,10 @@ def augment_training_images(messages : ImageMessage) -> List[ImageMessage]:
     grayscale = False
 
     # Convert the images to the proper size and generate the heatmaps
-    heatmaps = [HeatmapsOnImage(np.float32(m.mask), shape=m.image.shape, min_value=0.0, max_value=1.0) for m in messages]
+    heatmaps = [HeatmapsOnImage(as_unit(m.mask, np.float32), shape=m.image.shape, min_value=0.0, max_value=1.0) for m in messages]
     for m in messages:
-        m.image = np.uint8(m.image*255.0)
-        if m.image.shape[2] == 1:
+        if color_of(m.image) == 'GRAY':
             m.metadata['grayscale']  = True
-            m.image = cv2.merge((m.image, m.image, m.image))
         
     # Generate some identity images which we still keep
     identity_messages = [m for m in messages]
@@ -203,13 +212,14 @@ def augment_training_images(messages : ImageMessage) -> List[ImageMessage]:
     )
     
     # Run the image pipeline
-    images, heatmaps = seq(images=[m.image for m in new_messages], heatmaps=new_heatmaps)
+    # imgaug needs three uint8 channels, the identity images are kept as they are
+    images, heatmaps = seq(images=[convert_image(m.image, 'BGR', 'uint8') for m in new_messages], heatmaps=new_heatmaps)
     
     # Now convert the heatmaps back to the right profile
-    result = [ImageMessage(uuid.uuid4(), image=image/255.0, mask=np.float64(heatmaps[i].get_arr())) for i, image in enumerate(images)]
+    result = [ImageMessage(uuid.uuid4(), image=to_policy(image), mask=to_policy(heatmaps[i].get_arr()), origin=new_messages[i].origin)
+              for i, image in enumerate(images)]
     # Add the identity images
     for m in identity_messages:
-        m.image = m.image/255.0
-        result.append(m)
+        result.append(convert(m))
 
     return result
\ No newline at end of file
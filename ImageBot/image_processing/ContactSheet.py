@@ -0,0 +1,163 @@
+"""Review of many greenscreen masks at once.
+
+A contact sheet shows the images of several messages in a grid, each one with
+the greenscreen its mask removes darkened. All images are accepted initially.
+The user rejects or accepts an image again by clicking on it or pressing its
+number, 'x' rejects all images of the sheet and any other key confirms the
+sheet. Thus, a whole sheet of masks is reviewed with a single key press, if
+all of them are fine.
+
+Example:
+    for sheet in sheets(messages):
+        accepted = ContactSheet(sheet).review()
+
+Todo:
+    - Add license boilerplate
+"""
+
+from itertools import islice
+
+import cv2
+import numpy as np
+
+from ImageBot.Config import REVIEW_SHEET_COLUMNS, REVIEW_SHEET_ROWS, REVIEW_TILE_SIZE
+
+from ImageBot.infrastructure.ImageMessage import fit_size
+from ImageBot.infrastructure.dtypes import as_uint8, as_unit
+
+# Brightness of the removed greenscreen on the sheet
+REMOVED_BRIGHTNESS = 0.25
+# Color of the frame and cross of rejected images (BGR)
+REJECTED_COLOR = (0, 0, 255)
+# Keys of the images on a sheet, the image number is shown in the upper left corner
+TILE_KEYS = '123456789abcdefghijklmnopqrstuvw'
+
+class ContactSheet(object):
+    """Grid of images with their masks, which are accepted or rejected at once, see the module description."""
+
+    def __init__(self, messages, columns=REVIEW_SHEET_COLUMNS, tile_size=REVIEW_TILE_SIZE):
+        """Constructor.
+
+        Args:
+            messages (List[ImageMessage]): Messages with image and mask
+            columns (int, optional): Number of images per row. Defaults to REVIEW_SHEET_COLUMNS.
+            tile_size (int, optional): Length of the longer side of the images. Defaults to REVIEW_TILE_SIZE.
+        """
+        assert 0 < len(messages) <= len(TILE_KEYS), "A sheet shows at most %i images" % len(TILE_KEYS)
+        assert columns > 0 and tile_size > 0
+        self.messages = list(messages)
+        self.accepted = [True] * len(self.messages)
+        self._columns = min(columns, len(self.messages))
+        self._rows = (len(self.messages) + columns - 1) // columns
+        self._tile_size = tile_size
+        self._tiles = [overlay(m.image, m.mask, tile_size) for m in self.messages]
+
+    def image(self) -> np.ndarray:
+        """Draw the sheet with the current decisions.
+
+        Returns:
+            np.ndarray: The uint8 BGR sheet
+        """
+        size = self._tile_size
+        sheet = np.zeros((self._rows*size, self._columns*size, 3), np.uint8)
+        for index, tile in enumerate(self._tiles):
+            top, left = (index // self._columns) * size, (index % self._columns) * size
+            height, width = tile.shape[:2]
+            # Center the tile in its cell
+            y, x = top + (size - height) // 2, left + (size - width) // 2
+            sheet[y:y+height, x:x+width] = tile
+            if not self.accepted[index]:
+                cv2.rectangle(sheet, (left + 2, top + 2), (left + size - 3, top + size - 3), REJECTED_COLOR, 4)
+                cv2.line(sheet, (x, y), (x + width - 1, y + height - 1), REJECTED_COLOR, 2)
+                cv2.line(sheet, (x + width - 1, y), (x, y + height - 1), REJECTED_COLOR, 2)
+            cv2.putText(sheet, TILE_KEYS[index], (left + 8, top + 24), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+        return sheet
+
+    def tile_at(self, x, y):
+        """Index of the image at a position of the sheet.
+
+        Args:
+            x (int): Horizontal position
+            y (int): Vertical position
+
+        Returns:
+            int|None: The index or None, if there is no image
+        """
+        column, row = x // self._tile_size, y // self._tile_size
+        index = row * self._columns + column
+        if column >= self._columns or index >= len(self.messages):
+            return None
+        return index
+
+    def toggle(self, index):
+        """Reject an accepted image or accept a rejected one.
+
+        Args:
+            index (int): Index of the image
+        """
+        self.accepted[index] = not self.accepted[index]
+
+    def review(self, title='review') -> list:
+        """Show the sheet until the user confirms it.
+
+        Args:
+            title (str, optional): Title of the window. Defaults to 'review'.
+
+        Returns:
+            List[bool]: Whether each message has been accepted
+        """
+        def clicked(event, x, y, flags, param):
+            if event == cv2.EVENT_LBUTTONUP:
+                index = self.tile_at(x, y)
+                if index is not None:
+                    self.toggle(index)
+                    cv2.imshow(title, self.image())
+
+        cv2.imshow(title, self.image())
+        cv2.setMouseCallback(title, clicked)
+        while True:
+            key = cv2.waitKey(0) & 0xFF
+            if key == ord('x'):
+                self.accepted = [False] * len(self.messages)
+                break
+            index = TILE_KEYS.find(chr(key))
+            if 0 <= index < len(self.messages):
+                self.toggle(index)
+                cv2.imshow(title, self.image())
+            else:
+                break
+        cv2.destroyWindow(title)
+        return list(self.accepted)
+
+def overlay(image, mask, size) -> np.ndarray:
+    """Shrink an image and darken the greenscreen its mask removes.
+
+    Args:
+        image (np.ndarray): BGR image
+        mask (np.ndarray): Mask of the image
+        size (int): Length of the longer side of the result
+
+    Returns:
+        np.ndarray: The uint8 BGR overlay
+    """
+    image = fit_size(as_uint8(image), size)
+    mask = as_unit(fit_size(as_uint8(mask), size))
+    brightness = REMOVED_BRIGHTNESS + (1.0 - REMOVED_BRIGHTNESS) * mask
+    return np.uint8(image * brightness[:, :, np.newaxis])
+
+def sheets(items, size=REVIEW_SHEET_COLUMNS*REVIEW_SHEET_ROWS):
+    """Generator splitting items into the lists shown on one sheet each.
+
+    Args:
+        items (Iterable): The items, they are only consumed as far as needed for the next sheet
+        size (int, optional): Number of items per sheet. Defaults to REVIEW_SHEET_COLUMNS*REVIEW_SHEET_ROWS.
+
+    Yields:
+        List: The items of a sheet
+    """
+    iterator = iter(items)
+    while True:
+        sheet = list(islice(iterator, size))
+        if not sheet:
+            return
+        yield sheet
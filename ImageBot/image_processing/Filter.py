@@ -8,9 +8,11 @@ Todo:
 
 from os.path import isfile, join
 from os import listdir
+from collections import OrderedDict
 from types import MethodWrapperType
 from typing import List
 from multiprocessing import Lock
+import threading
 
 import cv2
 from cv2 import imread
@@ -18,71 +20,247 @@ import numpy as np
 
 from ImageBot.Config import *
 
-from ImageBot.infrastructure.ImageMessage import ImageMessage
+from ImageBot.infrastructure.ImageMessage import ImageMessage, fit_size
 from ImageBot.infrastructure.Pipeline import Pipeline
+from ImageBot.infrastructure.dtypes import as_uint8, scale_of
+from ImageBot.infrastructure.filter import write_image
 
 from ImageBot.image_processing.greenscreen import *
 from ImageBot.image_processing.masks import clean_mask_surrounding
+from ImageBot.image_processing.chroma_key import chroma_key
 
 # Main Filter for PostProcessor
 
 GreenscreenPipeline : Pipeline = None
+# Inline GreenscreenPipeline of the worker processes, see _worker_GreenscreenPipeline
+_WorkerGreenscreenPipeline : Pipeline = None
 
 def _init_GreenscreenPipeline():
     global GreenscreenPipeline
     GreenscreenPipeline = Pipeline(with_multiprocessing=True)
+    _add_greenscreen_filters(GreenscreenPipeline)
 
+def _worker_GreenscreenPipeline() -> Pipeline:
+    """Returns the inline GreenscreenPipeline of this process and creates it, if necessary.
+
+    The filters of the parallel PostProcessor run in worker processes, which cannot start processes
+    themselves and do not inherit GreenscreenPipeline with every start method (e.g. spawn on Windows).
+
+    Returns:
+        Pipeline: The pipeline
+    """
+    global _WorkerGreenscreenPipeline
+    if _WorkerGreenscreenPipeline is None:
+        pipeline = Pipeline()
+        _add_greenscreen_filters(pipeline)
+        _WorkerGreenscreenPipeline = pipeline
+    return _WorkerGreenscreenPipeline
+
+def _add_greenscreen_filters(pipeline : Pipeline):
+    """Add the filters of GreenscreenPipeline."""
     # Generate the greenscreen mask
-    GreenscreenPipeline.add(w_color_based_filer)
+    pipeline.add(w_color_based_filer)
     # Remove everything outside the center mask
-    GreenscreenPipeline.add(w_clean_mask_surrouding)
+    pipeline.add(w_clean_mask_surrouding)
     # Tigthen the mask a little bit
-    GreenscreenPipeline.add(w_tigthen_mask)
+    pipeline.add(w_tigthen_mask)
 
-def remove_greenscreen(message : ImageMessage) -> List[ImageMessage]:
-    """Removes the greenscreen from the image inside the given message.
+class GreenPreview(object):
+    """Downscaled copy of an image to pick the green value in, see select_green.
+
+    The masks shown while picking are computed on the copy and cached per green value,
+    thus they are shown immediately, even for large images. The mask of the estimated
+    green value is computed in advance.
+    """
+
+    def __init__(self, image, max_size=PICK_PREVIEW_SIZE):
+        """Constructor.
+
+        Args:
+            image (np.ndarray): Image to pick the green value in
+            max_size (int, optional): Length of the longer side of the copy. Defaults to PICK_PREVIEW_SIZE.
+        """
+        self.image = fit_size(as_uint8(image), max_size)
+        self._full_image = image
+        self._scale = image.shape[1] / self.image.shape[1]
+        self._value_scale = scale_of(image) / 255.0
+        self._masks = {}
+        # The estimated green value is shown first
+        green, _ = estimate_green(self.image)
+        self.default = green * self._value_scale
+        self.mask(self.default)
+
+    def pick(self, position):
+        """Green value at a position of the copy, it is averaged in the full resolution image.
+
+        Args:
+            position (Tuple[int]): Position in the copy
+
+        Returns:
+            np.ndarray: The green value in the value range of the image
+        """
+        x, y = position
+        return pick_color(self._full_image, (int(x*self._scale), int(y*self._scale)), 5)
+
+    def mask(self, green):
+        """Mask of the copy with the given green value, like GreenscreenPipeline creates it.
+
+        Args:
+            green (Tuple[float]): Green value in the value range of the image
+
+        Returns:
+            np.ndarray: The uint8 mask
+        """
+        key = tuple(np.round(np.asarray(green, dtype=np.float64) / self._value_scale, 1))
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = chroma_key(self.image, key, GREEN_MIN_THRESHOLD, GREEN_MAX_THRESHOLD)
+            try:
+                mask = clean_mask_surrounding(mask, max(1, int(round(MASK_CONTOUR_SMOOTHING / self._scale))), MASK_CONTOUR_MIN_SIZE)
+            except cv2.error:
+                # No object is left
+                mask = np.zeros_like(mask)
+            self._masks[key] = mask
+        return mask
+
+# Previews prepared ahead by prefetch_preview, by message id
+_previews = OrderedDict()
+_previews_lock = threading.Lock()
+
+def prefetch_preview(message : ImageMessage):
+    """Prepare the preview of a message in advance, use it as prepare function of an ImageLoader.
+
+    While the user picks the green value of an image, the next ones are decoded and their previews
+    prepared in the threads of the loader, e.g. ImageLoader(paths, read_ahead=PICK_PREFETCH, prepare=prefetch_preview).
+    Only the previews of the last 2*PICK_PREFETCH messages are kept.
 
     Args:
-        message (ImageMessage): Message containing the image to remove the greenscreen from
+        message (ImageMessage): The message, which is picked by remove_greenscreen afterwards
+    """
+    preview = GreenPreview(message.image)
+    with _previews_lock:
+        _previews[message.id] = preview
+        while len(_previews) > 2*PICK_PREFETCH:
+            _previews.popitem(last=False)
+
+def take_preview(message : ImageMessage) -> GreenPreview:
+    """Returns the preview prepared for a message by prefetch_preview and forgets it.
+
+    Args:
+        message (ImageMessage): The message
 
     Returns:
-        List[ImageMessage]: ImageMessage containing removed greenscreen and mask
+        GreenPreview|None: The preview or None, if it has not been prepared (anymore)
+    """
+    with _previews_lock:
+        return _previews.pop(message.id, None)
 
-    TODO: Move mask to metadata
+def select_green(image, green=None, preview : GreenPreview = None):
+    """Lets the user pick the green value by clicking on the image.
+
+    The image is shown downscaled next to the mask of the current green value, which is updated with
+    every click. Any key except 'x' confirms the current value, 'x' skips the image.
+
+    Args:
+        image (np.ndarray): Image to pick the green value in
+        green (Tuple[float]|None, optional): Initial green value in the value range of the image. Defaults to None,
+            which estimates it, see estimate_green.
+        preview (GreenPreview|None, optional): Prepared preview of the image. Defaults to None, which prepares it.
+
+    Returns:
+        Tuple[np.ndarray|None, bool]: The current green value in the value range of the image and whether the image has been skipped
     """
-    current_image = message.image
+    if preview is None:
+        preview = GreenPreview(image)
+    picked = [preview.default if green is None else green]
 
     def pick_green(event, x, y, flags, param):
         if event == cv2.EVENT_LBUTTONUP:
-            message.green = pick_color(current_image, (x, y), 5)
-            #print("Green value set to " + str(message.green))
+            picked[0] = preview.pick((x, y))
+            #print("Green value set to " + str(picked[0]))
 
             # Now show the mask
-            diff_image = color_based_filter(current_image, message.green, GREEN_MIN_THRESHOLD, GREEN_MAX_THRESHOLD)
-            diff_image = clean_mask_surrounding(diff_image, MASK_CONTOUR_SMOOTHING, MASK_CONTOUR_MIN_SIZE)
-            cv2.imshow('mask', np.uint8(diff_image*255))
-            # Show the mask for 3 seconds
-            cv2.waitKey(1000)
-            cv2.destroyWindow('mask')
+            cv2.imshow('mask', preview.mask(picked[0]))
 
     # If the green value has not been set yet, set it
     #print("Please select the green value by clicking on the image.")
     #print("If you selected an appropriate green value or want to select a green value later on, click any key to continue.")
 
-    cv2.imshow('image', message.image)
+    cv2.imshow('image', preview.image)
     cv2.namedWindow('image')
     cv2.setMouseCallback('image', pick_green)
+    cv2.imshow('mask', preview.mask(picked[0]))
     pressed_key = cv2.waitKey(0)
     cv2.destroyAllWindows()
 
     # If the x key is pressed we skip this image, this might be used if the mask is not good enough
-    if pressed_key != ord('x'):
+    return picked[0], pressed_key == ord('x')
+
+def remove_greenscreen(message : ImageMessage) -> List[ImageMessage]:
+    """Removes the greenscreen from the image inside the given message.
+
+    Args:
+        message (ImageMessage): Message containing the image to remove the greenscreen from
+
+    Returns:
+        List[ImageMessage]: ImageMessage containing removed greenscreen and mask
+
+    TODO: Move mask to metadata
+    """
+    green, skipped = select_green(message.image, message.green, take_preview(message))
+    message.green = green
+
+    if not skipped:
         result = GreenscreenPipeline(message)
     else:
         result = []
 
     return result
 
+def remove_greenscreen_of_run(message : ImageMessage, headless=False) -> List[ImageMessage]:
+    """Removes the greenscreen with the green value of the acquisition run of the image, see GreenCache.
+
+    The green value and the mask quality achieved with it in the run ('run_quality' metadata) are set
+    by the loader, see PostProcessor.load_capture.
+
+    Args:
+        message (ImageMessage): Message containing the image to remove the greenscreen from
+        headless (bool, optional): Estimate the green value of images without run, see remove_greenscreen_headless. Defaults to False.
+
+    Returns:
+        List[ImageMessage]: ImageMessage containing removed greenscreen and mask. Empty, if the image has no green value
+            or its mask quality is more than GREEN_RUN_MAX_QUALITY_DROP below the one of the run, the green value of the
+            image then needs to be picked with remove_greenscreen.
+    """
+    if message.green is None:
+        return remove_greenscreen_headless(message) if headless else []
+
+    quality = mask_quality(message.image, message.green)
+    if quality < message.metadata.get('run_quality', 0.0) - GREEN_RUN_MAX_QUALITY_DROP:
+        return []
+
+    message.metadata['mask_quality'] = quality
+    return _worker_GreenscreenPipeline()(message)
+
+def remove_greenscreen_headless(message : ImageMessage) -> List[ImageMessage]:
+    """Removes the greenscreen with an estimated green value instead of a picked one, see estimate_green.
+
+    Args:
+        message (ImageMessage): Message containing the image to remove the greenscreen from
+
+    Returns:
+        List[ImageMessage]: ImageMessage containing removed greenscreen and mask. Empty, if the confidence of
+            the estimation is below GREEN_ESTIMATION_MIN_CONFIDENCE, the green value of the image then needs
+            to be picked with remove_greenscreen.
+    """
+    green, confidence = estimate_green(message.image)
+    if confidence < GREEN_ESTIMATION_MIN_CONFIDENCE:
+        return []
+
+    message.green = green
+    message.metadata['green_confidence'] = confidence
+    return _worker_GreenscreenPipeline()(message)
+
 def save_with_mask(message, dest_folder, mask_suffix='mask', extension='png'):
     """Save given image into specified folder.
 
@@ -108,8 +286,8 @@ def save_with_mask(message, dest_folder, mask_suffix='mask', extension='png'):
         filename_mask = str(message.id) + '_' + mask_suffix + '.' + extension
 
     print(filename)
-    cv2.imwrite(os.path.join(dest_folder, filename), np.uint8(message.image*255))
-    cv2.imwrite(os.path.join(dest_folder, filename_mask), np.uint8(message.mask*255))
+    write_image(os.path.join(dest_folder, filename), as_uint8(message.image))
+    write_image(os.path.join(dest_folder, filename_mask), as_uint8(message.mask))
 
     return message
 
@@ -8,83 +8,227 @@ Todo:
 from os.path import isfile, join
 from os import PathLike, listdir
 from functools import partial
-from typing import List
+from typing import Iterator, List
 from pathlib import Path
 from queue import Queue
 
 from numpy import source
 
+from ImageBot.Config import *
 from ImageBot.infrastructure.Pipeline import Pipeline
 from ImageBot.infrastructure.Pipeline import Pipeline
 from ImageBot.infrastructure.ImageMessage import ImageMessage
+from ImageBot.infrastructure.StageCache import StageCache
+from ImageBot.infrastructure.Manifest import Manifest
+from ImageBot.infrastructure.ImageLoader import ImageLoader
+from ImageBot.infrastructure.GreenCache import GreenCache, group_by_run, run_of
+from ImageBot.infrastructure.dtypes import policy_dtype, scale_of
 from ImageBot.infrastructure.filter import *
 from ImageBot.image_processing.masks import *
 from ImageBot.image_processing.general import *
 from ImageBot.image_processing.greenscreen import *
 from ImageBot.image_processing.model import *
 
-from ImageBot.image_processing.Filter import remove_greenscreen, save_with_mask, _init_GreenscreenPipeline
+from ImageBot.image_processing.ContactSheet import ContactSheet, sheets
+from ImageBot.image_processing.Filter import remove_greenscreen, remove_greenscreen_headless, remove_greenscreen_of_run, select_green,\
+    prefetch_preview, take_preview, save_with_mask, _init_GreenscreenPipeline
+
+# The Config parameters the results of the greenscreen removal depend on
+GREENSCREEN_PARAMETERS = ('GREEN_MIN_THRESHOLD', 'GREEN_MAX_THRESHOLD', 'MASK_CONTOUR_SMOOTHING', 'MASK_CONTOUR_MIN_SIZE',
+                          'MASK_TIGTHEN_DISTANCE', 'IMAGE_DTYPE')
+# The Config parameters the results of the headless greenscreen removal depend on
+HEADLESS_GREENSCREEN_PARAMETERS = GREENSCREEN_PARAMETERS + ('GREEN_ESTIMATION_BORDER', 'GREEN_ESTIMATION_HUE_RANGE',
+                                                            'GREEN_ESTIMATION_MIN_SATURATION', 'GREEN_ESTIMATION_MIN_CONFIDENCE')
+# The Config parameters the results of the greenscreen removal with the green values of the runs depend on
+RUN_GREENSCREEN_PARAMETERS = HEADLESS_GREENSCREEN_PARAMETERS + ('GREEN_RUN_MAX_QUALITY_DROP', 'MASK_QUALITY_MARGIN')
 
 # TODO: Fix threadpool issue 
 Loader : 'Queue[Path]' = Queue()
 PostProcessor: Pipeline = None
-
-def load_images(source_folder : Path, mask_suffix='_mask', extension='png'):
+# Lets the user pick the green values of the images the parallel PostProcessor left without results
+ReviewProcessor: Pipeline = None
+# Images waiting for ReviewProcessor
+Review : 'Queue[Path]' = Queue()
+# Removes the greenscreen in batch review mode, before the masks are reviewed
+MaskProcessor: Pipeline = None
+
+def load_images(source_folder : Path, mask_suffix='_mask', extension='png', manifest : Manifest = None):
     """Load image paths into Loader queue.
 
     Args:
         source_folder (Path): Path to folder containing input images.
         mask_suffix (str, optional): Suffix of image files to mark mask images. Defaults to '_mask'.
         extension (str, optional): File extension to load. Defaults to 'png'.
+        manifest (Manifest, optional): Only load the images which are new or changed since they were
+            recorded in the manifest. The outputs of changed and deleted images are removed. Defaults to None.
+    """
+    files = [file for file in source_folder.iterdir() if not (mask_suffix in file.stem)]
+    if manifest is not None:
+        files = manifest.pending(files)
+    for file in files:
+        Loader.put(file)
+
+def pick_run_greens(files, greens : GreenCache, headless : bool = GREENSCREEN_HEADLESS, removed=()):
+    """Pick or estimate the green value of every acquisition run, which is not in the cache or outdated.
+
+    The green value is picked in the first image of the run. In headless mode, it is estimated
+    instead and only picked, if the estimation is not confident. If the image is skipped, the run
+    gets no green value and the green values of its images are picked one by one in review.
+    The green value of a run is outdated, if the image it was picked in changed (see GreenCache.current)
+    or if images of the run changed or were deleted, e.g. because a new acquisition reused the run names.
+
+    Args:
+        files (Iterable[Path]): The images to process, see load_images
+        greens (GreenCache): The cache, it is saved afterwards
+        headless (bool, optional): Estimate the green values, see estimate_green. Defaults to GREENSCREEN_HEADLESS.
+        removed (Iterable[Path], optional): The changed and deleted images, see Manifest.removed. Defaults to ().
     """
-    for file in source_folder.iterdir():
-        if not (mask_suffix in file.stem):
-            Loader.put(file)
+    outdated = set(run_of(path) for path in removed) | set(run for run in greens.runs() if not greens.current(run))
+    for run in outdated:
+        greens.remove(run)
+    first_files = [run_files[0] for run, run_files in group_by_run(files).items() if run is not None and run not in greens]
+    # The next images are decoded and prepared for picking while the current one is shown
+    loader = ImageLoader(first_files, read_ahead=PICK_PREFETCH, prepare=None if headless else prefetch_preview)
+    for message in loader:
+        image = message.image
+        green = None
+        if headless:
+            green, confidence = estimate_green(image)
+            if confidence < GREEN_ESTIMATION_MIN_CONFIDENCE:
+                green = None
+        if green is None:
+            green, skipped = select_green(image, preview=take_preview(message))
+            if skipped:
+                continue
+        path = message.metadata['image_path']
+        greens.set(run_of(path), np.asarray(green) * 255.0 / scale_of(image), mask_quality(image, green), path)
+    greens.save()
+
+def load_capture(image_file : Path, runs : dict = None) -> ImageMessage:
+    """Load an image with the green value of its acquisition run, use it as loader of the parallel PostProcessor.
 
-def init(dest_folder: Path = None) -> None:
+    Args:
+        image_file (Path): Path of the image file
+        runs (dict, optional): The green values of the runs, see GreenCache.runs. Defaults to None.
+
+    Returns:
+        ImageMessage: Loaded image in a new ImageMessage, see remove_greenscreen_of_run
+    """
+    message = load_path(image_file)
+    entry = runs.get(run_of(image_file)) if runs is not None else None
+    if entry is not None:
+        message.green = np.array(entry['green']) * scale_of(policy_dtype()) / 255.0
+        message.metadata['run_quality'] = entry['quality']
+    return message
+
+def init(dest_folder: Path = None, packed : bool = INTERMEDIATE_PACKED, headless : bool = GREENSCREEN_HEADLESS, per_run : bool = GREEN_PER_RUN,
+         batch_review : bool = GREENSCREEN_BATCH_REVIEW) -> None:
     """Initialize the post processing pipeline.
 
+    In headless mode, the green values are estimated instead of picked (see remove_greenscreen_headless).
+    In per run mode, the green value of every acquisition run is picked once before (see pick_run_greens)
+    and the loader sets it (see load_capture). In both modes, PostProcessor processes the images in
+    GREENSCREEN_HEADLESS_WORKERS processes without interaction. Images without results need to be passed
+    to ReviewProcessor, which lets the user pick their green values. Otherwise, ReviewProcessor is the PostProcessor.
+
+    With batch review, the parallel greenscreen removal is done by MaskProcessor. The user reviews its results
+    sheet by sheet (see review_masks) and only the accepted ones are passed to PostProcessor for the remaining filters.
+
     Args:
         dest_folder (Path, optional): Path to folder to save the resulting images in. Defaults to None.
+        packed (bool, optional): Save the images in shard files instead of PNG files, see ShardStore. Defaults to INTERMEDIATE_PACKED.
+        headless (bool, optional): Estimate the green values without interaction. Defaults to GREENSCREEN_HEADLESS.
+        per_run (bool, optional): Apply the green value of the run to its images, see remove_greenscreen_of_run. Defaults to GREEN_PER_RUN.
+        batch_review (bool, optional): Review the masks before the remaining filters, only in headless or per run mode. Defaults to GREENSCREEN_BATCH_REVIEW.
 
     Todo:
         Rewrite Loader to be on demand or more flexible?
     """
-    global PostProcessor
-    PostProcessor = Pipeline()
+    global PostProcessor, ReviewProcessor, MaskProcessor
 
+    parallel = headless or per_run
+    assert parallel or not batch_review, "The masks can only be reviewed in batches in headless or per run mode"
     _init_GreenscreenPipeline()
 
     # Load image from loader
     #PostProcessor.add(partial(load_image, source=Loader))
     #PostProcessor.add(show)
 
-    # First, find the mask by removing the greenscreen
-    PostProcessor.add(remove_greenscreen)
+    # First, find the mask by removing the greenscreen. The results are cached, thus
+    # the green values only need to be picked again if the image or a parameter changed.
+    cache = StageCache(Path(STAGE_CACHE_FOLDER)) if STAGE_CACHE_FOLDER is not None else None
+
+    ReviewProcessor = Pipeline(streaming=PIPELINE_STREAMING, micro_batch_size=PIPELINE_MICRO_BATCH_SIZE, instrument=PIPELINE_INSTRUMENT)
+    ReviewProcessor.add(remove_greenscreen, cache=cache, config=GREENSCREEN_PARAMETERS)
+    _add_processing(ReviewProcessor, dest_folder, packed)
+
+    MaskProcessor = None
+    if parallel:
+        PostProcessor = Pipeline(with_multiprocessing=True, max_no_processes=GREENSCREEN_HEADLESS_WORKERS, streaming=PIPELINE_STREAMING,
+                                 micro_batch_size=PIPELINE_MICRO_BATCH_SIZE, instrument=PIPELINE_INSTRUMENT)
+        masks = PostProcessor
+        if batch_review:
+            # The masks are reviewed in between
+            MaskProcessor = masks = Pipeline(with_multiprocessing=True, max_no_processes=GREENSCREEN_HEADLESS_WORKERS, instrument=PIPELINE_INSTRUMENT)
+        if per_run:
+            masks.add(partial(remove_greenscreen_of_run, headless=headless), cache=cache, config=RUN_GREENSCREEN_PARAMETERS)
+        else:
+            masks.add(remove_greenscreen_headless, cache=cache, config=HEADLESS_GREENSCREEN_PARAMETERS)
+        _add_processing(PostProcessor, dest_folder, packed)
+    else:
+        PostProcessor = ReviewProcessor
 
+    #return PostProcessor
+
+def review_masks(masked) -> Iterator:
+    """Let the user accept or reject the masks of MaskProcessor sheet by sheet, see ContactSheet.
+
+    The rejected images and the images without results are put into the Review queue. While a sheet
+    is shown, MaskProcessor already removes the greenscreen of the next images.
+
+    Args:
+        masked (Iterable[Tuple[Path, List[ImageMessage]]]): The images and their results of MaskProcessor
+
+    Yields:
+        Tuple[Path, ImageMessage]: The accepted images and their messages for PostProcessor
+    """
+    for sheet in sheets(masked):
+        for path, results in sheet:
+            if not results:
+                Review.put(path)
+        sheet = [(path, results[0]) for path, results in sheet if results]
+        if not sheet:
+            continue
+        accepted = ContactSheet([message for _, message in sheet]).review()
+        for (path, message), ok in zip(sheet, accepted):
+            if ok:
+                yield path, message
+            else:
+                Review.put(path)
+
+def _add_processing(pipeline : Pipeline, dest_folder : Path, packed : bool):
+    """Add the filters following the greenscreen removal, see init."""
     # Then, apply the first augmentation steps
     # Crop the image
-    PostProcessor.add(w_crop_to_mask)
-    #PostProcessor.add(show)
+    pipeline.add(w_crop_to_mask)
+    #pipeline.add(show)
 
     # Apply random augmentation of model parts (generates multiple 
-    PostProcessor.add(w_augment_mask, True)
-    #PostProcessor.add(show)
+    pipeline.add(w_augment_mask, True)
+    #pipeline.add(show)
 
     # Expand the canvas to fit all possible rotations
-    PostProcessor.add(w_expand_for_max_affine)
-    #PostProcessor.add(show)
+    pipeline.add(w_expand_for_max_affine)
+    #pipeline.add(show)
 
     # Apply the augmentation / transformation
-    PostProcessor.add(w_model_augement, True)
+    pipeline.add(w_model_augement, True)
 
     # Crop it back again
-    PostProcessor.add(w_crop_to_mask)
+    pipeline.add(w_crop_to_mask)
 
     # If provided, save image in given folder
     if dest_folder is not None:
         dest_folder.mkdir(parents=True, exist_ok=True)
-        PostProcessor.add(partial(save_message, dest_folder=dest_folder, save_mask=True))
-
-    #return PostProcessor
-
+        # The arrays of the saved results are freed right away, only their files are returned
+        pipeline.add(partial(save_message, dest_folder=dest_folder, save_mask=True, packed=packed, keep_arrays=False))
@@ -0,0 +1,124 @@
+"""Lookup table chroma key for uint8 images.
+
+The mask of color_based_filter only depends on the distance of a pixel to the
+green value. For uint8 images, the squared distance is the sum of one squared
+difference per channel, each of which has only 256 possible values:
+
+    distance² = T_b[b] + T_g[g] + T_r[r]
+
+Thus, the chroma key is computed with three small tables applied by a single
+cv2.LUT pass, a sum of the channels and a gather from a ramp table, which
+maps the squared distance to the mask value. Unlike a quantised 3D table of
+the BGR triples, this is exact up to rounding the squared distance to an
+integer. The tables are built once per green value and thresholds and are
+cached per process.
+
+Run this module to compare it with the floating point path:
+    python -m ImageBot.image_processing.chroma_key
+
+Todo:
+    - Add license boilerplate
+"""
+
+import time
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+from ImageBot.Config import GREEN_MIN_THRESHOLD, GREEN_MAX_THRESHOLD, GREEN_SPILL_COLOR
+
+# Number of cached tables per process
+CACHED_TABLES = 16
+
+def chroma_key(image : np.ndarray, green, min_threshold, max_threshold, dtype=np.uint8) -> np.ndarray:
+    """Mask of the pixels which are not green, see color_based_filter.
+
+    Args:
+        image (np.ndarray): uint8 BGR image
+        green (Tuple[float]): BGR value of the greenscreen from 0 to 255
+        min_threshold (float): Distance to the green value, relative to full intensity, up to which a pixel is masked out completely
+        max_threshold (float): Distance to the green value, relative to full intensity, from which a pixel is kept completely
+        dtype (np.dtype, optional): np.uint8 for values from 0 to 255 or np.float32 for values from 0.0 to 1.0. Defaults to np.uint8.
+
+    Returns:
+        np.ndarray: The two dimensional mask
+    """
+    assert image.dtype == np.uint8 and image.ndim == 3 and image.shape[2] == 3
+    channels, ramp = chroma_key_tables(tuple(float(g) for g in green), float(min_threshold), float(max_threshold), np.dtype(dtype).str)
+    squared = cv2.LUT(image, channels)
+    squared = cv2.transform(squared, np.ones((1, 3), np.float32))
+    # Round to the nearest entry of the ramp, truncating would bias the mask towards the green
+    return ramp[np.rint(squared, out=squared).astype(np.int32)]
+
+@lru_cache(maxsize=CACHED_TABLES)
+def chroma_key_tables(green, min_threshold, max_threshold, dtype):
+    """Build the tables of chroma_key.
+
+    Args:
+        green (Tuple[float]): BGR value of the greenscreen from 0 to 255
+        min_threshold (float): See chroma_key
+        max_threshold (float): See chroma_key
+        dtype (str): Numpy type string of the mask
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The squared differences per channel as 256x1x3 float32 table and
+            the mask value for every integer squared distance
+    """
+    assert len(green) == 3 and max_threshold > min_threshold
+    values = np.arange(256, dtype=np.float64)
+    channels = np.stack([(values - g)**2 for g in green], axis=1).astype(np.float32).reshape(256, 1, 3)
+    # Every channel reaches its largest squared difference at its own value, thus the largest
+    # squared distance is the sum of the maxima of the channels
+    distance = np.sqrt(np.arange(int(np.ceil(channels.max(axis=0).sum())) + 2, dtype=np.float64)) / 255.0
+    ramp = np.clip((distance - min_threshold) / (max_threshold - min_threshold), 0.0, 1.0)
+    if np.dtype(dtype) == np.uint8:
+        ramp = np.uint8(np.rint(ramp*255.0))
+    else:
+        ramp = ramp.astype(dtype)
+    return channels, ramp
+
+def benchmark(image=None, green=GREEN_SPILL_COLOR, min_threshold=GREEN_MIN_THRESHOLD, max_threshold=GREEN_MAX_THRESHOLD, repetitions=10) -> dict:
+    """Compare the lookup table chroma key with the float64 path of color_based_filter.
+
+    Args:
+        image (np.ndarray|None, optional): uint8 BGR image. Defaults to None, which uses a random 1280x800 frame.
+        green (Tuple[int], optional): BGR value of the greenscreen. Defaults to GREEN_SPILL_COLOR.
+        min_threshold (float, optional): See chroma_key. Defaults to GREEN_MIN_THRESHOLD.
+        max_threshold (float, optional): See chroma_key. Defaults to GREEN_MAX_THRESHOLD.
+        repetitions (int, optional): Number of runs to average the time over. Defaults to 10.
+
+    Returns:
+        dict: Milliseconds per frame of the float64 path and the lookup table with uint8 and float32 masks,
+            the first call of the lookup table including building the tables and the maximum difference of the masks
+    """
+    # Imported here, because greenscreen uses this module
+    from ImageBot.image_processing.greenscreen import color_based_filter
+    if image is None:
+        image = np.random.default_rng(0).integers(0, 256, (800, 1280, 3), dtype=np.uint8)
+
+    def milliseconds(f):
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            result = f()
+        return (time.perf_counter() - start) / repetitions * 1000.0, result
+
+    chroma_key_tables.cache_clear()
+    start = time.perf_counter()
+    chroma_key(image, green, min_threshold, max_threshold)
+    first = (time.perf_counter() - start) * 1000.0
+    reference_ms, reference = milliseconds(lambda: color_based_filter(image / 255.0, np.array(green) / 255.0, min_threshold, max_threshold))
+    uint8_ms, mask = milliseconds(lambda: chroma_key(image, green, min_threshold, max_threshold))
+    float32_ms, mask32 = milliseconds(lambda: chroma_key(image, green, min_threshold, max_threshold, np.float32))
+    return {
+        'float64_ms': reference_ms,
+        'lut_uint8_ms': uint8_ms,
+        'lut_float32_ms': float32_ms,
+        'lut_first_call_ms': first,
+        'max_difference_uint8': float(np.abs(mask / 255.0 - reference).max()),
+        'max_difference_float32': float(np.abs(mask32 - reference).max()),
+    }
+
+if __name__ == '__main__':
+    for name, value in benchmark().items():
+        print('%-24s %10.4f' % (name, value))
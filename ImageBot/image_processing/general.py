@@ -8,6 +8,7 @@ import numpy as np
 import cv2
 from collections.abc import Iterable
 from ImageBot.image_processing.masks import mask_bounding_box
+from ImageBot.infrastructure.dtypes import policy_dtype, scale_of
     
 def crop_to_mask(image, mask):
     """Crop image to mask.
@@ -33,18 +34,19 @@ def create_color_matt(size, color):
         color ([type]): Image color.
 
     Returns:
-        np.ndarray: Image of single color.
+        np.ndarray: Image of single color, see IMAGE_DTYPE.
     """
-    # Norm the color to float
-    color = [x/255.0 for x in color]
+    # Norm the color to the value range of the image
+    dtype = policy_dtype()
+    color = [x/255.0*scale_of(dtype) for x in color]
     
     # Create a blank black image
-    image = np.zeros((size[0], size[1], 3), np.float64)
+    image = np.zeros((size[0], size[1], 3), dtype)
     # Set the color
     image[:] = color
     return image
 
-def expand_canvas(image, directions, color=None):
+def expand_canvas(image, directions, color=None, out=None):
     """Expand canvas in given directions and fill with given color.
 
     Expands the image in the given directions.
@@ -57,6 +59,8 @@ def expand_canvas(image, directions, color=None):
         image (np.ndarray): Image to expand.
         directions ([int|Tuple[Tuple[int]]]): Directions to expand. Can either be a single value or tuple of tuples of values like ((x_left, x_right), (y_up, y_down)).
         color (Tuple[int]|float, optional): Color to set created pixels to. Can either be an RGB tuple, single value or None. Defaults to None.
+        out (np.ndarray, optional): Array of the expanded shape and the data type of the image to write the result to, e.g. from a BufferPool.
+            Defaults to None, which allocates a new one.
 
     Returns:
         np.ndarray: Image with expanded canvas.
@@ -73,13 +77,14 @@ def expand_canvas(image, directions, color=None):
         else:
             color = [0 for _ in range(color_dim)]
     
-    # Now check the set or generated color dimension
+    # Now check the set or generated color dimension and norm it to the value range of the image
+    scale = scale_of(image)/255.0
     if color_dim > 0:
         assert isinstance(color, Iterable) and (len(color) == color_dim)
-        color = np.array([c/255.0 for c in color])
+        color = np.array([c*scale for c in color])
     else:
         assert not isinstance(color, Iterable)
-        color = color/255.0
+        color = color*scale
         
     # If directions is a single number, we expand in all four directions, if it
     # is an array, it is given for each side
@@ -96,7 +101,12 @@ def expand_canvas(image, directions, color=None):
         new_shape = [image.shape[0] + directions[0][0] + directions[0][1], image.shape[1] + directions[1][0] + directions[1][1], color_dim]
     else:
         new_shape = [image.shape[0] + directions[0][0] + directions[0][1], image.shape[1] + directions[1][0] + directions[1][1]]
-    result = np.full(new_shape, color)
+    if out is None:
+        result = np.full(new_shape, color, dtype=image.dtype)
+    else:
+        assert out.shape == tuple(new_shape) and out.dtype == image.dtype
+        result = out
+        result[...] = color
     # Insert the old image at the correct position
     result[directions[0][0]: image.shape[0]+directions[0][0],  directions[1][0]:image.shape[1]+directions[1][0]] = image
     
@@ -12,6 +12,8 @@ from ImageBot.Config import *
 from ImageBot.image_processing.masks import clean_mask_surrounding, enlarge_mask,\
     tigthen_mask
 from ImageBot.infrastructure.filter import *
+from ImageBot.infrastructure.dtypes import as_uint8, as_unit, policy_dtype, scale_of, to_policy
+from ImageBot.image_processing.chroma_key import chroma_key
 
 import cv2
 import numpy as np
@@ -23,16 +25,20 @@ def color_based_filter(image, green, min_threshold, max_threshold):
 
     Args:
         image (np.ndarray): Image to apply filter on.
-        green (Tuple[int]): RGB value to filter for.
-        min_threshold (float): Lower threshold.
-        max_threshold (float): Upper threshold.
+        green (Tuple[int]): RGB value to filter for, in the value range of the image.
+        min_threshold (float): Lower threshold, relative to full intensity.
+        max_threshold (float): Upper threshold, relative to full intensity.
 
     Returns:
-        np.ndarray: Filtered image.
+        np.ndarray: Filtered image as floating point values from 0.0 to 1.0.
     """
     # Check the image param
     assert isinstance(image, np.ndarray)
     assert image.shape[2] == 3
+    
+    if image.dtype == np.uint8:
+        # The mask only depends on the BGR triple, use the lookup tables
+        return chroma_key(image, green, min_threshold, max_threshold, np.float32)
 
     #print("Image min:", np.min(image))
     #print ("Image max:",np.max(image))
@@ -40,8 +46,9 @@ def color_based_filter(image, green, min_threshold, max_threshold):
     # Check the green param and convert it to an array
     assert isinstance(green, Iterable)
     assert len(green) == 3
-    # Norm the green color
-    green = np.array(green)
+    # Norm the image and the green color
+    green = np.array(green) / scale_of(image)
+    image = as_unit(image)
     #print("Green Value:", green)
     
     # Numpy channels are sorted in BGR,substract the green channel
@@ -77,6 +84,7 @@ def green_spill_mask(image, green, min_angle_threshold, max_angle_threshold, min
     assert len(green) == 3
     
     green = np.array(green)/255.0
+    image = as_unit(image)
     
     # Calculate the cosine angle between each image pixel and the green value
     angle_image = np.dot(image, green)/np.linalg.norm(image, axis=2)/np.linalg.norm(green)
@@ -110,21 +118,22 @@ def remove_green_spill(image, mask, reduction=0.75):
         reduction (float, optional): Reduction factor. Defaults to 0.75.
 
     Returns:
-        np.ndarray: Image with removed green spill.
+        np.ndarray: Image with removed green spill, see IMAGE_DTYPE.
     """
     # We are working with inverse color, thus we only apply half of the color, to
     # return from green to a neutral grey
-    mask = mask*0.5*reduction
+    mask = as_unit(mask)*0.5*reduction
     
     # Now invert the colors of the image
-    bw_image = cv2.cvtColor(np.uint8(image*255), cv2.COLOR_BGR2HSV)
+    image = as_uint8(image)
+    bw_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
     bw_image[:,:,0] = (bw_image[:,:,0] + 90) % 180
     bw_image = cv2.cvtColor(bw_image, cv2.COLOR_HSV2BGR)
     
     mask = cv2.merge((mask, mask, mask))
-    bw_image = ((1.0-mask)*np.uint8(image*255) + mask*bw_image)/255
+    bw_image = ((1.0-mask)*image + mask*bw_image)/255
     
-    return bw_image
+    return to_policy(bw_image)
 
 def pick_color(img, pos, average_radius=1):
     """Extract color from position in image.
@@ -135,7 +144,7 @@ def pick_color(img, pos, average_radius=1):
         average_radius (int, optional): Smoothing radius. Defaults to 1.
 
     Returns:
-        Tuple[int]: Picked color.
+        Tuple[int]: Picked color in the value range of the image.
     """
     assert average_radius%2 == 1
     assert len(img.shape) == 3
@@ -146,7 +155,91 @@ def pick_color(img, pos, average_radius=1):
     x, y = pos
     color = np.average(img[y-r:y+r+1, x-r:x+r+1], axis=(0,1))
     return color
-    
+
+def border_pixels(img, width):
+    """Extract the pixels of the image border.
+
+    Args:
+        img (np.ndarray): Image to extract the border from.
+        width (float): Width of the border, relative to the shorter side of the image.
+
+    Returns:
+        np.ndarray: The border pixels as Nx1x3 array.
+    """
+    assert len(img.shape) == 3
+    w = max(1, int(round(min(img.shape[:2]) * width)))
+    sides = (img[:w], img[-w:], img[w:-w, :w], img[w:-w, -w:])
+    return np.concatenate([side.reshape(-1, 1, img.shape[2]) for side in sides])
+
+def estimate_green(img, border=GREEN_ESTIMATION_BORDER, hue_range=GREEN_ESTIMATION_HUE_RANGE, min_saturation=GREEN_ESTIMATION_MIN_SATURATION,
+                   min_threshold=GREEN_MIN_THRESHOLD, max_threshold=GREEN_MAX_THRESHOLD):
+    """Estimate the color of the greenscreen from the image border.
+
+    The object is placed in the center, thus the border mostly shows the greenscreen. The most frequent
+    hue of the saturated border pixels is taken as hue of the greenscreen and the median of the pixels
+    with this hue as its color. The confidence is the share of the border, which is removed with the
+    estimated color by color_based_filter. It is low, if the border is not uniform, e.g. because the
+    object reaches into it or the greenscreen does not fill the image.
+
+    Args:
+        img (np.ndarray): Image to estimate the greenscreen color of.
+        border (float, optional): Width of the border, relative to the shorter side. Defaults to GREEN_ESTIMATION_BORDER.
+        hue_range (int, optional): Maximum hue difference of the greenscreen pixels to the most frequent hue. Defaults to GREEN_ESTIMATION_HUE_RANGE.
+        min_saturation (int, optional): Minimum saturation of the greenscreen pixels. Defaults to GREEN_ESTIMATION_MIN_SATURATION.
+        min_threshold (float, optional): Lower threshold of color_based_filter. Defaults to GREEN_MIN_THRESHOLD.
+        max_threshold (float, optional): Upper threshold of color_based_filter. Defaults to GREEN_MAX_THRESHOLD.
+
+    Returns:
+        Tuple[np.ndarray, float]: Estimated color in the value range of the image and the confidence from 0.0 to 1.0.
+    """
+    assert len(img.shape) == 3 and img.shape[2] == 3
+    scale = scale_of(img)
+    pixels = border_pixels(as_uint8(img), border)
+    hsv = cv2.cvtColor(pixels, cv2.COLOR_BGR2HSV).reshape(-1, 3)
+    pixels = pixels.reshape(-1, 3)
+
+    saturated = hsv[:, 1] >= min_saturation
+    if not saturated.any():
+        # Gray border, there is no greenscreen to estimate
+        return np.median(pixels, axis=0) * scale / 255.0, 0.0
+
+    # The hue is circular, count the pixels within the hue range around every hue
+    histogram = np.bincount(hsv[saturated, 0], minlength=180)
+    histogram = np.concatenate((histogram[-hue_range:], histogram, histogram[:hue_range])) if hue_range > 0 else histogram
+    peak = np.argmax(np.convolve(histogram, np.ones(2*hue_range + 1), 'valid'))
+    difference = np.abs(hsv[:, 0].astype(np.int32) - peak)
+    screen = saturated & (np.minimum(difference, 180 - difference) <= hue_range)
+    green = np.median(pixels[screen], axis=0)
+
+    removed = 1.0 - chroma_key(pixels.reshape(-1, 1, 3), green, min_threshold, max_threshold, np.float32)
+    return green * scale / 255.0, float(removed.mean())
+
+def mask_quality(img, green, min_threshold=GREEN_MIN_THRESHOLD, max_threshold=GREEN_MAX_THRESHOLD, border=GREEN_ESTIMATION_BORDER,
+                 margin=MASK_QUALITY_MARGIN):
+    """Rate the mask color_based_filter creates with the given green value.
+
+    A good green value removes the border, where the greenscreen is, and separates the object
+    clearly from the greenscreen, i.e. only the object edges are neither kept nor removed. The
+    quality is the share of the border which is removed, multiplied with the share of pixels
+    which are kept or removed clearly.
+
+    Args:
+        img (np.ndarray): Image to create the mask of.
+        green (Tuple[int]): RGB value of the greenscreen, in the value range of the image.
+        min_threshold (float, optional): Lower threshold of color_based_filter. Defaults to GREEN_MIN_THRESHOLD.
+        max_threshold (float, optional): Upper threshold of color_based_filter. Defaults to GREEN_MAX_THRESHOLD.
+        border (float, optional): Width of the border, relative to the shorter side. Defaults to GREEN_ESTIMATION_BORDER.
+        margin (float, optional): Mask values up to this share of full intensity from 0.0 or 1.0 count as clear. Defaults to MASK_QUALITY_MARGIN.
+
+    Returns:
+        float: The quality from 0.0 to 1.0.
+    """
+    assert len(img.shape) == 3 and img.shape[2] == 3
+    mask = chroma_key(as_uint8(img), np.array(green) * 255.0 / scale_of(img), min_threshold, max_threshold)
+    removed = 1.0 - border_pixels(mask[:, :, np.newaxis], border).mean() / 255.0
+    clear = np.count_nonzero((mask <= margin*255) | (mask >= (1.0 - margin)*255)) / mask.size
+    return float(removed * clear)
+
 def w_color_based_filer(message : ImageMessage) -> ImageMessage:
     """Filter definition of color_based_filter.
 
@@ -156,7 +249,11 @@ def w_color_based_filer(message : ImageMessage) -> ImageMessage:
     Returns:
         ImageMessage: Filtered image.
     """
-    message.mask = color_based_filter(message.image, message.green, GREEN_MIN_THRESHOLD, GREEN_MAX_THRESHOLD)
+    if message.image.dtype == np.uint8 and policy_dtype() in (np.uint8, np.float32):
+        # Compute the mask in its final data type
+        message.mask = chroma_key(message.image, message.green, GREEN_MIN_THRESHOLD, GREEN_MAX_THRESHOLD, policy_dtype())
+    else:
+        message.mask = to_policy(color_based_filter(message.image, message.green, GREEN_MIN_THRESHOLD, GREEN_MAX_THRESHOLD))
     return message
 
 def w_clean_mask_surrouding(message : ImageMessage) -> ImageMessage:
@@ -196,7 +293,7 @@ def w_enlarge_mask(message : ImageMessage) -> ImageMessage:
     return message
 
 
-# Currently unused but maybe interessting for the future
+# Currently unused but maybe interessting for the future, see estimate_green
 
 def histo_green(img, colorrange , low_saturation, valuerange):
     """Histogram filter for background removal.
@@ -8,6 +8,8 @@ import numpy as np
 from scipy.interpolate import splprep, splev
 from scipy.ndimage.filters import maximum_filter
 
+from ImageBot.infrastructure.dtypes import as_uint8, as_unit, scale_of, to_policy
+
 def mask_to_alpha(image, mask):
     assert image.shape[0] == mask.shape[0]
     assert image.shape[1] == mask.shape[1]
@@ -21,20 +23,21 @@ def combine_images(background, foreground, mask):
     assert background.shape[1] == foreground.shape[1] == mask.shape[1]
     assert background.shape[2] == foreground.shape[2] == 3
     
-    # We must make the mask times three to work with the 3 channels of the original images
-    mask = cv2.merge((mask, mask, mask))
+    # Blend in values from 0.0 to 1.0, the arrays might be of different policies
+    # The mask is broadcast over the 3 channels of the original images
+    mask = as_unit(mask)[:, :, np.newaxis]
     
     # Multiply the images to get the overlay
-    foreground = cv2.multiply(mask, foreground)
-    background = cv2.multiply(1.0-mask, background)
+    foreground = mask * as_unit(foreground)
+    background = (1.0-mask) * as_unit(background)
     
     # Add the overlays to each other
-    return cv2.add(foreground, background)
+    return to_policy(foreground + background)
 
 
 def detect_edges(mask, distance_smoothing):
     tmpMask = cv2.merge((mask, mask, mask))
-    tmpMask = np.uint8(tmpMask*255)
+    tmpMask = as_uint8(tmpMask)
     tmpMask = cv2.cvtColor(tmpMask, cv2.COLOR_BGR2GRAY)
     
     kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (distance_smoothing, distance_smoothing))
@@ -144,7 +147,8 @@ def smoothen_contours(mask, distance_smoothing):
     return result
 
 def mask_bounding_box(mask, epsilon=0.01):
-    non_zeros = np.argwhere(mask.flatten() > epsilon)[:,0]
+    # Epsilon is relative to full intensity
+    non_zeros = np.argwhere(mask.flatten() > epsilon*scale_of(mask))[:,0]
     if len(non_zeros) == 0:
         # Somehow there is no mask there
         print("Nothing to mask")
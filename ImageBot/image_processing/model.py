@@ -17,6 +17,7 @@ from imgaug.augmentables.heatmaps import HeatmapsOnImage
 from ImageBot.infrastructure.ImageMessage import ImageMessage
 import uuid
 from ImageBot.image_processing.masks import mask_bounding_box
+from ImageBot.infrastructure.dtypes import as_uint8, as_unit, to_policy
 
 def w_crop_to_mask(message):
     # We do not use crop to mask here, because it is slower calling it two times
@@ -42,7 +43,7 @@ def w_expand_for_max_affine(message):
 def w_model_augement(messages):
     # Convert the image to uint8
     for message in messages:
-        message.image = np.uint8(message.image*255.0)
+        message.image = as_uint8(message.image)
     
     # Leave at least each of one image as it is
     identity_messages = list(messages)
@@ -54,9 +55,9 @@ def w_model_augement(messages):
     origins = []
     greens = []
     for message in messages:
-        new_heatmaps.extend([HeatmapsOnImage(np.float32(message.mask), shape=message.image.shape, min_value=0.0, max_value=1.0) for _ in range(MODEL_MULTIPLY_MESSAGE_IMAGE_AUGMENTATION-1)])
+        new_heatmaps.extend([HeatmapsOnImage(as_unit(message.mask, np.float32), shape=message.image.shape, min_value=0.0, max_value=1.0) for _ in range(MODEL_MULTIPLY_MESSAGE_IMAGE_AUGMENTATION-1)])
         new_images.extend([message.image for _ in range(MODEL_MULTIPLY_MESSAGE_IMAGE_AUGMENTATION-1)])
-        #origins.extend([message.origin for _ in range(MODEL_MULTIPLY_MESSAGE_IMAGE_AUGMENTATION-1)])
+        origins.extend([message.origin for _ in range(MODEL_MULTIPLY_MESSAGE_IMAGE_AUGMENTATION-1)])
         greens.extend([message.green for _ in range(MODEL_MULTIPLY_MESSAGE_IMAGE_AUGMENTATION-1)])
     
     seq = iaa.Sequential([
@@ -72,9 +73,9 @@ def w_model_augement(messages):
     images, heatmaps = seq(images=new_images, heatmaps=new_heatmaps)
     
     # Convert it back to the original file format that we use
-    result = [ImageMessage(uuid.uuid4(), image/255.0, np.float64(heatmaps[i].get_arr()), greens[i].copy()) for i, image in enumerate(images)]
+    result = [ImageMessage(uuid.uuid4(), to_policy(image), to_policy(heatmaps[i].get_arr()), greens[i].copy(), origin=origins[i]) for i, image in enumerate(images)]
     for im in identity_messages:
-        im.image = im.image/255.0
+        im.image = to_policy(im.image)
     result.extend(identity_messages)
     
     return result
@@ -83,7 +84,7 @@ def w_augment_mask(messages):
     # TODO: Keep one untouched
     # Convert the image to uint8
     for message in messages:
-        message.mask = np.uint8(message.mask*255.0)
+        message.mask = as_uint8(message.mask)
     
     # Leave at least each of one image as it is
     identity_messages = list(messages)
@@ -95,7 +96,7 @@ def w_augment_mask(messages):
     images = []
     for message in messages:
         new_masks.extend([message.mask for _ in range(MODEL_MULTIPLY_MESSAGE_MASK_AUGMENTATION-1)])
-        #origins.extend([message.origin for _ in range(MODEL_MULTIPLY_MESSAGE_MASK_AUGMENTATION-1)])
+        origins.extend([message.origin for _ in range(MODEL_MULTIPLY_MESSAGE_MASK_AUGMENTATION-1)])
         images.extend([message.image for _ in range(MODEL_MULTIPLY_MESSAGE_MASK_AUGMENTATION-1)])
         greens.extend([message.green for _ in range(MODEL_MULTIPLY_MESSAGE_MASK_AUGMENTATION-1)])
     
@@ -109,10 +110,10 @@ def w_augment_mask(messages):
     masks = seq_mask(images=new_masks)
     
     # Convert it back and merge it with the identity messages
-    result = [ImageMessage(uuid.uuid4(), images[i].copy(), mask/255.0, greens[i].copy()) for i, mask in enumerate(masks)]
+    result = [ImageMessage(uuid.uuid4(), images[i].copy(), to_policy(mask), greens[i].copy(), origin=origins[i]) for i, mask in enumerate(masks)]
     for im in identity_messages:
         # Convert back to correct dimensions 
-        im.mask = np.float64(im.mask)/255.0
+        im.mask = to_policy(im.mask)
         # Add it to the result
         result.append(im)
     
@@ -0,0 +1,139 @@
+"""Pool of reusable numpy arrays for temporary results of filters.
+
+Filters which need temporary arrays of the same shape for every message
+(e.g. a canvas of the background size) borrow them from the pool of their
+process with take and return them with give, as soon as they are not used
+anymore. Thus, the arrays are allocated once per worker instead of once per
+message, which avoids the allocator churn and page faults of large arrays.
+
+Only arrays which do not leave the filter must be returned; arrays which are
+passed on in a message are still used after the filter returned.
+
+The pool keeps at most max_bytes. If it is full, the arrays of the least
+recently returned shape are dropped first, so that rarely used shapes do not
+displace the frequent ones.
+
+Todo:
+    - Add license boilerplate
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from ImageBot.Config import BUFFER_POOL_MAX_BYTES
+
+class BufferPool(object):
+    """Arrays grouped by shape and data type, which can be borrowed and returned."""
+
+    def __init__(self, max_bytes=BUFFER_POOL_MAX_BYTES):
+        """Constructor.
+
+        Args:
+            max_bytes (int, optional): Maximum number of bytes of all pooled arrays. Defaults to BUFFER_POOL_MAX_BYTES.
+        """
+        assert max_bytes >= 0
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # (shape, dtype) -> returned arrays, the least recently returned shape first
+        self._free = OrderedDict()
+        self._bytes = 0
+        self._takes = 0
+        self._hits = 0
+        self._bytes_saved = 0
+
+    def take(self, shape, dtype) -> np.ndarray:
+        """Borrow an array. Its content is undefined.
+
+        Args:
+            shape (Tuple[int]): Shape of the array
+            dtype (np.dtype): Data type of the array
+
+        Returns:
+            np.ndarray: A returned array of the shape and data type or a new one
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            self._takes += 1
+            arrays = self._free.get(key)
+            if arrays:
+                array = arrays.pop()
+                if not arrays:
+                    del self._free[key]
+                self._bytes -= array.nbytes
+                self._hits += 1
+                self._bytes_saved += array.nbytes
+                return array
+        return np.empty(key[0], key[1])
+
+    def give(self, *arrays):
+        """Return borrowed arrays, which must not be used anymore afterwards.
+
+        Args:
+            arrays (np.ndarray): The arrays, views and arrays larger than max_bytes are dropped
+        """
+        with self._lock:
+            for array in arrays:
+                if array.base is not None or not array.flags.c_contiguous or array.nbytes > self.max_bytes:
+                    continue
+                key = (array.shape, array.dtype.str)
+                self._free.setdefault(key, []).append(array)
+                self._free.move_to_end(key)
+                self._bytes += array.nbytes
+            while self._bytes > self.max_bytes:
+                key, pooled = next(iter(self._free.items()))
+                self._bytes -= pooled.pop(0).nbytes
+                if not pooled:
+                    del self._free[key]
+
+    def stats(self) -> dict:
+        """Report how often the pool could hand out a returned array.
+
+        Returns:
+            dict: Takes, hits, hit rate, bytes not allocated thanks to the pool and bytes pooled right now
+        """
+        with self._lock:
+            return {
+                'takes': self._takes,
+                'hits': self._hits,
+                'hit_rate': self._hits / self._takes if self._takes > 0 else 0.0,
+                'bytes_saved': self._bytes_saved,
+                'pooled_bytes': self._bytes,
+            }
+
+    def report(self) -> str:
+        """Format the statistics as one line.
+
+        Returns:
+            str: The report
+        """
+        s = self.stats()
+        return '%i takes, %.0f%% hits, %.1f MB saved, %.1f MB pooled' % (
+            s['takes'], 100*s['hit_rate'], s['bytes_saved'] / 2**20, s['pooled_bytes'] / 2**20)
+
+# The pool of this process
+_default = None
+_default_lock = threading.Lock()
+
+def default_pool() -> BufferPool:
+    """Returns the pool of this process and creates it, if necessary.
+
+    Returns:
+        BufferPool: The pool
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = BufferPool()
+        return _default
+
+def _reset_default_pool():
+    """Drops the pool inherited by a forked process, every worker has its own."""
+    global _default, _default_lock
+    _default = None
+    _default_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_default_pool)
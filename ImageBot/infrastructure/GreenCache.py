@@ -0,0 +1,164 @@
+"""Green values of the acquisition runs of an image folder.
+
+All images of one run of the DataAquistionSequence (run<i>-<height>mm.png) are
+taken in front of the same greenscreen with the same lighting. Thus, the green
+value only needs to be picked or estimated once per run. The cache stores it
+together with the mask quality it achieved in the image it was picked in (see
+mask_quality) in a JSON file next to the image folder (e.g. 0_raw_greens.json
+next to 0_raw). The green values are stored from 0 to 255.
+
+The run numbers start at 0 for every acquisition, thus a new acquisition into
+the same folder reuses the names of the runs. The cache also stores the path,
+modification time and size of the image the green value was picked in. If that
+image changed or is gone, the entry is outdated (see current).
+
+Example:
+    greens = GreenCache(raw_folder)
+    for run, paths in group_by_run(raw_folder.iterdir()).items():
+        if run is not None and not greens.current(run):
+            greens.set(run, pick_green(paths[0]), quality, paths[0])
+    greens.save()
+
+Todo:
+    - Add license boilerplate
+"""
+
+import json
+import os
+import re
+import threading
+from pathlib import Path
+
+GREEN_CACHE_VERSION = 1
+
+# Name of the images of an acquisition run, see DataAquistionSequence
+RUN_PATTERN = re.compile(r'run(\d+)-')
+
+def run_of(path) -> str:
+    """Acquisition run of an image file.
+
+    Args:
+        path (Path|str|None): The image file
+
+    Returns:
+        str|None: The run, e.g. 'run3', or None, if the file is not named like an image of a run
+    """
+    if path is None:
+        return None
+    match = RUN_PATTERN.match(Path(path).name)
+    return 'run' + match.group(1) if match else None
+
+def group_by_run(paths) -> dict:
+    """Group image files by their acquisition run.
+
+    Args:
+        paths (Iterable[Path]): The image files
+
+    Returns:
+        Dict[str|None, List[Path]]: The files of every run in the given order. Files without run are grouped under None.
+    """
+    runs = {}
+    for path in paths:
+        runs.setdefault(run_of(path), []).append(path)
+    return runs
+
+class GreenCache(object):
+    """Green values of the runs of an image folder, see the module description."""
+
+    def __init__(self, source_folder : Path):
+        """Constructor, loads the cache of the folder, if it exists.
+
+        Args:
+            source_folder (Path): The image folder
+        """
+        self.source_folder = Path(source_folder)
+        self.path = self.source_folder.with_name(self.source_folder.name + '_greens.json')
+        self._lock = threading.Lock()
+        self._runs = {}
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            assert data.get('version') == GREEN_CACHE_VERSION, "Unknown green cache version in '%s'" % self.path
+            self._runs = data['runs']
+
+    def __len__(self):
+        return len(self._runs)
+
+    def __contains__(self, run):
+        return run in self._runs
+
+    def get(self, run) -> dict:
+        """Green value of a run.
+
+        Args:
+            run (str|None): The run, see run_of
+
+        Returns:
+            dict|None: The 'green' value from 0 to 255, the mask 'quality' achieved with it and the 'source' image
+                it was picked in, None if the run is not cached
+        """
+        with self._lock:
+            entry = self._runs.get(run)
+            return dict(entry) if entry is not None else None
+
+    def current(self, run) -> bool:
+        """Whether the green value of a run is cached and the image it was picked in is unchanged.
+
+        Args:
+            run (str|None): The run, see run_of
+
+        Returns:
+            bool: False, if the run is not cached or the entry is outdated
+        """
+        entry = self.get(run)
+        if entry is None or entry.get('source') is None:
+            return False
+        source = entry['source']
+        try:
+            stat = os.stat(source['path'])
+        except FileNotFoundError:
+            return False
+        return source['mtime_ns'] == stat.st_mtime_ns and source['size'] == stat.st_size
+
+    def set(self, run, green, quality, source : Path):
+        """Store the green value of a run.
+
+        Args:
+            run (str): The run, see run_of
+            green (Tuple[float]): BGR value from 0 to 255
+            quality (float): Mask quality achieved with the green value, see mask_quality
+            source (Path): The image the green value was picked in
+        """
+        assert run is not None and len(green) == 3
+        stat = os.stat(source)
+        with self._lock:
+            self._runs[run] = {'green': [float(g) for g in green], 'quality': float(quality),
+                               'source': {'path': os.path.abspath(source), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}}
+
+    def remove(self, run):
+        """Remove the green value of a run, so that it is picked again.
+
+        Args:
+            run (str): The run, see run_of
+        """
+        with self._lock:
+            self._runs.pop(run, None)
+
+    def runs(self) -> dict:
+        """All cached runs, e.g. to hand them to the workers of a pipeline.
+
+        Returns:
+            Dict[str, dict]: The entries of the runs, see get
+        """
+        with self._lock:
+            return {run: dict(entry) for run, entry in self._runs.items()}
+
+    def save(self):
+        """Write the cache next to the image folder."""
+        with self._lock:
+            data = json.dumps({'version': GREEN_CACHE_VERSION, 'runs': self._runs}, indent=1)
+        temporary = self.path.with_name(self.path.name + '.tmp')
+        with open(temporary, 'w') as f:
+            f.write(data)
+        # An interrupted save keeps the previous cache
+        os.replace(temporary, self.path)
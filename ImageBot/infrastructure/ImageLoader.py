@@ -0,0 +1,175 @@
+"""Prefetching parallel image loader.
+
+Decodes image files and, if set, their masks in a thread pool ahead of the
+consumer. OpenCV releases the GIL while decoding, thus the files are decoded
+in parallel and overlap with the processing of the previous images. The
+number of images decoded ahead is bounded, which keeps the memory bounded as
+well.
+
+Example:
+    loader = ImageLoader(Loader, load_mask=True)
+    for results in pipeline.map(loader):
+        ...
+    print(loader.report())
+
+Todo:
+    - Add license boilerplate
+"""
+
+import threading
+import time
+from collections import deque
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from queue import Empty, Queue
+
+from ImageBot.Config import LOADER_WORKERS, LOADER_READ_AHEAD
+
+from .ImageMessage import ImageMessage
+from .filter import load_path
+
+class ImageLoader(object):
+    """Iterable of ImageMessages decoded by a thread pool.
+
+    Every iteration loads all paths of the source once. The statistics add up over all iterations.
+    """
+
+    def __init__(self, source, load_mask=False, workers=LOADER_WORKERS, read_ahead=LOADER_READ_AHEAD, extension='png', mask_suffix='_mask',
+                 max_size=None, prepare=None):
+        """Constructor.
+
+        Args:
+            source (Iterable[Path]|Queue[Path]): Paths of the images. A queue is drained while iterating.
+            load_mask (bool, optional): Load the mask with the same name and the given suffix, too. Defaults to False.
+            workers (int, optional): Number of decoding threads. Defaults to LOADER_WORKERS.
+            read_ahead (int, optional): Maximum number of images decoded ahead of the consumer. Defaults to LOADER_READ_AHEAD.
+            extension (str, optional): Extension of the mask files. Defaults to 'png'.
+            mask_suffix (str, optional): Suffix of the mask files. Defaults to '_mask'.
+            max_size (int|None, optional): Shrink larger images to this length of the longer side, see load_image. Defaults to None.
+            prepare (Callable|None, optional): Called with every loaded message in the decoding threads, e.g. to precompute
+                data the consumer needs. Defaults to None.
+        """
+        assert isinstance(source, (Iterable, Queue))
+        assert workers > 0 and read_ahead > 0
+        self._source = source
+        self._load_mask = load_mask
+        self._workers = workers
+        self._read_ahead = read_ahead
+        self._extension = extension
+        self._mask_suffix = mask_suffix
+        self._max_size = max_size
+        self._prepare = prepare
+
+        # The statistics
+        self._lock = threading.Lock()
+        self._images = 0
+        self._bytes = 0
+        self._decode_seconds = 0.0
+        self._wait_seconds = 0.0
+        self._elapsed = 0.0
+
+    def __iter__(self):
+        """Decode the images of the source ahead and return them in order.
+
+        Raises:
+            IOError: If an image cannot be read
+
+        Yields:
+            ImageMessage: Message with the decoded image and, if set, mask
+        """
+        executor = ThreadPoolExecutor(self._workers)
+        pending = deque()
+        start = time.perf_counter()
+        try:
+            for path in self._paths():
+                pending.append(executor.submit(self._decode, path))
+                if len(pending) >= self._read_ahead:
+                    yield self._next(pending)
+            while pending:
+                yield self._next(pending)
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+            with self._lock:
+                self._elapsed += time.perf_counter() - start
+
+    def feed(self, pipeline, clbck=None):
+        """Execute the pipeline on all loaded images.
+
+        Args:
+            pipeline (Pipeline): The pipeline
+            clbck (Callable|None, optional): See Pipeline.execute. Defaults to None.
+        """
+        for message in self:
+            pipeline.execute(message, clbck=clbck)
+
+    def throughput(self) -> dict:
+        """Report how fast the images are decoded.
+
+        If the consumer spends a large share of the time waiting for the next image (wait_fraction),
+        the pipeline is bound by reading and decoding the images. Then, more workers might help,
+        if the storage is not saturated yet.
+
+        Returns:
+            dict: Decoded images and bytes, images and MB per second, mean decode time per image,
+                seconds the consumer waited for images and the waited share of the elapsed time
+        """
+        with self._lock:
+            images, nbytes, decode, wait, elapsed = self._images, self._bytes, self._decode_seconds, self._wait_seconds, self._elapsed
+        return {
+            'images': images,
+            'bytes': nbytes,
+            'images_per_second': images / elapsed if elapsed > 0 else 0.0,
+            'mb_per_second': nbytes / 2**20 / elapsed if elapsed > 0 else 0.0,
+            'decode_seconds_per_image': decode / images if images > 0 else 0.0,
+            'wait_seconds': wait,
+            'wait_fraction': wait / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def report(self) -> str:
+        """Format the throughput as one line.
+
+        Returns:
+            str: The report
+        """
+        t = self.throughput()
+        return '%i images, %.1f images/s, %.1f MB/s, %.1f ms decode/image, waited %.2f s (%.0f%%)' % (
+            t['images'], t['images_per_second'], t['mb_per_second'], 1000*t['decode_seconds_per_image'],
+            t['wait_seconds'], 100*t['wait_fraction'])
+
+    def _paths(self):
+        """Generator returning the paths of the source."""
+        if isinstance(self._source, Queue):
+            while True:
+                try:
+                    yield self._source.get_nowait()
+                except Empty:
+                    return
+        else:
+            yield from self._source
+
+    def _next(self, pending) -> ImageMessage:
+        """Waits for the oldest pending image and returns it."""
+        start = time.perf_counter()
+        message = pending.popleft().result()
+        with self._lock:
+            self._wait_seconds += time.perf_counter() - start
+        return message
+
+    def _decode(self, path) -> ImageMessage:
+        """Thread function loading the image and mask of the given path."""
+        start = time.perf_counter()
+        message = load_path(Path(path), self._load_mask, self._extension, self._mask_suffix, self._max_size)
+        nbytes = message.image.nbytes
+        if self._load_mask:
+            nbytes += message.mask.nbytes
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self._images += 1
+            self._bytes += nbytes
+            self._decode_seconds += seconds
+        if self._prepare is not None:
+            self._prepare(message)
+        return message
@@ -17,30 +17,198 @@ import os
 import cv2
 import numpy as np
 
+from .dtypes import to_policy
+
+# The reduced resolution decode modes of OpenCV by imread flags and reduction factor, largest factor first
+REDUCED_FLAGS = {
+    cv2.IMREAD_COLOR: {8: cv2.IMREAD_REDUCED_COLOR_8, 4: cv2.IMREAD_REDUCED_COLOR_4, 2: cv2.IMREAD_REDUCED_COLOR_2},
+    cv2.IMREAD_GRAYSCALE: {8: cv2.IMREAD_REDUCED_GRAYSCALE_8, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2},
+}
+
+# The first bytes of every PNG file
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+class ImageFile(object):
+    """Reference to an image file, which is decoded lazily.
+
+    Assign it to the image or mask of an ImageMessage instead of the decoded array.
+    The file is decoded on first access of the attribute in the process accessing it.
+    Until then, only the path is copied when the message is handed to another process.
+
+    If a maximum size is given, larger images are shrunk to a longer side of max_size, thus
+    images and masks of the same size are shrunk alike. If the size can be read from the header
+    of the file, OpenCV decodes it at a reduced resolution first (IMREAD_REDUCED_*), which is
+    much faster for JPEG files and saves memory for all files.
+    """
+
+    __slots__ = ('path', 'flags', 'max_size')
+
+    def __init__(self, path, flags=cv2.IMREAD_COLOR, max_size=None):
+        """Constructor.
+
+        Args:
+            path (Path|str): Path of the image file
+            flags (int, optional): OpenCV imread flags. Defaults to cv2.IMREAD_COLOR.
+            max_size (int|None, optional): Longer side the image is needed with at most. Defaults to None, which decodes the full resolution.
+        """
+        self.path = str(path)
+        self.flags = flags
+        self.max_size = max_size
+
+    def decode(self) -> np.ndarray:
+        """Decode the image file.
+
+        Raises:
+            IOError: If the file cannot be read
+
+        Returns:
+            np.ndarray: The image, see IMAGE_DTYPE
+        """
+        image = cv2.imread(self.path, self._reduced_flags())
+        if image is None:
+            raise IOError("Cannot read image file '%s'" % self.path)
+        if self.max_size is not None:
+            # If the size was not known in advance, reduce it after decoding
+            image = fit_size(image, self.max_size)
+        return to_policy(image)
+
+    def _reduced_flags(self) -> int:
+        """Returns the imread flags with the largest reduction keeping the longer side at least max_size."""
+        if self.max_size is None or self.flags not in REDUCED_FLAGS:
+            return self.flags
+        size = image_size(self.path)
+        if size is None:
+            return self.flags
+        for factor, flags in REDUCED_FLAGS[self.flags].items():
+            if max(size) // factor >= self.max_size:
+                return flags
+        return self.flags
+
+    def __repr__(self):
+        return 'ImageFile(%r, %r, %r)' % (self.path, self.flags, self.max_size)
+
+def image_size(path):
+    """Width and height of a PNG or JPEG file read from its header without decoding it.
+
+    Args:
+        path (Path|str): Path of the file
+
+    Returns:
+        Tuple[int, int]|None: Width and height or None, if it is neither a PNG nor a JPEG file
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(24)
+            if header[:8] == PNG_SIGNATURE and header[12:16] == b'IHDR':
+                # The signature is followed by the IHDR chunk, which starts with the size
+                return int.from_bytes(header[16:20], 'big'), int.from_bytes(header[20:24], 'big')
+            if header[:2] == b'\xff\xd8':
+                f.seek(2)
+                return _jpeg_size(f)
+    except OSError:
+        pass
+    return None
+
+def _jpeg_size(f):
+    """Reads the size from the start of frame segment of a JPEG file positioned after the SOI marker."""
+    while True:
+        marker = f.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            return None
+        length = int.from_bytes(marker[2:4], 'big')
+        # SOF0 to SOF15 except DHT, JPG and DAC contain the size
+        if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            return int.from_bytes(frame[3:5], 'big'), int.from_bytes(frame[1:3], 'big')
+        f.seek(length - 2, 1)
+
+def fit_size(image : np.ndarray, max_size) -> np.ndarray:
+    """Shrink an image, whose longer side exceeds max_size, to exactly max_size keeping the aspect ratio.
+
+    Args:
+        image (np.ndarray): The image
+        max_size (int): Maximum length of the longer side
+
+    Returns:
+        np.ndarray: The image itself, if it is not larger, otherwise the shrunk copy
+    """
+    height, width = image.shape[:2]
+    if max(height, width) <= max_size:
+        return image
+    scale = max_size / max(height, width)
+    size = (max(1, int(round(width*scale))), max(1, int(round(height*scale))))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
 class ImageMessage(object):
     """Container to hold the images and metadata.
 
     Each ImageMessage holds a Numpy reference to the image to be transported.
     Optionally, it can store a mask, a green value tupel and other metadata inside a dict.
+    The image and mask arrays have the data type selected by IMAGE_DTYPE (see dtypes) and
+    the green value is given in the value range of the image.
+    The origin is the id of the message a filter derived this message from. It is kept
+    by all derived messages, so that results can be traced back to the executed message.
+
+    The image and the mask might be ImageFile references, which are decoded on first access.
+    Use stored to get them without decoding.
     """
 
+    __slots__ = ('id', 'origin', 'green', 'metadata', '_image', '_mask')
 
-    def __init__(self, messageId, image=None, mask=None, green=None, metadata=None):
+    def __init__(self, messageId, image=None, mask=None, green=None, metadata=None, origin=None):
         """Construct image message container.
 
         Args:
             messageId (uuid|int): Message identifier
-            image (np.ndarray, optional): Image to carry. Defaults to None.
-            mask ([type], optional): Mask to be applied on image. Defaults to None.
+            image (np.ndarray|ImageFile, optional): Image to carry. Defaults to None.
+            mask (np.ndarray|ImageFile, optional): Mask to be applied on image. Defaults to None.
             green ([type], optional): RGB-values picked by user. Defaults to None.
             metadata ([type], optional): Metadata to identify/classify carried image or supply additional information. Defaults to None.
+            origin (uuid|int, optional): Id of the message this message was derived from. Defaults to None, which uses messageId.
 
         TODO: move mask and green to metadata
         """
-        self.image = image
-        self.mask = mask
+        self._image = image
+        self._mask = mask
         self.green = green
         self.id = messageId
+        self.origin = messageId if origin is None else origin
         self.metadata = metadata or {}
         # if not provided, add a default name to metadata dict
         self.metadata['name'] = 'Image' if not 'name' in self.metadata.keys() else self.metadata['name']
+
+    @property
+    def image(self):
+        """np.ndarray: The image, decoded on first access if it references a file."""
+        if isinstance(self._image, ImageFile):
+            self._image = self._image.decode()
+        return self._image
+
+    @image.setter
+    def image(self, value):
+        self._image = value
+
+    @property
+    def mask(self):
+        """np.ndarray: The mask, decoded on first access if it references a file."""
+        if isinstance(self._mask, ImageFile):
+            self._mask = self._mask.decode()
+        return self._mask
+
+    @mask.setter
+    def mask(self, value):
+        self._mask = value
+
+    def stored(self, field):
+        """Returns the image or mask as stored, without decoding it.
+
+        Args:
+            field (str): 'image' or 'mask'
+
+        Returns:
+            np.ndarray|ImageFile|object|None: The stored value
+        """
+        assert field in ('image', 'mask')
+        return self._image if field == 'image' else self._mask
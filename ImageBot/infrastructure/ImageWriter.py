@@ -0,0 +1,178 @@
+"""Asynchronous image writer.
+
+Encodes and writes images in a background thread pool, so that encoding the
+PNG files overlaps with processing the next messages. The number of images
+waiting to be written is bounded; write blocks if it is reached.
+
+Every process has its own default writer (see default_writer). The worker
+processes of the pipelines flush it at the end of every task, so that errors
+of the background writes fail the task and reach its error callback in the
+main process. There, Pipeline.join flushes it and raises the errors.
+
+Todo:
+    - Add license boilerplate
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import util
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from ImageBot.Config import WRITER_WORKERS, WRITER_QUEUE_SIZE, WRITER_PNG_COMPRESSION, WRITER_FSYNC_BATCH
+
+class ImageWriter(object):
+    """Writes images in background threads."""
+
+    def __init__(self, workers=WRITER_WORKERS, queue_size=WRITER_QUEUE_SIZE, compression=WRITER_PNG_COMPRESSION, fsync_batch=WRITER_FSYNC_BATCH):
+        """Constructor.
+
+        Args:
+            workers (int, optional): Number of encoding threads. Defaults to WRITER_WORKERS.
+            queue_size (int, optional): Maximum number of images waiting to be written. Defaults to WRITER_QUEUE_SIZE.
+            compression (int, optional): PNG compression level from 0 (fastest) to 9 (smallest). Defaults to WRITER_PNG_COMPRESSION.
+            fsync_batch (int, optional): Sync the written files to the disk after every fsync_batch files and on flush.
+                Defaults to WRITER_FSYNC_BATCH, 0 leaves it to the operating system.
+        """
+        assert workers > 0 and queue_size > 0
+        assert 0 <= compression <= 9
+        assert fsync_batch >= 0
+        self._workers = workers
+        self._compression = compression
+        self._fsync_batch = fsync_batch
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._lock = threading.Lock()
+        self._pending = set()
+        # Pending futures whose errors are raised by a running flush instead of _written
+        self._claimed = set()
+        self._unsynced = []
+        self._errors = []
+        self.files = 0
+        self.bytes = 0
+
+    def write(self, path : Path, image : np.ndarray):
+        """Write the image to the given file in the background.
+
+        The image must not be changed afterwards. Errors are raised by the next flush.
+
+        Args:
+            path (Path): The file, its extension selects the format
+            image (np.ndarray): The image as uint8 array
+        """
+        self._slots.acquire()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self._workers)
+            future = self._executor.submit(self._write, Path(path), image)
+            self._pending.add(future)
+        future.add_done_callback(self._written)
+
+    def flush(self):
+        """Wait until all images are written and synced, if set.
+
+        Raises:
+            IOError: The first error which occurred while writing since the last flush
+        """
+        with self._lock:
+            pending = list(self._pending)
+            self._claimed.update(pending)
+            errors, self._errors = self._errors, []
+        # The waiters of a future are woken before its done callbacks run, thus the
+        # errors of the pending writes are taken from the futures themselves
+        for future in pending:
+            if future.exception() is not None:
+                errors.append(future.exception())
+        self._sync()
+        if errors:
+            raise errors[0]
+
+    def _write(self, path, image):
+        """Thread function encoding and writing an image."""
+        extension = path.suffix.lower()
+        params = [cv2.IMWRITE_PNG_COMPRESSION, self._compression] if extension == '.png' else []
+        success, data = cv2.imencode(extension, image, params)
+        if not success:
+            raise IOError("Cannot encode image file '%s'" % path)
+        with open(path, 'wb') as f:
+            f.write(data.tobytes())
+        with self._lock:
+            self.files += 1
+            self.bytes += data.nbytes
+            self._unsynced.append(path)
+            full = self._fsync_batch > 0 and len(self._unsynced) >= self._fsync_batch
+        if full:
+            self._sync()
+
+    def _written(self, future):
+        """Frees the slot of a written image and keeps its error for the next flush, if no flush waits for it."""
+        with self._lock:
+            self._pending.discard(future)
+            if future in self._claimed:
+                self._claimed.discard(future)
+            elif future.exception() is not None:
+                self._errors.append(future.exception())
+        self._slots.release()
+
+    def _sync(self):
+        """Sync the written files and their folders to the disk, if fsync batching is enabled."""
+        if self._fsync_batch == 0:
+            return
+        with self._lock:
+            paths, self._unsynced = self._unsynced, []
+        folders = set()
+        for path in paths:
+            _fsync(path)
+            folders.add(path.parent)
+        if os.name != 'nt':
+            # The new directory entries must be synced, too
+            for folder in folders:
+                _fsync(folder)
+
+def _fsync(path):
+    """Sync the file or folder to the disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# The default writer of this process
+_default = None
+_default_lock = threading.Lock()
+
+def default_writer() -> ImageWriter:
+    """Returns the default writer of this process and creates it, if necessary.
+
+    The writer is flushed when the process exits, too. Errors raised then are only printed.
+
+    Returns:
+        ImageWriter: The writer
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = ImageWriter()
+            util.Finalize(_default, _default.flush, exitpriority=10)
+        return _default
+
+def _reset_default_writer():
+    """Drops the default writer inherited by a forked process, because its threads do not exist there."""
+    global _default, _default_lock
+    _default = None
+    _default_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_default_writer)
+
+def flush_default_writer():
+    """Flush the default writer of this process, if it has been created.
+
+    Raises:
+        IOError: See ImageWriter.flush
+    """
+    if _default is not None:
+        _default.flush()
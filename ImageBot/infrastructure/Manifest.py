@@ -0,0 +1,142 @@
+"""Manifest of the inputs already processed into an output folder.
+
+The manifest is a JSON file next to the output folder (e.g. 1_masked.json
+next to 1_masked). For every processed input file, it records the
+modification time and size of the input and the output files it produced.
+Thus, a pipeline only needs to process the inputs which are new or changed
+since the last run, and the outputs of changed or deleted inputs can be
+removed.
+
+Example:
+    manifest = Manifest(dest_folder)
+    paths = manifest.pending(source_folder.iterdir())
+    for path, results in zip(paths, pipeline.map(paths, ordered=True, loader=load_path)):
+        manifest.record(path, results)
+    pipeline.join()
+    manifest.save()
+
+Todo:
+    - Add license boilerplate
+"""
+
+import json
+import os
+import threading
+from pathlib import Path
+
+MANIFEST_VERSION = 1
+
+class Manifest(object):
+    """Processed inputs of an output folder, see the module description."""
+
+    def __init__(self, dest_folder : Path):
+        """Constructor, loads the manifest of the folder, if it exists.
+
+        Args:
+            dest_folder (Path): The output folder
+        """
+        self.dest_folder = Path(dest_folder)
+        self.path = self.dest_folder.with_name(self.dest_folder.name + '.json')
+        self._lock = threading.Lock()
+        self._entries = {}
+        # The changed and deleted inputs found by the last call of pending
+        self.removed = []
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            assert data.get('version') == MANIFEST_VERSION, "Unknown manifest version in '%s'" % self.path
+            self._entries = data['entries']
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, source):
+        return _key(source) in self._entries
+
+    def pending(self, sources) -> list:
+        """Remove the outputs of changed and deleted inputs and return the inputs which need processing.
+
+        An input needs processing, if it is not in the manifest or its modification time or size changed.
+        Inputs which are in the manifest, but not in sources anymore, are deleted. The changed and deleted
+        inputs are kept in removed, e.g. to invalidate what was derived from them.
+
+        Args:
+            sources (Iterable[Path]): All current input files
+
+        Returns:
+            List[Path]: The new and changed input files in the given order
+        """
+        result = []
+        removed = []
+        current = set()
+        for source in sources:
+            key = _key(source)
+            current.add(key)
+            entry = self._entries.get(key)
+            if entry is None:
+                result.append(source)
+                continue
+            stat = os.stat(source)
+            if entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+                self.remove(source)
+                removed.append(Path(source))
+                result.append(source)
+        for key in [k for k in self._entries if k not in current]:
+            self.remove(key)
+            removed.append(Path(key))
+        self.removed = removed
+        return result
+
+    def record(self, source : Path, results):
+        """Record that an input has been processed.
+
+        Args:
+            source (Path): The input file
+            results (List[ImageMessage]): The results of the input. The files they have been saved to are
+                taken from the 'saved_files' metadata, see save_message.
+        """
+        stat = os.stat(source)
+        outputs = [os.path.abspath(f) for r in results for f in r.metadata.get('saved_files', ())]
+        with self._lock:
+            self._entries[_key(source)] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'outputs': outputs}
+
+    def outputs(self, source) -> list:
+        """The output files recorded for an input.
+
+        Args:
+            source (Path|str): The input file
+
+        Returns:
+            List[Path]: The output files
+        """
+        return [Path(f) for f in self._entries[_key(source)]['outputs']]
+
+    def remove(self, source):
+        """Delete the output files of an input and remove it from the manifest.
+
+        Args:
+            source (Path|str): The input file
+        """
+        with self._lock:
+            entry = self._entries.pop(_key(source), None)
+        if entry is None:
+            return
+        for f in entry['outputs']:
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+
+    def save(self):
+        """Write the manifest next to the output folder."""
+        with self._lock:
+            data = json.dumps({'version': MANIFEST_VERSION, 'entries': self._entries}, indent=1)
+        temporary = self.path.with_name(self.path.name + '.tmp')
+        with open(temporary, 'w') as f:
+            f.write(data)
+        # An interrupted save keeps the previous manifest
+        os.replace(temporary, self.path)
+
+def _key(source) -> str:
+    """Key of an input file in the manifest."""
+    return str(Path(source).resolve())
@@ -13,14 +13,35 @@ Todo:
     - Add license boilerplate
 """
 
+import asyncio
 import multiprocessing
+import threading
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import resource_tracker
 from functools import partial
 import traceback
+from collections import deque
 from collections.abc import Iterable
-from typing import Callable
+from itertools import islice
+from typing import Callable, Iterator
 
 from numpy import sin
 
+from . import transport
+from .ImageWriter import flush_default_writer
+from .PipelineStats import PipelineStats
+
+# The filters and options of the pipeline a pool worker belongs to. They are
+# installed once per worker process by Pipeline.init_worker, so that the tasks
+# only need to carry the message itself.
+_worker_filters = None
+_worker_options = None
+_worker_shared_memory = False
+_worker_instrument = False
+
+# The available execution backends, see Pipeline
+BACKENDS = ('inline', 'threads', 'processes')
+
 class Pipeline(object):
     """Class representing Pipeline.
 
@@ -29,27 +50,85 @@ class Pipeline(object):
     """
 
 
-    def __init__(self, with_multiprocessing=False, max_no_processes=8):
+    def __init__(self, with_multiprocessing=False, max_no_processes=8, streaming=False, micro_batch_size=4, shared_memory=None, max_in_flight=None,
+                 instrument=False, stats_file=None, backend=None, batch_size=None, batch_timeout=0.1):
         """Constructor.
 
         Args:
             with_multiprocessing (bool, optional): Enable multiprocessing. Defaults to False.
-            max_no_processes (int, optional): If enabled, create the passed amount of subprocesses. Defaults to 8.
+            max_no_processes (int, optional): If enabled, create the passed amount of subprocesses or threads. Defaults to 8.
+            streaming (bool, optional): Push every message depth-first through the remaining filters as soon
+                as it is produced instead of running each filter over all results of the previous one. Peak memory
+                then depends on the chain depth instead of the total fan-out. Defaults to False.
+            micro_batch_size (int, optional): In streaming mode, the maximum number of messages handed to
+                a batch processing filter at once. Defaults to 4.
+            shared_memory (bool|None, optional): Hand the image and mask arrays of the messages to the
+                subprocesses through shared memory instead of pickling them, see transport. Defaults to None,
+                which enables it together with multiprocessing.
+            max_in_flight (int|None, optional): Maximum number of executed messages, which are not finished yet.
+                If reached, execute blocks until one of them finished. This keeps the memory of the main process
+                bounded, independent of the number of messages. Defaults to None, which does not limit them.
+            instrument (bool, optional): Collect timing, fan-out and byte statistics for every filter,
+                see stats. Defaults to False.
+            stats_file (Path|None, optional): If instrumented, dump the statistics as JSON to this file when
+                joining the pipeline. Defaults to None.
+            backend (str|None, optional): How messages are executed: 'inline' in the calling thread, 'threads'
+                in a thread pool or 'processes' in a process pool. Threads avoid copying the messages between
+                processes and start faster, but only run in parallel while the filters release the GIL, e.g. in
+                OpenCV and scipy. Compare them on the target machine, see benchmark.compare_chains. Defaults to
+                None, which selects 'processes' if with_multiprocessing is set and 'inline' otherwise.
+            batch_size (int|None, optional): Collect single messages passed to execute and execute them together
+                as batch, as soon as batch_size messages are collected or batch_timeout passed. Thus, batch processing
+                filters get several messages at once, even if the messages are executed one by one. The results are
+                handed back to the callbacks of the messages they originate from, so every message must have an
+                origin attribute (see ImageMessage). Defaults to None, which executes every message on its own.
+            batch_timeout (float, optional): Maximum number of seconds the first message of a batch waits for
+                further messages. Defaults to 0.1.
         """
-        self._multiprocessing = with_multiprocessing
-        if with_multiprocessing:
-            self._pool = multiprocessing.Pool(max_no_processes)
+        assert micro_batch_size > 0
+        assert max_in_flight is None or max_in_flight > 0
+        assert batch_size is None or batch_size > 0
+        if backend is None:
+            backend = 'processes' if with_multiprocessing else 'inline'
+        assert backend in BACKENDS
+        self._backend = backend
+        self._multiprocessing = backend == 'processes'
+        self._max_no_processes = max_no_processes
+        # The pool is started with the first execution, because the workers get
+        # a copy of the filters when they are initialized
+        self._pool = None
+        self._executor = None
+        self._shared_memory = self._multiprocessing if shared_memory is None else shared_memory
 
         self._filters = []
+        self._streaming = streaming
+        self._micro_batch_size = micro_batch_size
+        self._in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self._stats = PipelineStats() if instrument else None
+        self._stats_file = stats_file
+
+        # The messages collected for the next batch as (message, clbck, error_clbck) tuples
+        self._batch_size = batch_size
+        self._batch_timeout = batch_timeout
+        self._batch = []
+        self._batch_lock = threading.Lock()
+        self._batch_timer = None
         
-    def add(self, filter : Callable, batch_processing=False):
+    def add(self, filter : Callable, batch_processing=False, cache=None, config=()):
         """Add filter to pipeline.
 
         Args:
             filter (Callable): A Callable object, taking a  message object or an Iterable of message objects as first input. Message objects are any python serializable objects which are passed between filters in the pipeline.
             batch_processing (bool, optional): Enable batch processing. The filter must support batch processing by taking an Iterable of message objects as argument. Defaults to False.
+            cache (StageCache|None, optional): Return the cached results, if the filter already processed the same message with the
+                same Config parameters, see StageCache. Only filters without batch processing can be cached. Defaults to None.
+            config (Iterable[str], optional): Names of the Config parameters the results of a cached filter depend on. Defaults to ().
         """
         assert callable(filter)
+        assert self._pool is None and self._executor is None, "Filters cannot be changed while the pipeline is running"
+        if cache is not None:
+            assert not batch_processing, "Only filters without batch processing can be cached"
+            filter = cache.wrap(filter, config)
         self._filters.append((filter, batch_processing))
 
     def insert(self, index, filter, batch_processing=False):
@@ -61,9 +140,10 @@ class Pipeline(object):
             batch_processing (bool, optional): Enable batch processing. The filter must support it. Defaults to False.
         """
         assert callable(filter)
+        assert self._pool is None and self._executor is None, "Filters cannot be changed while the pipeline is running"
         self._filters.insert(index, (filter, batch_processing))
         
-    def execute(self, message, clbck=None, batch_processing=False):
+    def execute(self, message, clbck=None, batch_processing=False, error_clbck=None):
         """Execute pipeline on passed message or list of messages.
         
         This function spans a new pipeline process and then returns as soon as the
@@ -71,7 +151,8 @@ class Pipeline(object):
         called when the process finishes.
         If the number of max processes for this pipeline is reached, the process is
         put aside and will be started as soon as one of the currently running processes
-        finished.
+        finished. If max_in_flight messages are already put aside, this function blocks
+        until the first of them finished.
 
         Args:
             message (object|List[object]): Message object or list to be piped
@@ -82,13 +163,36 @@ class Pipeline(object):
                 process. Furthermore the callback should not block for a time too long,
                 because this stops further pipelines from being started. Defaults to None.
             batch_processing (bool, optional): Enable batch processing. Defaults to False.
+            error_clbck (Callable|None, optional): The callback to be called with the exception, if the processing
+                of the message failed. Defaults to None, which prints the exception (see error_callback).
 
         Returns:
             None
         """
+        self._execute(message, clbck, batch_processing, error_clbck)
+
+    def _execute(self, message, clbck=None, batch_processing=False, error_clbck=None):
+        """Hands the message over to the backend, see execute.
+
+        The results only ever reach the callbacks, the returned handle is meant for cancelling.
+
+        Args:
+            message (object|List[object]): See execute
+            clbck (Callable|None, optional): See execute. Defaults to None.
+            batch_processing (bool, optional): See execute. Defaults to False.
+            error_clbck (Callable|None, optional): See execute. Defaults to None.
+
+        Returns:
+            concurrent.futures.Future|None: The future of the message for the thread backend, None otherwise
+        """
         # Check the clbck type
         if clbck is not None:
             assert callable(clbck)
+        if error_clbck is None:
+            error_clbck = Pipeline.error_callback
+        if self._batch_size and not batch_processing:
+            # The message is executed later together with others
+            return self._buffer(message, clbck, error_clbck)
             
         # If the batch processing is true, the message must be iterable
         if batch_processing:
@@ -96,19 +200,47 @@ class Pipeline(object):
         
         if self._multiprocessing:
             # We are doing multiprocessing
-            # First prepare the call function
-            fnc = partial(Pipeline.call_fnc, filters=self._filters, message=message, batch_processing=batch_processing)
-            # Hand it over
-            if clbck is None:
-                return self._pool.apply_async(Pipeline.call_fnc, (message, self._filters, batch_processing), error_callback=Pipeline.error_callback)
-            else:
-                return self._pool.apply_async(Pipeline.call_fnc, (message, self._filters ,batch_processing), callback=clbck, error_callback=Pipeline.error_callback)
+            pool = self._get_pool()
+            if self._in_flight is not None:
+                # Wait for a free slot, the slot is freed again as soon as the message finished
+                self._in_flight.acquire()
+            sent = message
+            try:
+                if self._shared_memory:
+                    # Only hand over the handles of the arrays, the results come back the same way
+                    sent = transport.export_messages(message, batch_processing)
+                # The workers already know the filters, thus only the message is handed over
+                pool.apply_async(Pipeline.worker_fnc, (sent, batch_processing),
+                                 callback=partial(self._finished, sent=sent, batch_processing=batch_processing, clbck=clbck),
+                                 error_callback=partial(self._failed, sent=sent, batch_processing=batch_processing, error_clbck=error_clbck))
+            except BaseException:
+                # The message did not reach the pool, thus no callback frees its slot and blocks
+                if sent is not message:
+                    transport.release_messages(sent, batch_processing)
+                if self._in_flight is not None:
+                    self._in_flight.release()
+                raise
+        elif self._backend == 'threads':
+            # The threads share the filters and messages with this thread, nothing is copied
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self._max_no_processes)
+            if self._in_flight is not None:
+                self._in_flight.acquire()
+            try:
+                future = self._executor.submit(self, message, batch_processing)
+            except BaseException:
+                if self._in_flight is not None:
+                    self._in_flight.release()
+                raise
+            future.add_done_callback(partial(self._thread_finished, clbck=clbck, error_clbck=error_clbck))
+            return future
         else:
             # We are not doing multiprocessing, call the function directly
             try:
                 result = self(message, batch_processing=batch_processing)
             except Exception as ex:
-                Pipeline.error_callback(ex)
+                error_clbck(ex)
+                return
 
             if clbck is not None:
                 clbck(result)
@@ -123,18 +255,553 @@ class Pipeline(object):
         Returns:
             ImageMessage|List[ImageMessage]: See execute.
         """
-        return Pipeline.call_fnc(message, self._filters, batch_processing=batch_processing)
-        
+        return Pipeline.call_fnc(message, self._filters, batch_processing=batch_processing,
+                                 streaming=self._streaming, micro_batch_size=self._micro_batch_size, stats=self._stats)
+
     def join(self):
         """Joins all started subprocesses for the pipeline.
+
+        Images still being written in the background are finished, too (see ImageWriter).
         
         Returns:
             None: Returns as soon as all subprocesses of the pipelined finished.
         """
-        if self._multiprocessing:
+        self.flush()
+        if self._pool is not None:
             self._pool.close()
             self._pool.join()
+            self._pool = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        flush_default_writer()
+        if self._stats is not None and self._stats_file is not None:
+            self._stats.dump(self._stats_file)
+
+    def flush(self):
+        """Execute the messages collected for the next batch right away, see batch_size."""
+        with self._batch_lock:
+            batch = self._take_batch()
+        self._dispatch_batch(batch)
+
+    def _buffer(self, message, clbck, error_clbck):
+        """Adds a message to the next batch and executes the batch, if it is full.
+
+        Args:
+            message (object): The message passed to execute
+            clbck (Callable|None): The callback passed to execute
+            error_clbck (Callable): The error callback passed to execute
+        """
+        assert getattr(message, 'origin', None) is not None, "Batched messages need an origin"
+        ready = []
+        with self._batch_lock:
+            if any(m.origin == message.origin for m, _, _ in self._batch):
+                # The results of both could not be told apart, thus execute the collected ones first
+                ready.append(self._take_batch())
+            self._batch.append((message, clbck, error_clbck))
+            if len(self._batch) >= self._batch_size:
+                ready.append(self._take_batch())
+            elif self._batch_timer is None:
+                self._batch_timer = threading.Timer(self._batch_timeout, self._batch_expired)
+                self._batch_timer.daemon = True
+                self._batch_timer.start()
+        for batch in ready:
+            self._dispatch_batch(batch)
+
+    def _take_batch(self):
+        """Removes and returns the collected messages. The batch lock must be held."""
+        batch, self._batch = self._batch, []
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        return batch
+
+    def _batch_expired(self):
+        """Timer function executing the batch, which waited for batch_timeout."""
+        with self._batch_lock:
+            # The batch might have been executed and a new one started meanwhile
+            if self._batch_timer is not threading.current_thread():
+                return
+            batch = self._take_batch()
+        self._dispatch_batch(batch)
+
+    def map(self, iterable, ordered=False, chunksize=1, loader=None, batch_processing=False) -> Iterator:
+        """Execute the pipeline on all items of the iterable and iterate over the results.
+
+        The items are handed to the workers in chunks of chunksize items, which saves one round
+        trip per item. Only a bounded number of chunks is pending at the same time and the iterable
+        is only advanced if one of them finished. If a loader is given, every item is converted to a
+        message by calling the loader in the worker, e.g. map(paths, loader=load_path) decodes the
+        images in the workers instead of the calling process. If batch_size is set, every chunk is
+        executed as one batch (see batch_size). The messages and results of map do not count for
+        max_in_flight.
+
+        Args:
+            iterable (Iterable): The messages or, if a loader is given, the items to load them from
+            ordered (bool, optional): Yield the results in the order of the iterable instead of as soon as they finish. Defaults to False.
+            chunksize (int, optional): Number of items handed to a worker at once. Defaults to 1.
+            loader (Callable|None, optional): Picklable function returning the message for an item. Defaults to None, which uses the items as messages.
+            batch_processing (bool, optional): Whether every message is a list of messages, see execute. Defaults to False.
+
+        Raises:
+            Exception: The exception raised by a filter or the loader. The remaining results are dropped.
+
+        Yields:
+            List[object]: The results of the pipeline for one item
+        """
+        assert chunksize > 0
+        if loader is not None:
+            assert callable(loader)
+        grouped = bool(self._batch_size) and not batch_processing
+        chunks = Pipeline._chunks(iterable, chunksize)
+        if self._backend == 'inline':
+            for chunk in chunks:
+                yield from Pipeline.map_fnc(chunk, self._filters, loader, batch_processing, grouped, self._options(), self._stats)
+            return
+
+        # Keep every worker busy with a second chunk waiting for it
+        window = 2 * self._max_no_processes
+        pending = deque() if ordered else set()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < window:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    future = self._submit_chunk(chunk, loader, batch_processing, grouped)
+                    if ordered:
+                        pending.append(future)
+                    else:
+                        pending.add(future)
+                if not pending:
+                    break
+
+                if ordered:
+                    yield from pending.popleft().result()
+                else:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _options(self):
+        """Returns the keyword arguments passed on to call_fnc."""
+        return {'streaming': self._streaming, 'micro_batch_size': self._micro_batch_size}
+
+    def _chunks(iterable, chunksize):
+        """Generator returning lists of chunksize consecutive items of the iterable, the last one might be shorter."""
+        iterator = iter(iterable)
+        while True:
+            chunk = list(islice(iterator, chunksize))
+            if not chunk:
+                return
+            yield chunk
+
+    def _submit_chunk(self, chunk, loader, batch_processing, grouped) -> Future:
+        """Hands a chunk of map to the thread or process pool.
+
+        Args:
+            chunk (List[object]): The items
+            loader (Callable|None): See map
+            batch_processing (bool): See map
+            grouped (bool): Execute the chunk as one batch, see map_fnc
+
+        Returns:
+            Future: Future of the list of results per item
+        """
+        if self._multiprocessing:
+            future = Future()
+            pool = self._get_pool()
+            sent = []
+            try:
+                if self._shared_memory and loader is None:
+                    # Only hand over the handles of the arrays of the messages, as execute does
+                    for item in chunk:
+                        sent.append(transport.export_messages(item, batch_processing))
+                    chunk = sent
+                pool.apply_async(Pipeline.map_worker_fnc, (chunk, loader, batch_processing, grouped),
+                                 callback=partial(self._chunk_finished, future=future, sent=sent, batch_processing=batch_processing),
+                                 error_callback=partial(self._chunk_failed, future=future, sent=sent, batch_processing=batch_processing))
+            except BaseException:
+                # The chunk did not reach the pool, thus no callback destroys its blocks
+                for item in sent:
+                    transport.release_messages(item, batch_processing)
+                raise
+            return future
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self._max_no_processes)
+        return self._executor.submit(Pipeline.map_fnc, chunk, self._filters, loader, batch_processing, grouped,
+                                     self._options(), self._stats)
+
+    def _chunk_finished(self, result, future, sent, batch_processing):
+        """Handles the results of a chunk finished by a worker, see map_worker_fnc."""
+        results, stats = result
+        if stats is not None:
+            self._stats.merge(stats)
+        if self._shared_memory:
+            for item in sent:
+                transport.release_messages(item, batch_processing)
+            # Copy the results out of shared memory right away, even if nobody waits for them anymore
+            results = [transport.receive_messages(r, True) for r in results]
+        Pipeline._resolve(future, results)
+
+    def _chunk_failed(self, e, future, sent, batch_processing):
+        """Handles a chunk which failed in a worker, see map_worker_fnc."""
+        if self._shared_memory:
+            for item in sent:
+                transport.release_messages(item, batch_processing)
+        Pipeline._resolve(future, e, exception=True)
+
+    def _resolve(future, value, exception=False):
+        """Sets the result or exception of a future, which might have been cancelled meanwhile."""
+        try:
+            if exception:
+                future.set_exception(value)
+            else:
+                future.set_result(value)
+        except InvalidStateError:
+            pass
+
+    def _dispatch_batch(self, batch):
+        """Executes the collected messages as one batch.
+
+        Args:
+            batch (List[Tuple[object, Callable|None, Callable]]): The messages and their callbacks
+        """
+        if batch:
+            self.execute([m for m, _, _ in batch], clbck=partial(Pipeline.scatter, batch=batch), batch_processing=True,
+                         error_clbck=partial(Pipeline.scatter_error, batch=batch))
+
+    def scatter(results, batch):
+        """Hands the results of a batch to the callbacks of the messages they originate from.
+
+        Args:
+            results (List[object]): The results of the batch
+            batch (List[Tuple[object, Callable|None, Callable]]): The messages of the batch and their callbacks
+        """
+        per_message, lost = Pipeline.split_by_origin([m for m, _, _ in batch], results)
+        for (_, clbck, _), result in zip(batch, per_message):
+            if clbck is not None:
+                clbck(result)
+        if lost:
+            Pipeline.error_callback(ValueError("%i results of a batch do not originate from any of its messages" % lost))
+
+    def split_by_origin(messages, results):
+        """Assigns the results of a batch to the messages they originate from.
+
+        Args:
+            messages (List[object]): The messages of the batch, each with a different origin
+            results (List[object]): The results of the batch
+
+        Returns:
+            Tuple[List[List[object]], int]: The results per message and the number of results without matching origin
+        """
+        per_origin = {m.origin: [] for m in messages}
+        lost = 0
+        for r in results:
+            origin = getattr(r, 'origin', None)
+            if origin in per_origin:
+                per_origin[origin].append(r)
+            else:
+                lost += 1
+        return [per_origin[m.origin] for m in messages], lost
+
+    def scatter_error(e, batch):
+        """Hands the exception of a failed batch to the error callbacks of all its messages.
+
+        Args:
+            e (object): See error_callback
+            batch (List[Tuple[object, Callable|None, Callable]]): The messages of the batch and their callbacks
+        """
+        for _, _, error_clbck in batch:
+            error_clbck(e)
+
+    def stats(self) -> PipelineStats:
+        """Statistics of the filters of this pipeline, collected from all processes.
+
+        Print the returned object to get a report with one line per filter.
+
+        Returns:
+            PipelineStats: The statistics
+        """
+        assert self._stats is not None, "The pipeline is not instrumented"
+        return self._stats
+
+    def _finished(self, result, sent, batch_processing, clbck):
+        """Handles the result of a message finished by a worker.
+
+        Args:
+            result (Tuple[List[object], dict|None]): Return value of worker_fnc
+            sent (object|List[object]): The message(s) handed to the worker
+            batch_processing (bool): See execute
+            clbck (Callable|None): The callback passed to execute
+        """
+        result, stats = result
+        if stats is not None:
+            self._stats.merge(stats)
+        if self._shared_memory:
+            transport.release_messages(sent, batch_processing)
+            result = transport.receive_messages(result, True)
+        if self._in_flight is not None:
+            self._in_flight.release()
+        if clbck is not None:
+            clbck(result)
+
+    def _failed(self, e, sent, batch_processing, error_clbck):
+        """Handles a message which failed in a worker.
+
+        Args:
+            e (object): See error_callback
+            sent (object|List[object]): The message(s) handed to the worker
+            batch_processing (bool): See execute
+            error_clbck (Callable): The error callback passed to execute
+        """
+        if self._shared_memory:
+            transport.release_messages(sent, batch_processing)
+        if self._in_flight is not None:
+            self._in_flight.release()
+        error_clbck(e)
+
+    def _thread_finished(self, future, clbck, error_clbck):
+        """Handles a message finished or cancelled in the thread pool.
+
+        Args:
+            future (concurrent.futures.Future): The future of the message
+            clbck (Callable|None): The callback passed to execute
+            error_clbck (Callable): The error callback passed to execute
+        """
+        if self._in_flight is not None:
+            self._in_flight.release()
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            error_clbck(future.exception())
+        elif clbck is not None:
+            clbck(future.result())
+
+    async def submit(self, message, batch_processing=False):
+        """Execute the pipeline on the passed message(s) and wait for the result without blocking the event loop.
+
+        Works with every backend. Handing the message over, which might block (see execute and
+        max_in_flight), happens in the default executor of the event loop. If the waiting coroutine
+        is cancelled, messages which were not started yet are cancelled for the thread backend; the
+        results of all others are dropped.
+
+        Args:
+            message (object|List[object]): See execute
+            batch_processing (bool, optional): See execute. Defaults to False.
+
+        Raises:
+            Exception: The exception raised by a filter
+
+        Returns:
+            List[object]: The results of the pipeline for the message(s)
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(result):
+            if not future.done():
+                future.set_result(result)
+
+        def reject(e):
+            if not future.done():
+                future.set_exception(e)
+
+        handle = await loop.run_in_executor(None, partial(self._execute, message, batch_processing=batch_processing,
+                                                          clbck=lambda r: loop.call_soon_threadsafe(resolve, r),
+                                                          error_clbck=lambda e: loop.call_soon_threadsafe(reject, e)))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if handle is not None:
+                handle.cancel()
+            raise
+
+    async def stream(self, source, max_concurrency=8, ordered=False, batch_processing=False):
+        """Execute the pipeline on all messages of the source and yield the results as they finish.
+
+        At most max_concurrency messages are submitted at the same time, the source is only
+        advanced if there is a free slot. If the iteration is stopped early or fails, the
+        remaining submitted messages are cancelled (see submit).
+
+        Args:
+            source (Iterable|AsyncIterable): The messages. Synchronous iterables are advanced in the default
+                executor of the event loop, so that e.g. decoding images in a generator does not block the loop.
+            max_concurrency (int, optional): Maximum number of submitted messages, which did not finish yet. Defaults to 8.
+            ordered (bool, optional): Yield the results in the order of the source instead of as soon as they finish. Defaults to False.
+            batch_processing (bool, optional): Whether every item of the source is a list of messages, see execute. Defaults to False.
+
+        Yields:
+            List[object]: The results of the pipeline for one item of the source
+        """
+        assert max_concurrency > 0
+        loop = asyncio.get_running_loop()
+        if hasattr(source, '__aiter__'):
+            iterator = source.__aiter__()
+            next_item = iterator.__anext__
+        else:
+            iterator = iter(source)
+            end = object()
+
+            async def next_item():
+                item = await loop.run_in_executor(None, next, iterator, end)
+                if item is end:
+                    raise StopAsyncIteration
+                return item
+
+        pending = deque() if ordered else set()
+        exhausted = False
+        try:
+            while True:
+                # Fill up the free slots
+                while not exhausted and len(pending) < max_concurrency:
+                    try:
+                        message = await next_item()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    task = asyncio.ensure_future(self.submit(message, batch_processing))
+                    if ordered:
+                        pending.append(task)
+                    else:
+                        pending.add(task)
+                if not pending:
+                    break
+
+                if ordered:
+                    yield await pending[0]
+                    pending.popleft()
+                else:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _get_pool(self):
+        """Returns the process pool of this pipeline and starts it, if necessary.
+
+        Every worker of the pool receives the filters of this pipeline exactly once
+        through the pool initializer, see init_worker.
+
+        Returns:
+            multiprocessing.Pool: The running process pool
+        """
+        if self._pool is None:
+            if self._shared_memory:
+                # The workers must share the resource tracker of this process, otherwise
+                # they would destroy the shared memory blocks they created when exiting
+                resource_tracker.ensure_running()
+            self._pool = multiprocessing.Pool(self._max_no_processes, initializer=Pipeline.init_worker,
+                                              initargs=(self._filters, self._options(), self._shared_memory, self._stats is not None))
+        return self._pool
+
+    def init_worker(filters, options, shared_memory=False, instrument=False):
+        """Installs the filters of a pipeline in the current worker process.
+
+        Args:
+            filters (List[Tuple[Callable, bool]]): The filters of the pipeline
+            options (dict): Keyword arguments passed on to call_fnc for every task
+            shared_memory (bool, optional): Whether the messages are transported through shared memory. Defaults to False.
+            instrument (bool, optional): Whether to collect statistics for every task. Defaults to False.
+        """
+        global _worker_filters, _worker_options, _worker_shared_memory, _worker_instrument
+        _worker_filters = filters
+        _worker_options = options
+        _worker_shared_memory = shared_memory
+        _worker_instrument = instrument
+
+    def worker_fnc(message, batch_processing=False):
+        """Runs the filters installed by init_worker on the given message.
+
+        Args:
+            message (object|List[object]): See execute
+            batch_processing (bool, optional): See execute. Defaults to False.
+
+        Returns:
+            Tuple[List[object], dict|None]: The results (see execute) and, if instrumented, the statistics of this task
+        """
+        assert _worker_filters is not None, "Worker has not been initialized by Pipeline.init_worker"
+        stats = PipelineStats(_worker_filters) if _worker_instrument else None
+        if not _worker_shared_memory:
+            result = Pipeline.call_fnc(message, _worker_filters, batch_processing=batch_processing, stats=stats, **_worker_options)
+            # Errors of the background writes fail the task, see ImageWriter
+            flush_default_writer()
+            return result, (stats.to_dict() if stats is not None else None)
+
+        # Map the arrays of the message without copying them
+        handles = transport.import_messages(message, batch_processing)
+        try:
+            result = Pipeline.call_fnc(message, _worker_filters, batch_processing=batch_processing, stats=stats, **_worker_options)
+            flush_default_writer()
+            if transport.PERSISTENT_SEGMENTS:
+                # The main process takes over the blocks of the results
+                result = transport.export_messages(result, True, detach=True)
+            return result, (stats.to_dict() if stats is not None else None)
+        finally:
+            for handle in handles:
+                transport.release(handle)
     
+    def map_worker_fnc(items, loader, batch_processing, grouped):
+        """Runs the filters installed by init_worker on a chunk of map.
+
+        Args:
+            items (List[object]): The items of the chunk
+            loader (Callable|None): See map
+            batch_processing (bool): See map
+            grouped (bool): See map_fnc
+
+        Returns:
+            Tuple[List[List[object]], dict|None]: The results per item and, if instrumented, the statistics of this task
+        """
+        assert _worker_filters is not None, "Worker has not been initialized by Pipeline.init_worker"
+        stats = PipelineStats(_worker_filters) if _worker_instrument else None
+        handles = []
+        if _worker_shared_memory and loader is None:
+            # Map the arrays of the messages without copying them
+            for item in items:
+                handles += transport.import_messages(item, batch_processing)
+        try:
+            results = Pipeline.map_fnc(items, _worker_filters, loader, batch_processing, grouped, _worker_options, stats)
+            # Errors of the background writes fail the task, see ImageWriter
+            flush_default_writer()
+            if _worker_shared_memory and transport.PERSISTENT_SEGMENTS:
+                results = [transport.export_messages(r, True, detach=True) for r in results]
+            return results, (stats.to_dict() if stats is not None else None)
+        finally:
+            for handle in handles:
+                transport.release(handle)
+
+    def map_fnc(items, filters, loader, batch_processing, grouped, options, stats=None):
+        """Loads and processes a chunk of map.
+
+        Args:
+            items (List[object]): The items of the chunk
+            filters (List[Tuple[Callable, bool]]): The filters of the pipeline
+            loader (Callable|None): See map
+            batch_processing (bool): See map
+            grouped (bool): Process all messages as one batch and assign the results by their origin
+            options (dict): Keyword arguments passed on to call_fnc
+            stats (PipelineStats|None, optional): Statistics to record the filter calls in. Defaults to None.
+
+        Returns:
+            List[List[object]]: The results per item
+        """
+        messages = [loader(item) for item in items] if loader is not None else items
+        if not grouped:
+            return [Pipeline.call_fnc(m, filters, batch_processing=batch_processing, stats=stats, **options) for m in messages]
+        results = Pipeline.call_fnc(messages, filters, batch_processing=True, stats=stats, **options)
+        per_message, lost = Pipeline.split_by_origin(messages, results)
+        if lost:
+            raise ValueError("%i results of a batch do not originate from any of its messages" % lost)
+        return per_message
+
     def error_callback(e):
         """Prints error and exceptions which might occure within the pipeline.
         
@@ -147,7 +814,7 @@ class Pipeline(object):
         print("An exception occurred in the pipeline:")
         traceback.print_exception(type(e), e, e.__traceback__)
         
-    def call_fnc(message, filters, batch_processing=False):
+    def call_fnc(message, filters, batch_processing=False, streaming=False, micro_batch_size=4, stats=None):
         """Handles the calling of provided filters.
 
         A filter is a function, which takes a certain message, processes it and
@@ -159,10 +826,16 @@ class Pipeline(object):
             message (object): See execute
             filters (List[Callable]): List of filters, which will be executed in order
             batch_processing (bool, optional): See execute. Defaults to False.
+            streaming (bool, optional): Process the messages depth-first, see stream_fnc. Defaults to False.
+            micro_batch_size (int, optional): See stream_fnc. Defaults to 4.
+            stats (PipelineStats|None, optional): Statistics to record the filter calls in. Defaults to None.
 
         Returns:
             object|List[object]: See execute
         """
+        if streaming:
+            return list(Pipeline.stream_fnc(message, filters, batch_processing, micro_batch_size, stats))
+
         # Setup the start message(s)
         prev_results = None
         if batch_processing:
@@ -171,7 +844,7 @@ class Pipeline(object):
             prev_results = [message]
    
         # Now start processing
-        for fb in filters:
+        for i, fb in enumerate(filters):
             # The callable is stored as the first value in the tuple
             f = fb[0]
             new_results = []
@@ -180,7 +853,7 @@ class Pipeline(object):
                 # The filter is not capable of batch processing all previous results
                 # at once
                 for pr in prev_results:
-                    single_new_result = f(pr)
+                    single_new_result = Pipeline._call_filter(i, f, pr, False, stats)
                     # Collect the single or multiple results of this filter
                     if isinstance(single_new_result, list):
                         new_results.extend(single_new_result)
@@ -191,14 +864,94 @@ class Pipeline(object):
                         new_results.append(single_new_result)
             else:
                 # The filter can do batch processing
-                new_results = f(prev_results)
+                new_results = Pipeline._call_filter(i, f, prev_results, True, stats)
             # After processing all messages from the previous filter, the collected
             # results are now the results from the previous filter
             prev_results = new_results
         
         # Done with all filters, return
         return prev_results
-        
-        
-        
-        
\ No newline at end of file
+
+    def stream_fnc(message, filters, batch_processing=False, micro_batch_size=4, stats=None) -> Iterator:
+        """Lazily pushes the message(s) depth-first through the provided filters.
+
+        Every stage of the returned generator chain pulls a single message from
+        the previous stage, processes it and hands its results on before the
+        next message is pulled. Batch processing filters get micro-batches of at
+        most micro_batch_size messages. Thus, only the messages on the current
+        path through the chain are alive at the same time, independent of how
+        many messages the filters produce in total.
+
+        Args:
+            message (object|List[object]): See execute
+            filters (List[Callable]): List of filters, which will be executed in order
+            batch_processing (bool, optional): See execute. Defaults to False.
+            micro_batch_size (int, optional): Maximum number of messages handed to a batch processing
+                filter at once. Defaults to 4.
+            stats (PipelineStats|None, optional): Statistics to record the filter calls in. Defaults to None.
+
+        Returns:
+            Iterator[object]: Generator yielding the results of the last filter
+        """
+        stream = iter(message) if batch_processing else iter([message])
+        for i, (f, f_batch_processing) in enumerate(filters):
+            stream = Pipeline._stream_filter(stream, i, f, f_batch_processing, micro_batch_size, stats)
+        return stream
+
+    def _stream_filter(messages, index, f, batch_processing, micro_batch_size, stats):
+        """Generator applying a single filter to a stream of messages.
+
+        Args:
+            messages (Iterator[object]): Messages from the previous filter
+            index (int): Index of the filter in the pipeline
+            f (Callable): The filter to apply
+            batch_processing (bool): Whether the filter takes a list of messages
+            micro_batch_size (int): Maximum number of messages per call of a batch processing filter
+            stats (PipelineStats|None): Statistics to record the filter calls in
+
+        Yields:
+            object: The single results of the filter
+        """
+        if batch_processing:
+            while True:
+                # Collect a bounded micro-batch from the previous filter
+                micro_batch = list(islice(messages, micro_batch_size))
+                if not micro_batch:
+                    return
+                yield from Pipeline._as_list(Pipeline._call_filter(index, f, micro_batch, True, stats))
+        else:
+            for m in messages:
+                yield from Pipeline._as_list(Pipeline._call_filter(index, f, m, False, stats))
+
+    def _call_filter(index, f, argument, batch_processing, stats):
+        """Calls a filter and, if given, records its statistics.
+
+        Args:
+            index (int): Index of the filter in the pipeline
+            f (Callable): The filter
+            argument (object|List[object]): The message or, for batch processing filters, the list of messages
+            batch_processing (bool): Whether the filter takes a list of messages
+            stats (PipelineStats|None): Statistics to record the call in
+
+        Returns:
+            object|List[object]|None: The return value of the filter
+        """
+        if stats is None:
+            return f(argument)
+        return stats.run(index, f, argument, argument if batch_processing else [argument])
+
+    def _as_list(result):
+        """Normalizes the return value of a filter to a list of messages.
+
+        Args:
+            result (object|List[object]|None): Return value of a filter
+
+        Returns:
+            List[object]: The single or multiple results, empty if the filter returned None
+        """
+        if isinstance(result, list):
+            return result
+        elif result is None:
+            return []
+        else:
+            return [result]
@@ -0,0 +1,187 @@
+"""Per filter statistics of a pipeline.
+
+For every filter of a pipeline, the number of calls, histograms of the wall and
+CPU time per call, the number of messages going in and coming out (fan-out)
+and the bytes of the image and mask arrays going in and coming out are
+collected. Statistics collected in different processes are merged by
+exchanging their dict representation.
+
+Todo:
+    - Add license boilerplate
+"""
+
+import json
+import threading
+import time
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+
+from . import transport
+
+# Upper bounds of the time histogram buckets in seconds, the last bucket is unbounded
+TIME_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+def filter_name(f) -> str:
+    """Readable name of a filter.
+
+    Args:
+        f (Callable): The filter
+
+    Returns:
+        str: Name of the function, the wrapped function for partials or the class name for other callables
+    """
+    while isinstance(f, partial):
+        f = f.func
+    return getattr(f, '__name__', type(f).__name__)
+
+def message_bytes(messages) -> int:
+    """Number of bytes of the image and mask arrays of the given messages. Images which are not decoded yet do not count.
+
+    Args:
+        messages (List[object]): Messages to count
+
+    Returns:
+        int: Sum of the array sizes in bytes
+    """
+    result = 0
+    for m in messages:
+        for field in transport.ARRAY_FIELDS:
+            array = transport.peek(m, field)
+            if isinstance(array, np.ndarray):
+                result += array.nbytes
+    return result
+
+def _bucket(seconds) -> int:
+    """Index of the histogram bucket for the given duration."""
+    for i, bound in enumerate(TIME_BUCKETS):
+        if seconds <= bound:
+            return i
+    return len(TIME_BUCKETS)
+
+class PipelineStats(object):
+    """Statistics of the filters of a pipeline."""
+
+    def __init__(self, filters=None, offset=0):
+        """Constructor.
+
+        Args:
+            filters (List[Tuple[Callable, bool]], optional): The filters of the pipeline. Defaults to None.
+            offset (int, optional): Index of the first given filter in the whole pipeline. Defaults to 0.
+        """
+        self._filters = {}
+        self._lock = threading.Lock()
+        for i, fb in enumerate(filters or []):
+            self._entry(i + offset, filter_name(fb[0]))
+        self._offset = offset
+
+    def _entry(self, index, name=None):
+        """Returns the statistics of the filter with the given index and creates them, if necessary."""
+        key = str(index)
+        if key not in self._filters:
+            self._filters[key] = {
+                'name': name,
+                'calls': 0,
+                'wall': 0.0,
+                'cpu': 0.0,
+                'wall_histogram': [0]*(len(TIME_BUCKETS)+1),
+                'cpu_histogram': [0]*(len(TIME_BUCKETS)+1),
+                'messages_in': 0,
+                'messages_out': 0,
+                'bytes_in': 0,
+                'bytes_out': 0,
+            }
+        return self._filters[key]
+
+    def run(self, index, f, argument, messages_in):
+        """Call a filter and record its statistics.
+
+        Args:
+            index (int): Index of the filter in the list the statistics were created with
+            f (Callable): The filter
+            argument (object|List[object]): The message or, for batch processing filters, list of messages
+            messages_in (List[object]): The messages handed to the filter
+
+        Returns:
+            object|List[object]|None: The return value of the filter
+        """
+        bytes_in = message_bytes(messages_in)
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        result = f(argument)
+        cpu = time.thread_time() - cpu
+        wall = time.perf_counter() - wall
+        if isinstance(result, list):
+            messages_out = result
+        else:
+            messages_out = [] if result is None else [result]
+
+        with self._lock:
+            entry = self._entry(index + self._offset, filter_name(f))
+            entry['calls'] += 1
+            entry['wall'] += wall
+            entry['cpu'] += cpu
+            entry['wall_histogram'][_bucket(wall)] += 1
+            entry['cpu_histogram'][_bucket(cpu)] += 1
+            entry['messages_in'] += len(messages_in)
+            entry['messages_out'] += len(messages_out)
+            entry['bytes_in'] += bytes_in
+            entry['bytes_out'] += message_bytes(messages_out)
+        return result
+
+    def merge(self, data : dict):
+        """Add statistics collected somewhere else.
+
+        Args:
+            data (dict): Statistics returned by to_dict
+        """
+        with self._lock:
+            for key, other in data['filters'].items():
+                entry = self._entry(key, other['name'])
+                for field, value in other.items():
+                    if field == 'name':
+                        continue
+                    elif isinstance(value, list):
+                        entry[field] = [a + b for a, b in zip(entry[field], value)]
+                    else:
+                        entry[field] += value
+
+    def to_dict(self) -> dict:
+        """Returns the statistics as JSON serializable dict.
+
+        Returns:
+            dict: The time histogram bucket bounds and the statistics per filter index
+        """
+        with self._lock:
+            filters = {k: dict(v, wall_histogram=list(v['wall_histogram']), cpu_histogram=list(v['cpu_histogram']))
+                       for k, v in self._filters.items()}
+        return {'time_buckets': list(TIME_BUCKETS), 'filters': filters}
+
+    def dump(self, path : Path):
+        """Write the statistics to a JSON file.
+
+        Args:
+            path (Path): File to write to
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def report(self) -> str:
+        """Format the statistics as a table with one line per filter.
+
+        Returns:
+            str: The report
+        """
+        lines = ['%3s %-32s %7s %10s %10s %9s %9s %9s %10s %10s' % ('#', 'filter', 'calls', 'wall [s]', 'cpu [s]', 'ms/call',
+                                                                  'msg in', 'fan-out', 'MB in', 'MB out')]
+        data = self.to_dict()['filters']
+        for key in sorted(data, key=int):
+            e = data[key]
+            lines.append('%3s %-32s %7i %10.2f %10.2f %9.1f %9i %9.2f %10.1f %10.1f' % (
+                key, e['name'], e['calls'], e['wall'], e['cpu'], 1000*e['wall']/max(1, e['calls']), e['messages_in'],
+                e['messages_out']/max(1, e['messages_in']), e['bytes_in']/2**20, e['bytes_out']/2**20))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.report()
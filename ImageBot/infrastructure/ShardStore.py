@@ -0,0 +1,291 @@
+"""Packed storage of ImageMessages in shard files.
+
+Instead of two PNG files per message, the images and masks of a dataset are
+appended to a few large shard files. Every writing process has its own shard
+file, so that no locking is needed, and its own index file with one fixed size
+record per message (see INDEX_DTYPE). The index files are memory-mapped when
+reading, which gives random access to the messages by their id without
+scanning the folder or opening a file per message.
+
+The arrays are stored as uint8, either raw or compressed losslessly with zlib
+(see SHARD_COMPRESSION_LEVEL). A record is only appended to the index after
+its arrays have been written, thus the store can be read while it is written
+and an interrupted run loses at most the message it was writing.
+
+Layout of a store folder:
+    <token>.shard: The concatenated image and mask bytes of one writer
+    <token>.idx: The index records of the shard, see INDEX_DTYPE
+
+Todo:
+    - Add license boilerplate
+"""
+
+import os
+import threading
+import uuid
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from ImageBot.Config import SHARD_COMPRESSION_LEVEL
+
+from .ImageMessage import ImageMessage
+from .dtypes import as_uint8, to_policy
+
+SHARD_EXTENSION = '.shard'
+INDEX_EXTENSION = '.idx'
+
+# Maximum number of dimensions of a stored array
+MAX_DIMENSIONS = 3
+
+# One record of an index file. A message without mask has a mask_ndim of 0.
+INDEX_DTYPE = np.dtype([
+    ('id', 'S64'),
+    ('name', 'S128'),
+    ('offset', '<u8'),
+    ('image_nbytes', '<u8'),
+    ('mask_nbytes', '<u8'),
+    ('image_shape', '<u4', (MAX_DIMENSIONS,)),
+    ('mask_shape', '<u4', (MAX_DIMENSIONS,)),
+    ('image_ndim', 'u1'),
+    ('mask_ndim', 'u1'),
+    ('compressed', 'u1'),
+])
+
+def message_name(message : ImageMessage) -> str:
+    """Name of the files of a message, i.e. the name of its source image or its id.
+
+    Args:
+        message (ImageMessage): The message
+
+    Returns:
+        str: The name without extension
+    """
+    if 'image_path' in message.metadata:
+        return Path(message.metadata['image_path']).stem
+    return message.metadata.get('stored_name', str(message.id))
+
+class ShardWriter(object):
+    """Appends messages to a new shard file of a store folder.
+
+    A writer must only be used by one process. Use shard_writer to get the one of the calling process.
+    """
+
+    def __init__(self, folder : Path, compression=SHARD_COMPRESSION_LEVEL):
+        """Constructor.
+
+        Args:
+            folder (Path): Folder of the store, it is created if necessary
+            compression (int, optional): zlib compression level from 1 (fastest) to 9 (smallest), 0 stores the arrays raw.
+                Defaults to SHARD_COMPRESSION_LEVEL.
+        """
+        assert 0 <= compression <= 9
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        token = '%i-%s' % (os.getpid(), uuid.uuid4().hex[:8])
+        self._compression = compression
+        self._lock = threading.Lock()
+        # Unbuffered, thus every appended record is on its way to the disk at once
+        self._data = open(folder / (token + SHARD_EXTENSION), 'ab', buffering=0)
+        self._index = open(folder / (token + INDEX_EXTENSION), 'ab', buffering=0)
+        self._offset = 0
+
+    def append(self, message : ImageMessage, save_mask=True):
+        """Append the image and, if set, the mask of a message.
+
+        Args:
+            message (ImageMessage): The message, its id is the key in the store
+            save_mask (bool, optional): Store the mask, too. Defaults to True.
+        """
+        record = np.zeros(1, INDEX_DTYPE)
+        record['id'] = _key(message.id)
+        name = message_name(message).encode('utf-8')
+        assert len(name) <= INDEX_DTYPE['name'].itemsize, "Name '%s' is too long for the index" % name
+        record['name'] = name
+        record['compressed'] = self._compression > 0
+        image = self._encode(as_uint8(message.image), record, 'image')
+        mask = self._encode(as_uint8(message.mask), record, 'mask') if save_mask and message.mask is not None else b''
+
+        with self._lock:
+            record['offset'] = self._offset
+            self._data.write(image)
+            self._data.write(mask)
+            self._offset += len(image) + len(mask)
+            self._index.write(record.tobytes())
+
+    def close(self):
+        """Close the files of the shard."""
+        with self._lock:
+            self._data.close()
+            self._index.close()
+
+    def _encode(self, array, record, field) -> bytes:
+        """Returns the bytes of an array and sets its shape in the record."""
+        assert array.ndim <= MAX_DIMENSIONS
+        data = np.ascontiguousarray(array).tobytes()
+        if self._compression > 0:
+            data = zlib.compress(data, self._compression)
+        record[field + '_ndim'] = array.ndim
+        record[field + '_shape'][0, :array.ndim] = array.shape
+        record[field + '_nbytes'] = len(data)
+        return data
+
+class ShardStore(object):
+    """Random access to the messages of a store folder by their id.
+
+    The index files are read when the store is created and by refresh. Reading an unknown
+    id refreshes the store once, thus messages appended in the meantime are found, too.
+    Only the folder is pickled, e.g. when the store is passed to pool workers.
+    """
+
+    def __init__(self, folder : Path):
+        """Constructor.
+
+        Args:
+            folder (Path): Folder of the store
+        """
+        self.folder = Path(folder)
+        self._lock = threading.Lock()
+        self._indices = []
+        self._shards = []
+        # Memory maps of the shard files: path -> np.memmap
+        self._maps = {}
+        self._keys = {}
+        self.refresh()
+
+    def __reduce__(self):
+        return (ShardStore, (self.folder,))
+
+    def refresh(self):
+        """Map the index files again to find the messages appended since the last refresh."""
+        indices, shards, keys = [], [], {}
+        # If an id was stored more than once, the record of the last modified index wins
+        for index_file in sorted(self.folder.glob('*' + INDEX_EXTENSION), key=lambda f: f.stat().st_mtime_ns):
+            # A record which is being written is ignored
+            count = index_file.stat().st_size // INDEX_DTYPE.itemsize
+            if count == 0:
+                continue
+            index = np.memmap(index_file, INDEX_DTYPE, mode='r', shape=(count,))
+            for row, key in enumerate(index['id']):
+                keys[key] = (len(indices), row)
+            indices.append(index)
+            shards.append(index_file.with_suffix(SHARD_EXTENSION))
+        with self._lock:
+            self._indices, self._shards, self._keys = indices, shards, keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, message_id):
+        return _key(message_id) in self._keys
+
+    def __iter__(self):
+        """Iterate over the stored messages in the order they were written per shard."""
+        for message_id in self.ids():
+            yield self.read(message_id)
+
+    def ids(self) -> list:
+        """The ids of all stored messages.
+
+        Returns:
+            List[str]: The ids as strings
+        """
+        return [key.decode('ascii') for key in self._keys]
+
+    def read(self, message_id, message : ImageMessage = None, load_mask=True) -> ImageMessage:
+        """Read a message by its id.
+
+        Args:
+            message_id (uuid|int|str): Id of the message
+            message (ImageMessage, optional): Message to read the image and mask into. Defaults to None,
+                which creates a new message with the stored id.
+            load_mask (bool, optional): Read the mask, too, if it is stored. Defaults to True.
+
+        Raises:
+            KeyError: If the id is not stored
+
+        Returns:
+            ImageMessage: The message, its metadata contain the stored name as 'stored_name'
+        """
+        key = _key(message_id)
+        if key not in self._keys:
+            self.refresh()
+        with self._lock:
+            shard, row = self._keys[key]
+            record, shard = self._indices[shard][row], self._shards[shard]
+        if message is None:
+            message = ImageMessage(key.decode('ascii'))
+        offset = int(record['offset'])
+        message.image = to_policy(self._decode(shard, offset, record, 'image'))
+        if load_mask and record['mask_ndim'] > 0:
+            message.mask = to_policy(self._decode(shard, offset + int(record['image_nbytes']), record, 'mask'))
+        message.metadata['stored_name'] = record['name'].decode('utf-8')
+        return message
+
+    def _data(self, shard, end) -> np.memmap:
+        """Returns the memory map of a shard file, which is mapped again if it grew past the mapped size."""
+        with self._lock:
+            data = self._maps.get(shard)
+            if data is None or len(data) < end:
+                data = np.memmap(shard, np.uint8, mode='r')
+                self._maps[shard] = data
+            return data
+
+    def _decode(self, shard, offset, record, field) -> np.ndarray:
+        """Returns a copy of a stored array."""
+        nbytes = int(record[field + '_nbytes'])
+        shape = tuple(int(s) for s in record[field + '_shape'][:record[field + '_ndim']])
+        data = self._data(shard, offset + nbytes)[offset:offset + nbytes]
+        if record['compressed']:
+            # A bytearray, because filters may change the array in place
+            return np.frombuffer(bytearray(zlib.decompress(data)), np.uint8).reshape(shape)
+        return np.array(data).reshape(shape)
+
+def is_store(folder : Path) -> bool:
+    """Whether the folder contains a store.
+
+    Args:
+        folder (Path): The folder
+
+    Returns:
+        bool: True, if it contains at least one index file
+    """
+    folder = Path(folder)
+    return folder.is_dir() and any(folder.glob('*' + INDEX_EXTENSION))
+
+def _key(message_id) -> bytes:
+    """Key of a message id in the index."""
+    key = str(message_id).encode('ascii')
+    assert len(key) <= INDEX_DTYPE['id'].itemsize, "Message id '%s' is too long for the index" % message_id
+    return key
+
+# The writers of this process: folder -> ShardWriter
+_writers = {}
+_writers_lock = threading.Lock()
+
+def shard_writer(folder : Path) -> ShardWriter:
+    """Returns the writer of this process for the given store folder and creates it, if necessary.
+
+    Args:
+        folder (Path): Folder of the store
+
+    Returns:
+        ShardWriter: The writer
+    """
+    folder = Path(folder).resolve()
+    with _writers_lock:
+        writer = _writers.get(folder)
+        if writer is None:
+            writer = ShardWriter(folder)
+            _writers[folder] = writer
+        return writer
+
+def _reset_writers():
+    """Forgets the writers inherited by a forked process, it must append to its own shards."""
+    global _writers, _writers_lock
+    _writers = {}
+    _writers_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_writers)
@@ -0,0 +1,269 @@
+"""Content addressed on-disk cache of filter results.
+
+The results of a filter are stored under a hash of everything they depend on:
+the filter, the image and mask of the input message (the bytes of the file, if
+the image is not decoded yet), its green value and metadata and the values of
+the Config parameters the filter reads. If the same message passes the filter
+again with unchanged parameters, the stored results are returned instead of
+running the filter. Thus, rerunning a pipeline after changing a parameter of a
+later filter does not redo the earlier ones.
+
+The cache is bounded by its size on disk. Every hit refreshes the modification
+time of the entry and the least recently used entries are evicted first.
+
+Empty results are never stored. A filter returns no messages, if it drops a
+message, e.g. because the user skipped it interactively. Such a decision must
+be made again on the next run instead of being replayed from the cache.
+
+Todo:
+    - Add license boilerplate
+"""
+
+import hashlib
+import os
+import pickle
+import threading
+from functools import partial
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+import ImageBot.Config as Config
+from ImageBot.Config import STAGE_CACHE_MAX_BYTES
+
+from .ImageMessage import ImageFile
+from .PipelineStats import filter_name
+
+# Share of the maximum size the cache is reduced to when evicting, so that not every put evicts
+EVICTION_TARGET = 0.9
+
+class StageCache(object):
+    """Cache of filter results in a folder, see the module description.
+
+    Every process accounts the size of the cache on its own, thus several processes
+    can share a cache folder. Only the folder and the size limit are pickled.
+    """
+
+    def __init__(self, folder : Path, max_bytes=STAGE_CACHE_MAX_BYTES):
+        """Constructor.
+
+        Args:
+            folder (Path): Folder of the cache, it is created if necessary
+            max_bytes (int, optional): Maximum size of all entries. Defaults to STAGE_CACHE_MAX_BYTES.
+        """
+        assert max_bytes > 0
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Size of all entries, determined on the first put
+        self._size = None
+        self.hits = 0
+        self.misses = 0
+
+    def __reduce__(self):
+        return (StageCache, (self.folder, self.max_bytes))
+
+    def wrap(self, filter : Callable, config=()) -> Callable:
+        """Returns the filter with cached results, see Pipeline.add.
+
+        Args:
+            filter (Callable): Filter taking a single message
+            config (Iterable[str], optional): Names of the Config parameters the results depend on. Defaults to ().
+
+        Returns:
+            Callable: The cached filter
+        """
+        return CachedFilter(filter, self, config)
+
+    def key(self, filter : Callable, message, config=()) -> str:
+        """Hash of a filter, its input message and the values of the given Config parameters.
+
+        Args:
+            filter (Callable): The filter
+            message (ImageMessage): The input message
+            config (Iterable[str], optional): Names of the Config parameters. Defaults to ().
+
+        Returns:
+            str: The key as hex digest
+        """
+        h = hashlib.blake2b(digest_size=20)
+        f = filter
+        while isinstance(f, partial):
+            # The bound arguments select the results as well
+            for value in f.args:
+                _update(h, value)
+            for name in sorted(f.keywords):
+                h.update(name.encode('utf-8'))
+                _update(h, f.keywords[name])
+            f = f.func
+        h.update(('%s.%s' % (getattr(f, '__module__', ''), filter_name(f))).encode('utf-8'))
+        for name in config:
+            h.update(('%s=%r' % (name, getattr(Config, name))).encode('utf-8'))
+        _update(h, message.stored('image'))
+        _update(h, message.stored('mask'))
+        _update(h, message.green)
+        for name in sorted(message.metadata):
+            h.update(name.encode('utf-8'))
+            _update(h, message.metadata[name])
+        return h.hexdigest()
+
+    def get(self, key):
+        """Returns the cached results of a key and marks them as recently used.
+
+        Args:
+            key (str): See key
+
+        Returns:
+            object|None: The results or None, if the key is not cached
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                results = pickle.load(f)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # Missing, evicted meanwhile or not completely written
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return results
+
+    def put(self, key, results):
+        """Store the results of a key and evict the least recently used entries, if the cache is full.
+
+        Args:
+            key (str): See key
+            results (object): Picklable results of the filter
+        """
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        temporary = path.with_name('%s.%i.tmp' % (path.name, os.getpid()))
+        with open(temporary, 'wb') as f:
+            pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        # Readers never see a partial entry
+        os.replace(temporary, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(s for _, s, _ in self._entries())
+            else:
+                self._size += size
+            full = self._size > self.max_bytes
+        if full:
+            self.evict()
+
+    def evict(self, max_bytes=None):
+        """Delete the least recently used entries until the cache is smaller than EVICTION_TARGET of the limit.
+
+        Args:
+            max_bytes (int|None, optional): The limit. Defaults to None, which uses max_bytes of the cache.
+        """
+        target = EVICTION_TARGET * (self.max_bytes if max_bytes is None else max_bytes)
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        size = sum(s for _, s, _ in entries)
+        for path, s, _ in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Evicted by another process
+                pass
+            size -= s
+        with self._lock:
+            self._size = size
+
+    def clear(self):
+        """Delete all entries."""
+        self.evict(0)
+
+    def stats(self) -> dict:
+        """Hits and misses of this process and the size of the cache.
+
+        Returns:
+            dict: Hits, misses, hit rate, entries and bytes
+        """
+        entries = self._entries()
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses > 0 else 0.0,
+            'entries': len(entries),
+            'bytes': sum(s for _, s, _ in entries),
+        }
+
+    def _path(self, key) -> Path:
+        """File of an entry, the entries are spread over subfolders by the first two digits."""
+        return self.folder / key[:2] / (key + '.pkl')
+
+    def _entries(self):
+        """Returns (path, size, modification time) of all entries."""
+        entries = []
+        for folder in os.scandir(self.folder):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.name.endswith('.pkl'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((entry.path, stat.st_size, stat.st_mtime_ns))
+        return entries
+
+class CachedFilter(object):
+    """Filter returning the cached results of a filter, see StageCache.wrap."""
+
+    def __init__(self, filter : Callable, cache : StageCache, config=()):
+        """Constructor.
+
+        Args:
+            filter (Callable): Filter taking a single message
+            cache (StageCache): The cache
+            config (Iterable[str], optional): Names of the Config parameters the results depend on. Defaults to ().
+        """
+        assert callable(filter)
+        for name in config:
+            assert hasattr(Config, name), "Unknown Config parameter '%s'" % name
+        self.filter = filter
+        self.cache = cache
+        self.config = tuple(config)
+        # Report the statistics under the name of the wrapped filter
+        self.__name__ = filter_name(filter)
+
+    def __call__(self, message):
+        key = self.cache.key(self.filter, message, self.config)
+        results = self.cache.get(key)
+        if results is None:
+            results = self.filter(message)
+            # A dropped message is not cached, see the module description
+            if results is not None and not (isinstance(results, list) and len(results) == 0):
+                self.cache.put(key, results)
+        elif isinstance(results, list):
+            # The results belong to the message passed now
+            for r in results:
+                r.origin = message.origin
+        else:
+            results.origin = message.origin
+        return results
+
+def _update(h, value):
+    """Adds a value to the hash."""
+    if isinstance(value, ImageFile):
+        # Hash the file instead of decoding it
+        h.update(('file:%i:%r:' % (value.flags, value.max_size)).encode('utf-8'))
+        with open(value.path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    elif isinstance(value, np.ndarray):
+        h.update(('array:%s:%s:' % (value.dtype.str, value.shape)).encode('utf-8'))
+        h.update(np.ascontiguousarray(value).data)
+    else:
+        h.update(('%r:' % (value,)).encode('utf-8'))
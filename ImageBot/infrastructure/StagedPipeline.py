@@ -0,0 +1,356 @@
+"""Stage-parallel Pipeline backend.
+
+Instead of one worker running the whole filter chain for a message, the
+filters are grouped into stages. Every stage has its own worker processes and
+the stages are connected by bounded queues. Thus, cheap, CPU heavy and I/O
+bound stages overlap across cores and each stage gets as many workers as it
+needs.
+
+All results (including the fan-out) of one executed message travel through
+the stages together, so that the callback still receives all of them at once.
+
+Todo:
+    - Add license boilerplate
+"""
+
+import itertools
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future
+from functools import partial
+from multiprocessing import resource_tracker
+from multiprocessing.pool import ExceptionWithTraceback
+from collections.abc import Iterable
+from typing import Callable
+
+from .Pipeline import Pipeline
+from .PipelineStats import PipelineStats
+from . import transport
+from .ImageWriter import flush_default_writer
+
+class _Stage(object):
+    """A group of filters run by the same worker processes."""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.filters = []
+
+def _stage_worker(filters, offset, options, shared_memory, instrument, in_queue, out_queue, done_queue, counters):
+    """Main function of a stage worker process.
+
+    Args:
+        filters (List[Tuple[Callable, bool]]): The filters of the stage
+        offset (int): Index of the first filter of the stage in the whole pipeline
+        options (dict): Keyword arguments passed on to Pipeline.call_fnc
+        shared_memory (bool): Whether the messages are transported through shared memory
+        instrument (bool): Whether to collect statistics, which are passed on with the messages
+        in_queue (multiprocessing.Queue): Queue to take the (task id, messages, error, statistics) tuples from
+        out_queue (multiprocessing.Queue): Queue of the next stage
+        done_queue (multiprocessing.Queue): Queue to report failed tasks to
+        counters (multiprocessing.Array): Shared [processed tasks, busy seconds, blocked seconds] of the stage
+    """
+    while True:
+        item = in_queue.get()
+        if item is None:
+            # Sentinel, the stage is shut down
+            break
+        task_id, messages, _, task_stats = item
+        start = time.perf_counter()
+        handles = []
+        stats = None
+        if instrument:
+            # Add the statistics of this stage to the ones of the previous stages
+            stats = PipelineStats(filters, offset)
+            if task_stats is not None:
+                stats.merge(task_stats)
+        try:
+            if shared_memory:
+                handles = transport.import_messages(messages, True)
+            result = Pipeline.call_fnc(messages, filters, batch_processing=True, stats=stats, **options)
+            # Errors of the background writes fail the task, see ImageWriter
+            flush_default_writer()
+            if shared_memory:
+                result = transport.export_messages(result, True, detach=True)
+            queue, item = out_queue, (task_id, result, None, stats.to_dict() if stats is not None else None)
+        except Exception as e:
+            queue, item = done_queue, (task_id, None, ExceptionWithTraceback(e, e.__traceback__), None)
+        finally:
+            # The inputs are consumed by this stage
+            for handle in handles:
+                transport.release(handle, unlink=True)
+        busy = time.perf_counter() - start
+
+        # Hand the results over, this blocks if the next stage is saturated
+        queue.put(item)
+        with counters.get_lock():
+            counters[0] += 1
+            counters[1] += busy
+            counters[2] += time.perf_counter() - start - busy
+
+class StagedPipeline(Pipeline):
+    """Pipeline running groups of filters as parallel stages.
+
+    Every stage has its own worker processes and is connected to the next stage by
+    a bounded queue. Use add_stage to start a new stage; all filters added afterwards
+    belong to it.
+    """
+
+    def __init__(self, queue_size=4, streaming=False, micro_batch_size=4, shared_memory=None, max_in_flight=None,
+                 instrument=False, stats_file=None, batch_size=None, batch_timeout=0.1):
+        """Constructor.
+
+        Args:
+            queue_size (int, optional): Maximum number of tasks waiting in front of each stage. Defaults to 4.
+            streaming (bool, optional): See Pipeline. Defaults to False.
+            micro_batch_size (int, optional): See Pipeline. Defaults to 4.
+            shared_memory (bool|None, optional): See Pipeline. Defaults to None, which enables it where
+                shared memory blocks outlive the process which created them.
+            max_in_flight (int|None, optional): See Pipeline. Defaults to None.
+            instrument (bool, optional): See Pipeline. Defaults to False.
+            stats_file (Path|None, optional): See Pipeline. Defaults to None.
+            batch_size (int|None, optional): See Pipeline. Defaults to None.
+            batch_timeout (float, optional): See Pipeline. Defaults to 0.1.
+        """
+        if shared_memory is None:
+            shared_memory = transport.PERSISTENT_SEGMENTS
+        assert not shared_memory or transport.PERSISTENT_SEGMENTS, "Shared memory blocks do not persist on this platform"
+        super().__init__(with_multiprocessing=True, streaming=streaming, micro_batch_size=micro_batch_size,
+                         shared_memory=shared_memory, max_in_flight=max_in_flight, instrument=instrument, stats_file=stats_file,
+                         batch_size=batch_size, batch_timeout=batch_timeout)
+        assert queue_size > 0
+        self._queue_size = queue_size
+        self._stages = []
+
+        # The state while running
+        self._queues = None
+        self._done_queue = None
+        self._processes = None
+        self._counters = None
+        self._collector = None
+        self._callbacks = {}
+        self._callbacks_lock = threading.Lock()
+        self._task_ids = itertools.count()
+        self._start_time = None
+
+    def add_stage(self, name=None, workers=1):
+        """Start a new stage. All filters added afterwards belong to this stage.
+
+        Args:
+            name (str, optional): Name of the stage used for reporting. Defaults to None, which uses the index of the stage.
+            workers (int, optional): Number of worker processes for this stage. Defaults to 1.
+        """
+        assert self._processes is None, "Stages cannot be changed while the pipeline is running"
+        assert workers > 0
+        self._stages.append(_Stage(name or str(len(self._stages)), workers))
+
+    def add(self, filter : Callable, batch_processing=False, cache=None, config=()):
+        """Add filter to the current stage of the pipeline, see Pipeline.add.
+
+        If no stage has been added yet, a stage with a single worker is started.
+        """
+        assert self._processes is None, "Filters cannot be changed while the pipeline is running"
+        if not self._stages:
+            self.add_stage()
+        super().add(filter, batch_processing, cache, config)
+        self._stages[-1].filters.append(self._filters[-1])
+
+    def insert(self, index, filter, batch_processing=False):
+        """Insert filter at provided index to the pipeline, see Pipeline.insert.
+
+        The filter joins the stage of the filter it is inserted in front of. At the end of
+        the pipeline, it joins the last stage like add.
+        """
+        assert self._processes is None, "Filters cannot be changed while the pipeline is running"
+        if not self._stages:
+            self.add_stage()
+        # The position the filter ends up at, like list.insert
+        position = max(0, len(self._filters) + index) if index < 0 else min(index, len(self._filters))
+        super().insert(position, filter, batch_processing)
+        offset = 0
+        for stage in self._stages:
+            if position < offset + len(stage.filters) or stage is self._stages[-1]:
+                stage.filters.insert(position - offset, self._filters[position])
+                return
+            offset += len(stage.filters)
+
+    def _execute(self, message, clbck=None, batch_processing=False, error_clbck=None):
+        """Hands the message over to the first stage, see Pipeline.execute.
+
+        Blocks as long as the queue in front of the first stage is full or max_in_flight
+        messages are not finished yet. The callback is called from a thread of the main process.
+        """
+        if clbck is not None:
+            assert callable(clbck)
+        if self._batch_size and not batch_processing:
+            return self._buffer(message, clbck, error_clbck or Pipeline.error_callback)
+        if batch_processing:
+            assert isinstance(message, Iterable)
+        self._start()
+        if self._in_flight is not None:
+            self._in_flight.acquire()
+
+        messages = list(message) if batch_processing else [message]
+        task_id = next(self._task_ids)
+        exported = False
+        try:
+            if self._shared_memory:
+                # The first stage takes over the blocks
+                messages = transport.export_messages(messages, True, detach=True)
+                exported = True
+            with self._callbacks_lock:
+                self._callbacks[task_id] = (clbck, error_clbck or Pipeline.error_callback)
+            self._queues[0].put((task_id, messages, None, None))
+        except BaseException:
+            # The message did not reach the first stage, thus nothing frees its slot and blocks
+            with self._callbacks_lock:
+                self._callbacks.pop(task_id, None)
+            if exported:
+                transport.discard_messages(messages, True)
+            if self._in_flight is not None:
+                self._in_flight.release()
+            raise
+
+    def _submit_chunk(self, chunk, loader, batch_processing, grouped) -> Future:
+        """Executes a chunk of map, see Pipeline._submit_chunk.
+
+        The loader runs in the calling process, because the messages are handed to the first stage.
+        """
+        messages = [loader(item) for item in chunk] if loader is not None else chunk
+        future = Future()
+        failed = partial(Pipeline._resolve, future, exception=True)
+        if grouped:
+            def finished(results):
+                per_message, lost = Pipeline.split_by_origin(messages, results)
+                if lost:
+                    failed(ValueError("%i results of a batch do not originate from any of its messages" % lost))
+                else:
+                    Pipeline._resolve(future, per_message)
+            self.execute(messages, clbck=finished, batch_processing=True, error_clbck=failed)
+            return future
+
+        # Every message travels through the stages on its own
+        results = [None] * len(messages)
+        remaining = [len(messages)]
+        lock = threading.Lock()
+        def finished(i, result):
+            with lock:
+                results[i] = result
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    Pipeline._resolve(future, results)
+        for i, m in enumerate(messages):
+            self.execute(m, clbck=partial(finished, i), batch_processing=batch_processing, error_clbck=failed)
+        return future
+
+    def join(self):
+        """Waits until all executed messages passed all stages and stops the workers."""
+        self.flush()
+        if self._processes is None:
+            return
+        # Shut down stage by stage, so that every stage processed all results of the previous one
+        for stage, queue, processes in zip(self._stages, self._queues, self._processes):
+            for _ in range(stage.workers):
+                queue.put(None)
+            for p in processes:
+                p.join()
+        self._done_queue.put(None)
+        self._collector.join()
+        flush_default_writer()
+        self._queues = None
+        self._done_queue = None
+        self._processes = None
+        self._collector = None
+        if self._stats is not None and self._stats_file is not None:
+            self._stats.dump(self._stats_file)
+
+    def utilisation(self):
+        """Report how busy the stages are.
+
+        The utilisation is the time the workers of a stage spent processing divided by the
+        time they were available. Blocked is the time spent waiting for a free slot in
+        the queue of the next stage, which indicates that a later stage is the bottleneck.
+
+        Returns:
+            List[dict]: For every stage its name, workers, processed tasks, busy and blocked seconds and utilisation
+        """
+        assert self._counters is not None, "The pipeline has not been started yet"
+        elapsed = time.perf_counter() - self._start_time
+        result = []
+        for stage, counters in zip(self._stages, self._counters):
+            with counters.get_lock():
+                tasks, busy, blocked = counters[0], counters[1], counters[2]
+            result.append({
+                'name': stage.name,
+                'workers': stage.workers,
+                'tasks': int(tasks),
+                'busy': busy,
+                'blocked': blocked,
+                'utilisation': busy / (elapsed * stage.workers) if elapsed > 0 else 0.0,
+            })
+        return result
+
+    def utilisation_report(self):
+        """Format the utilisation of the stages as a table.
+
+        Returns:
+            str: One line per stage
+        """
+        lines = ['%-16s %7s %7s %10s %10s %7s' % ('stage', 'workers', 'tasks', 'busy [s]', 'blocked [s]', 'util')]
+        for s in self.utilisation():
+            lines.append('%-16s %7i %7i %10.2f %10.2f %6.0f%%' % (s['name'], s['workers'], s['tasks'], s['busy'], s['blocked'], s['utilisation']*100))
+        return '\n'.join(lines)
+
+    def _start(self):
+        """Starts the stage workers and the result collector, if not already running."""
+        if self._processes is not None:
+            return
+        assert self._stages, "The pipeline has no filters"
+        if self._shared_memory:
+            resource_tracker.ensure_running()
+
+        options = {'streaming': self._streaming, 'micro_batch_size': self._micro_batch_size}
+        self._queues = [multiprocessing.Queue(self._queue_size) for _ in self._stages]
+        self._done_queue = multiprocessing.Queue()
+        self._counters = [multiprocessing.Array('d', 3) for _ in self._stages]
+        self._processes = []
+        offset = 0
+        for i, stage in enumerate(self._stages):
+            out_queue = self._queues[i+1] if i+1 < len(self._stages) else self._done_queue
+            processes = [multiprocessing.Process(target=_stage_worker, daemon=True,
+                                                 args=(stage.filters, offset, options, self._shared_memory, self._stats is not None,
+                                                       self._queues[i], out_queue, self._done_queue, self._counters[i]))
+                         for _ in range(stage.workers)]
+            for p in processes:
+                p.start()
+            self._processes.append(processes)
+            offset += len(stage.filters)
+
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+        self._start_time = time.perf_counter()
+
+    def _collect(self):
+        """Thread function handing the results of the last stage to the callbacks."""
+        while True:
+            item = self._done_queue.get()
+            if item is None:
+                break
+            task_id, result, error, stats = item
+            with self._callbacks_lock:
+                clbck, error_clbck = self._callbacks.pop(task_id)
+            if self._in_flight is not None:
+                self._in_flight.release()
+            if error is not None:
+                error_clbck(error)
+                continue
+            if stats is not None:
+                self._stats.merge(stats)
+            if self._shared_memory:
+                result = transport.receive_messages(result, True)
+            if clbck is not None:
+                try:
+                    clbck(result)
+                except Exception as ex:
+                    Pipeline.error_callback(ex)
@@ -0,0 +1,180 @@
+"""Helpers to measure the performance of pipelines.
+
+The functions in here are meant to be called from a notebook or the command
+line to compare different pipeline setups on real data. Parallel backends can
+only be compared on a machine with several cores, thus the results contain
+the number of cores the measurement had.
+
+Run this module to compare the backends on the chains of the project:
+    python -m ImageBot.infrastructure.benchmark <raw> <masked> <backgrounds> <output>
+
+Todo:
+    - Add license boilerplate
+"""
+
+import copy
+import os
+import pickle
+import sys
+import time
+from functools import partial
+from pathlib import Path
+from typing import Callable, List
+
+from .Pipeline import Pipeline, BACKENDS
+
+
+def _serialization_cost(payload, repetitions):
+    """Measure size and round trip time of pickling the given payload.
+
+    Args:
+        payload (object): Object to serialize, like the arguments of a pool task
+        repetitions (int): Number of round trips to average the time over
+
+    Returns:
+        Tuple[int, float]: Size of the payload in bytes and mean seconds per pickle and unpickle round trip
+    """
+    data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        pickle.loads(pickle.dumps(payload, pickle.HIGHEST_PROTOCOL))
+    return len(data), (time.perf_counter() - start) / repetitions
+
+def dispatch_overhead(pipeline : Pipeline, message, batch_processing=False, repetitions=20) -> dict:
+    """Measure the per-task dispatch overhead of a pipeline.
+
+    Compares the task payload which was sent to the pool workers before the filters
+    were installed once per worker (message plus filter list) with the payload sent
+    to Pipeline.worker_fnc today (message only).
+
+    Args:
+        pipeline (Pipeline): Pipeline with all filters added
+        message (object|List[object]): A representative message
+        batch_processing (bool, optional): See Pipeline.execute. Defaults to False.
+        repetitions (int, optional): Number of round trips to average the time over. Defaults to 20.
+
+    Returns:
+        dict: Payload bytes and seconds per task, both for the filter list ('before') and the registry ('after')
+    """
+    before_bytes, before_seconds = _serialization_cost((message, pipeline._filters, batch_processing), repetitions)
+    after_bytes, after_seconds = _serialization_cost((message, batch_processing), repetitions)
+    return {
+        'before': {'bytes': before_bytes, 'seconds': before_seconds},
+        'after': {'bytes': after_bytes, 'seconds': after_seconds},
+    }
+
+def compare_backends(make_pipeline : Callable[[str], Pipeline], messages : List, backends=BACKENDS) -> dict:
+    """Measure the throughput of the same filter chain on different execution backends.
+
+    Every backend processes a deep copy of the given messages, because filters may alter them.
+
+    Args:
+        make_pipeline (Callable[[str], Pipeline]): Returns a new pipeline with all filters added for the given backend name
+        messages (List[object]): Representative messages
+        backends (Iterable[str], optional): Backends to compare. Defaults to all in BACKENDS.
+
+    Returns:
+        dict: For every backend the seconds for all messages and the messages per second
+    """
+    result = {}
+    for backend in backends:
+        pipeline = make_pipeline(backend)
+        inputs = copy.deepcopy(messages)
+        start = time.perf_counter()
+        for message in inputs:
+            pipeline.execute(message)
+        pipeline.join()
+        seconds = time.perf_counter() - start
+        result[backend] = {'seconds': seconds, 'messages_per_second': len(inputs) / seconds}
+    return result
+
+def usable_cores() -> int:
+    """Number of cores this process may run on.
+
+    Returns:
+        int: The number of cores
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def headless_postprocessor(backend : str, dest_folder : Path = None, max_no_processes=None) -> Pipeline:
+    """The filter chain of the PostProcessor with estimated green values on the given backend.
+
+    The interactive PostProcessor cannot be benchmarked as is, because the user picks the green
+    value of every image in a window. The headless chain estimates it instead (see
+    remove_greenscreen_headless) and runs the same filters afterwards. Images without a
+    confident estimation yield no results, as in the headless PostProcessor.
+
+    Args:
+        backend (str): See Pipeline
+        dest_folder (Path, optional): Path to folder to save the resulting images in. Defaults to None.
+        max_no_processes (int|None, optional): Number of processes or threads. Defaults to None, which uses GREENSCREEN_HEADLESS_WORKERS.
+
+    Returns:
+        Pipeline: The pipeline
+    """
+    # Imported here, because the post processing uses this package
+    from ImageBot.Config import GREENSCREEN_HEADLESS_WORKERS, PIPELINE_STREAMING, PIPELINE_MICRO_BATCH_SIZE, INTERMEDIATE_PACKED
+    from ImageBot.image_processing import PostProcessor
+    from ImageBot.image_processing.Filter import remove_greenscreen_headless
+    pipeline = Pipeline(backend=backend, max_no_processes=max_no_processes or GREENSCREEN_HEADLESS_WORKERS,
+                        streaming=PIPELINE_STREAMING, micro_batch_size=PIPELINE_MICRO_BATCH_SIZE)
+    pipeline.add(remove_greenscreen_headless)
+    PostProcessor._add_processing(pipeline, dest_folder, INTERMEDIATE_PACKED)
+    return pipeline
+
+def augmentation_pipeline(backend : str, dest_folder : Path = None) -> Pipeline:
+    """The AugmentationPipeline on the given backend, the backgrounds must be loaded (see load_images).
+
+    Args:
+        backend (str): See Pipeline
+        dest_folder (Path, optional): Path to folder to save the resulting images in. Defaults to None.
+
+    Returns:
+        Pipeline: The pipeline
+    """
+    from ImageBot.data_augmentation import AugmentationPipeline
+    AugmentationPipeline.init(dest_folder, staged=False, backend=backend, packed=False)
+    return AugmentationPipeline.AugmentationPipeline
+
+def compare_chains(raw_folder : Path, masked_folder : Path, bgs_folder : Path, dest_folder : Path = None, count=8,
+                   backends=BACKENDS) -> dict:
+    """Compare the backends on the headless PostProcessor chain and the AugmentationPipeline, see compare_backends.
+
+    Args:
+        raw_folder (Path): Folder of captured images, the input of the PostProcessor
+        masked_folder (Path): Folder of images with masks, the input of the AugmentationPipeline
+        bgs_folder (Path): Folder of background images
+        dest_folder (Path, optional): The results of the chains are saved in its subfolders 'post' and 'augmentation'.
+            Defaults to None, which does not save them.
+        count (int, optional): Number of images per chain. Defaults to 8.
+        backends (Iterable[str], optional): Backends to compare. Defaults to all in BACKENDS.
+
+    Returns:
+        dict: The number of 'cores' usable by this process and the results of compare_backends for
+            the 'postprocessor' and the 'augmentation' chain
+    """
+    from ImageBot.data_augmentation import AugmentationPipeline
+    from ImageBot.infrastructure.filter import load_path
+
+    def folder(name):
+        return Path(dest_folder) / name if dest_folder is not None else None
+
+    raw = sorted(f for f in Path(raw_folder).iterdir() if '_mask' not in f.stem)[:count]
+    AugmentationPipeline.load_images(Path(masked_folder), Path(bgs_folder), packed=False)
+    masked = sorted(f for f in Path(masked_folder).iterdir() if '_mask' not in f.stem)[:count]
+    return {
+        'cores': usable_cores(),
+        'postprocessor': compare_backends(partial(headless_postprocessor, dest_folder=folder('post')),
+                                          [load_path(f) for f in raw], backends),
+        'augmentation': compare_backends(partial(augmentation_pipeline, dest_folder=folder('augmentation')),
+                                         [load_path(f, load_mask=True) for f in masked], backends),
+    }
+
+if __name__ == '__main__':
+    result = compare_chains(*[Path(a) for a in sys.argv[1:5]])
+    print('cores %i' % result['cores'])
+    for chain in ('postprocessor', 'augmentation'):
+        for backend, values in result[chain].items():
+            print('%-14s %-10s %8.2f s %8.2f messages/s' % (chain, backend, values['seconds'], values['messages_per_second']))
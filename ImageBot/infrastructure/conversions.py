@@ -0,0 +1,144 @@
+"""Colour space and data type conversions of ImageMessages.
+
+Filters declare the colour space and data type they need with the requires
+decorator instead of converting the images themselves. The conversion layer
+then picks the cheapest path from the current representation of every image:
+    - Nothing is done, if the image already has the required representation.
+    - A colour conversion is a single cv2 call working on the current data
+      type, so no scaling round trip to uint8 and back is needed.
+    - If both change, the channels are reduced before the data type is
+      converted and added afterwards, so the data type conversion always
+      works on the single channel image.
+
+The colour spaces are 'GRAY' (two dimensional arrays) and 'BGR' (three
+channels). The data types are the ones of the policies in dtypes. The current
+colour space and data type of a message are read from its image, which is as
+cheap as reading them from metadata and stays right when a filter replaces the
+image. The converted images are new arrays, because they are passed on in the
+message and thus cannot be borrowed from a BufferPool.
+
+Example:
+    @requires(color='GRAY', dtype='uint8')
+    def my_filter(message):
+        ...
+
+Todo:
+    - Add license boilerplate
+"""
+
+from collections.abc import Iterable
+from functools import wraps
+
+import cv2
+import numpy as np
+
+from .ImageMessage import ImageMessage
+from .dtypes import POLICIES, policy_dtype, to_policy
+
+COLOR_SPACES = ('GRAY', 'BGR')
+
+# Weights of the blue, green and red channel for the gray value, the same cv2.cvtColor uses
+GRAY_WEIGHTS = np.array([[0.114, 0.587, 0.299]])
+
+# The data types cv2.cvtColor supports
+_CVT_DTYPES = (np.uint8, np.uint16, np.float32)
+
+def color_of(image : np.ndarray) -> str:
+    """Colour space of an image array.
+
+    Args:
+        image (np.ndarray): Two dimensional or three channel image
+
+    Returns:
+        str: One of COLOR_SPACES
+    """
+    if image.ndim == 2 or image.shape[2] == 1:
+        return 'GRAY'
+    assert image.shape[2] == 3, "Images with %i channels are not supported" % image.shape[2]
+    return 'BGR'
+
+def convert_image(image : np.ndarray, color=None, dtype=None) -> np.ndarray:
+    """Convert an image to the given colour space and data type policy along the cheapest path.
+
+    Args:
+        image (np.ndarray): The image
+        color (str|None, optional): One of COLOR_SPACES. Defaults to None, which keeps the colour space.
+        dtype (str|None, optional): One of POLICIES. Defaults to None, which keeps the data type.
+
+    Returns:
+        np.ndarray: The image itself, if nothing needs to be converted, otherwise the converted image
+    """
+    assert color is None or color in COLOR_SPACES
+    assert dtype is None or dtype in POLICIES
+    if image.ndim == 3 and image.shape[2] == 1:
+        # Single channel images are two dimensional, the reshape does not copy
+        image = image.reshape(image.shape[:2])
+    current = color_of(image)
+    if color is None or color == current:
+        return image if dtype is None else to_policy(image, dtype)
+    if color == 'GRAY':
+        # Reduce the data first
+        gray = _to_gray(image)
+        return gray if dtype is None else to_policy(gray, dtype)
+    if dtype is not None:
+        image = to_policy(image, dtype)
+    return _to_bgr(image)
+
+def convert(message : ImageMessage, color=None, dtype=None) -> ImageMessage:
+    """Convert the image of a message to the given colour space and data type policy in place, see convert_image.
+
+    The mask is converted to the data type as well.
+
+    Args:
+        message (ImageMessage): The message
+        color (str|None, optional): One of COLOR_SPACES. Defaults to None, which keeps the colour space.
+        dtype (str|None, optional): One of POLICIES. Defaults to None, which keeps the data type.
+
+    Returns:
+        ImageMessage: The given message
+    """
+    message.image = convert_image(message.image, color, dtype)
+    if dtype is not None and message.mask is not None:
+        message.mask = to_policy(message.mask, dtype)
+    return message
+
+def requires(color=None, dtype=None):
+    """Decorator declaring the colour space and data type policy a filter needs.
+
+    The messages passed to the decorated filter are converted first, see convert. It works for
+    filters taking a single message as well as for batch processing filters taking a list.
+
+    Args:
+        color (str|None, optional): One of COLOR_SPACES. Defaults to None, which accepts any colour space.
+        dtype (str|None, optional): One of POLICIES. Defaults to None, which accepts any data type.
+
+    Returns:
+        Callable: The decorator
+    """
+    assert color is None or color in COLOR_SPACES
+    assert dtype is None or dtype in POLICIES
+    def decorator(f):
+        @wraps(f)
+        def wrapper(message, *args, **kwargs):
+            if isinstance(message, Iterable):
+                for m in message:
+                    convert(m, color, dtype)
+            else:
+                convert(message, color, dtype)
+            return f(message, *args, **kwargs)
+        wrapper.requires = {'color': color, 'dtype': dtype}
+        return wrapper
+    return decorator
+
+def _to_gray(image : np.ndarray) -> np.ndarray:
+    """Converts a BGR image with a single cv2 call in its data type."""
+    if image.dtype.type in _CVT_DTYPES:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # cvtColor does not support float64, the weighted sum gives the same result
+    return cv2.transform(image, GRAY_WEIGHTS)
+
+def _to_bgr(image : np.ndarray) -> np.ndarray:
+    """Converts a gray image with a single cv2 call in its data type."""
+    if image.dtype.type in _CVT_DTYPES:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    return cv2.merge((image, image, image))
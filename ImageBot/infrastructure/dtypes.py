@@ -0,0 +1,99 @@
+"""Pipeline wide data type policy of the image and mask arrays.
+
+All filters store the image and mask arrays of an ImageMessage with the data
+type selected by IMAGE_DTYPE in the config:
+    - 'uint8': The native type of the image files with values from 0 to 255.
+    - 'float32': Values from 0.0 to 1.0 with a quarter of the memory of float64.
+    - 'float64': Values from 0.0 to 1.0, the legacy behaviour.
+
+Filters which need another representation for a computation (e.g. imgaug
+needs uint8, the chroma key needs floats) convert with the functions of this
+module. If the array already has the requested type, they return it without
+copying, so that no conversion round trips happen for the native type.
+
+Todo:
+    - Add license boilerplate
+"""
+
+import numpy as np
+
+from ImageBot.Config import IMAGE_DTYPE
+
+# The supported policies
+POLICIES = {'uint8': np.uint8, 'float32': np.float32, 'float64': np.float64}
+
+def policy_dtype(policy=None) -> np.dtype:
+    """Data type of the given policy.
+
+    Args:
+        policy (str|None, optional): One of POLICIES. Defaults to None, which uses IMAGE_DTYPE.
+
+    Returns:
+        np.dtype: The data type
+    """
+    policy = IMAGE_DTYPE if policy is None else policy
+    assert policy in POLICIES, "Unknown image data type policy '%s'" % policy
+    return np.dtype(POLICIES[policy])
+
+def scale_of(array_or_dtype) -> float:
+    """Value of full intensity for the given array or data type.
+
+    Args:
+        array_or_dtype (np.ndarray|np.dtype|str): Array or data type
+
+    Returns:
+        float: 255.0 for uint8 and 1.0 for floating point types
+    """
+    dtype = array_or_dtype.dtype if isinstance(array_or_dtype, np.ndarray) else np.dtype(array_or_dtype)
+    return 255.0 if dtype == np.uint8 else 1.0
+
+def as_uint8(array : np.ndarray) -> np.ndarray:
+    """Convert an image or mask to uint8, e.g. for saving or OpenCV and imgaug functions which need it.
+
+    Args:
+        array (np.ndarray): Array of any policy
+
+    Returns:
+        np.ndarray: The array itself, if it is uint8 already, otherwise a converted copy
+    """
+    if array.dtype == np.uint8:
+        return array
+    # Round instead of truncating, otherwise every round trip would darken the image
+    return np.uint8(np.clip(np.rint(array*255.0), 0.0, 255.0))
+
+def as_unit(array : np.ndarray, dtype=np.float32) -> np.ndarray:
+    """Convert an image or mask to floating point values from 0.0 to 1.0 for computations.
+
+    Args:
+        array (np.ndarray): Array of any policy
+        dtype (np.dtype, optional): Floating point type for integer arrays. Defaults to np.float32.
+
+    Returns:
+        np.ndarray: The array itself, if it is a floating point array already, otherwise a converted copy
+    """
+    if np.issubdtype(array.dtype, np.floating):
+        return array
+    dtype = np.dtype(dtype)
+    # Cast and scale in one pass
+    return np.multiply(array, dtype.type(1.0/255.0), dtype=dtype)
+
+def to_policy(array : np.ndarray, policy=None) -> np.ndarray:
+    """Convert an image or mask to the data type of the policy.
+
+    Integer arrays are taken as values from 0 to 255, floating point arrays as values from 0.0 to 1.0.
+
+    Args:
+        array (np.ndarray): Array to convert
+        policy (str|None, optional): One of POLICIES. Defaults to None, which uses IMAGE_DTYPE.
+
+    Returns:
+        np.ndarray: The array itself, if it has the data type already, otherwise a converted copy
+    """
+    dtype = policy_dtype(policy)
+    if array.dtype == dtype:
+        return array
+    if dtype == np.uint8:
+        return as_uint8(array)
+    if np.issubdtype(array.dtype, np.floating):
+        return array.astype(dtype)
+    return np.multiply(array, dtype.type(1.0/255.0), dtype=dtype)
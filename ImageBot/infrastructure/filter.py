@@ -8,7 +8,12 @@ Todo:
     - Add license boilerplate
 """
 
-from .ImageMessage import ImageMessage
+from .ImageMessage import ImageMessage, ImageFile, fit_size
+from .dtypes import as_uint8, as_unit, to_policy
+from .conversions import convert
+from .ImageWriter import default_writer
+from .ShardStore import ShardStore, shard_writer, message_name
+from ImageBot.Config import WRITER_ASYNC
 
 import os
 from collections.abc import Iterable
@@ -21,27 +26,81 @@ import numpy as np
 import cv2
 
 
-def load_image(message : ImageMessage, source : 'Queue[Path]', load_mask=False, extension='png', mask_suffix='_mask') -> ImageMessage:
+def load_image(message : ImageMessage, source : 'Queue[Path]', load_mask=False, extension='png', mask_suffix='_mask', store : ShardStore = None,
+               max_size=None) -> ImageMessage:
     """Load image from file and optionally its mask.
 
+    The files are decoded lazily on first access of the image and mask, see ImageFile.
+
     Args:
         message (ImageMessage): List of incoming messages. Will be ignored (only for compatability)
-        source (queue[Path]): Queue containing Path-objects.
+        source (queue[Path]): Queue containing Path-objects or, if a store is given, message ids.
         load_mask (bool, optional): If set, a mask with the same name and the given suffix is loaded additionally. Defaults to False
         extension (str, optional): Specific extension to look for. Defaults to 'png'.
         mask_suffix (str, optional): Mask suffix of the image file. Defaults to '_mask'
+        store (ShardStore, optional): Read the messages from this store instead of image files. Defaults to None.
+        max_size (int|None, optional): Shrink larger images and masks to this length of the longer side, e.g. if the
+            following filters shrink them anyway. Files are decoded at a reduced resolution, see ImageFile.
+            Defaults to None, which keeps the full resolution.
 
     Returns:
         ImageMessage: Loaded images in ImageMessage
     """
-    image_file : Path = source.get()
+    if store is not None:
+        return _fit_message(store.read(source.get(), message, load_mask), max_size)
+    return _read_image(message, source.get(), load_mask, extension, mask_suffix, max_size)
+
+def load_path(image_file : Path, load_mask=False, extension='png', mask_suffix='_mask', max_size=None) -> ImageMessage:
+    """Load image from the given file into a new message and optionally its mask.
+
+    The files are decoded lazily on first access of the image and mask, see ImageFile.
+    Use it as loader of Pipeline.map.
+
+    Args:
+        image_file (Path): Path of the image file
+        load_mask (bool, optional): If set, a mask with the same name and the given suffix is loaded additionally. Defaults to False
+        extension (str, optional): Extension of the mask file. Defaults to 'png'.
+        mask_suffix (str, optional): Mask suffix of the image file. Defaults to '_mask'
+        max_size (int|None, optional): See load_image. Defaults to None.
+
+    Returns:
+        ImageMessage: Loaded image in a new ImageMessage
+    """
+    return _read_image(ImageMessage(uuid.uuid4()), Path(image_file), load_mask, extension, mask_suffix, max_size)
+
+def load_stored(message_id, store : ShardStore, load_mask=False, max_size=None) -> ImageMessage:
+    """Read the message with the given id from a store into a new message.
+
+    Use it as loader of Pipeline.map for packed datasets.
+
+    Args:
+        message_id (uuid|int|str): Id of the message, see ShardStore.ids
+        store (ShardStore): The store
+        load_mask (bool, optional): If set, the mask is read additionally. Defaults to False
+        max_size (int|None, optional): See load_image. Defaults to None.
+
+    Returns:
+        ImageMessage: The read message
+    """
+    return _fit_message(store.read(message_id, load_mask=load_mask), max_size)
+
+def _fit_message(message : ImageMessage, max_size) -> ImageMessage:
+    """Shrink the image and mask of a message to max_size, if set. See load_image."""
+    if max_size is not None:
+        message.image = fit_size(message.image, max_size)
+        if message.mask is not None:
+            message.mask = fit_size(message.mask, max_size)
+    return message
+
+def _read_image(message : ImageMessage, image_file : Path, load_mask, extension, mask_suffix, max_size=None) -> ImageMessage:
+    """Reference image and, if set, its mask file in the given message. See load_image."""
     mask_file : Path
 
-    # Load image and, if set, its mask
-    message.image = cv2.imread(image_file.as_posix(), cv2.IMREAD_COLOR) / 255.0
+    # Reference image and, if set, its mask, they are decoded where they are used first
+    message.image = ImageFile(image_file, cv2.IMREAD_COLOR, max_size)
     if load_mask:
         mask_file = image_file.parent / (image_file.stem + mask_suffix + '.' + extension)
-        message.mask = cv2.imread(mask_file.as_posix(), cv2.IMREAD_GRAYSCALE) / 255.0
+        message.mask = ImageFile(mask_file, cv2.IMREAD_GRAYSCALE, max_size)
     
     # If source_file is a Path, set metadata
     if isinstance(image_file, Path):
@@ -49,35 +108,80 @@ def load_image(message : ImageMessage, source : 'Queue[Path]', load_mask=False,
 
     return message
 
-def save_message(message : ImageMessage, dest_folder : Path, save_mask=False, mask_suffix='_mask', extension='png') -> ImageMessage:
+def save_message(message : ImageMessage, dest_folder : Path, save_mask=False, mask_suffix='_mask', extension='png', packed=False,
+                 keep_arrays=True) -> ImageMessage:
     """Save given image and, if set, its mask into specified folder.
 
+    If WRITER_ASYNC is set, the files are written in the background, see write_image.
+    If packed is set, the arrays are appended to the shard of this process in the folder instead, see ShardStore.
+    Otherwise, the written files are listed in the 'saved_files' metadata of the message, see Manifest.
+
     Args:
         message (ImageMessage): ImageMessage containing the image to save
         dest_folder (Path): Path to the desired location
         save_mask (bool, optional): If set, the mask is saved additionally. Defaults to False
         mask_suffix (str, optional): Suffix to use when mask is saved. Default to '_mask'
         extension (str, optional): File extension to use for file. Defaults to 'png'.
+        packed (bool, optional): Store the message in the shard store in dest_folder. Defaults to False.
+        keep_arrays (bool, optional): Return the given message. Otherwise, a message with its id, origin, green value and
+            metadata, but without image and mask is returned. As last filter of a pipeline, this frees the arrays of every
+            result as soon as it is saved instead of keeping all results of a message until they are returned. Defaults to True.
 
     Returns:
-        ImageMessage: Returns the given message
+        ImageMessage: Returns the given message or, if keep_arrays is not set, the message without arrays
     """
     image_file : Path
     mask_file : Path
 
+    if packed:
+        shard_writer(dest_folder).append(message, save_mask)
+        return message if keep_arrays else _without_arrays(message)
+
     try:
         image_file = dest_folder / message.metadata['image_path'].name
 
     except KeyError as k:
-        image_file = dest_folder / (str(message.id) + "." + extension)
+        image_file = dest_folder / (message_name(message) + "." + extension)
 
     mask_file = dest_folder / ('%s%s.%s' % (image_file.stem, mask_suffix, extension))
 
-    cv2.imwrite(image_file.as_posix(), np.uint8(message.image*255))
+    write_image(image_file, _written_array(message.image, keep_arrays))
+    message.metadata['saved_files'] = [image_file]
     if save_mask:
-        cv2.imwrite(mask_file.as_posix(), np.uint8(message.mask*255))
+        write_image(mask_file, _written_array(message.mask, keep_arrays))
+        message.metadata['saved_files'].append(mask_file)
 
-    return message
+    return message if keep_arrays else _without_arrays(message)
+
+def _without_arrays(message : ImageMessage) -> ImageMessage:
+    """Copy of a saved message without image and mask, see save_message."""
+    return ImageMessage(message.id, green=message.green, metadata=message.metadata, origin=message.origin)
+
+def write_image(path : Path, image : np.ndarray):
+    """Write an image file, in the background if WRITER_ASYNC is set.
+
+    Background writes are finished by Pipeline.join or ImageWriter.flush_default_writer
+    and when the process exits.
+
+    Args:
+        path (Path): The file, its extension selects the format
+        image (np.ndarray): The image as uint8 array
+    """
+    if WRITER_ASYNC:
+        default_writer().write(path, image)
+    else:
+        cv2.imwrite(Path(path).as_posix(), image)
+
+def _written_array(array : np.ndarray, passed_on=True) -> np.ndarray:
+    """The uint8 array to write for an image or mask of a message, see write_image.
+
+    A background write must not see later changes of the message, if it is passed on.
+    Thus, the array of the message itself is copied, if it is uint8 already.
+    """
+    image = as_uint8(array)
+    if WRITER_ASYNC and passed_on and image is array:
+        image = image.copy()
+    return image
 
 def show(message : ImageMessage) -> ImageMessage:
     """Create a window and display the image given in message.
@@ -88,16 +192,16 @@ def show(message : ImageMessage) -> ImageMessage:
     Returns:
         ImageMessage: Provided message
     """
-    cv2.imshow("Message Image", np.uint8(message.image*255))
+    cv2.imshow("Message Image", as_uint8(message.image))
     if message.mask is not None:
-        cv2.imshow("Message Mask", np.uint8(message.mask*255))
+        cv2.imshow("Message Mask", as_uint8(message.mask))
     cv2.waitKey(0)
     cv2.destroyAllWindows()
     return message
 
 
 def to_float64_image(message : ImageMessage) -> ImageMessage:
-    """Convert image to float64.
+    """Convert image to float64 with values from 0.0 to 1.0, independent of IMAGE_DTYPE.
 
     Args:
         message (ImageMessage): Image to be converted
@@ -105,10 +209,7 @@ def to_float64_image(message : ImageMessage) -> ImageMessage:
     Returns:
         ImageMessage: Resulting image
     """
-    message.image = np.float64(message.image)/255.0
-    if message.mask is not None:
-        message.mask = np.float64(message.mask) / 255.0
-    return message
+    return convert(message, dtype='float64')
 
 def smooth_mask(message : ImageMessage, radius) -> ImageMessage:
     """Apply gaussian blur on image.
@@ -124,7 +225,7 @@ def smooth_mask(message : ImageMessage, radius) -> ImageMessage:
     return message
 
 def to_uint8_image(message : ImageMessage) -> ImageMessage:
-    """Convert image type to uint8.
+    """Convert image type to uint8, independent of IMAGE_DTYPE.
 
     Args:
         message (ImageMessage): Image to be converted
@@ -132,13 +233,10 @@ def to_uint8_image(message : ImageMessage) -> ImageMessage:
     Returns:
         ImageMessage: Resulting iamge
     """
-    message.image = np.uint8(message.image*255)
-    if message.mask is not None:
-        message.mask = np.uint8(message.mask*255)
-    return message
+    return convert(message, dtype='uint8')
 
 def to_grayscale_image(message : ImageMessage) -> ImageMessage:
-    """Convert image to grayscale.
+    """Convert image to grayscale, nothing is done if it is grayscale already.
 
     Args:
         message (ImageMessage): Image to be converted
@@ -146,6 +244,4 @@ def to_grayscale_image(message : ImageMessage) -> ImageMessage:
     Returns:
         ImageMessage: Resulting image
     """
-    assert (len(message.image.shape) == 3) and (message.image.shape[2] == 3)
-    message.image = cv2.cvtColor(np.uint8(message.image*255), cv2.COLOR_BGR2GRAY)/255.0
-    return message
\ No newline at end of file
+    return convert(message, color='GRAY')
\ No newline at end of file
@@ -0,0 +1,243 @@
+"""Shared memory transport for the arrays of ImageMessages.
+
+Instead of pickling the image and mask of a message when it is handed to
+another process, the arrays are copied into a shared memory block and only a
+small handle (name, shape, dtype) is pickled. The receiving process maps the
+block into its own address space without copying it.
+
+Every process keeps track of the blocks it created or attached to with a
+reference count. A block is closed as soon as the count drops to zero and
+unlinked by the process that consumed it last:
+    - Blocks created by the main process are unlinked when the task using them finished.
+    - Blocks created by a worker for its results are unlinked by the main process after receiving them.
+
+On Windows, a shared memory block vanishes as soon as the last process closed
+it. Thus, results are only returned through shared memory, where blocks persist
+until they are unlinked (PERSISTENT_SEGMENTS).
+
+Todo:
+    - Add license boilerplate
+"""
+
+import os
+import copy
+import threading
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# The message attributes which are transported through shared memory
+ARRAY_FIELDS = ('image', 'mask')
+
+# Whether shared memory blocks outlive the process which created them
+PERSISTENT_SEGMENTS = os.name != 'nt'
+
+# Shared memory blocks used by this process: name -> [SharedMemory, reference count]
+_blocks = {}
+# Blocks which could not be closed yet, because numpy views on them are still alive
+_deferred = []
+_lock = threading.Lock()
+
+class SharedArray(object):
+    """Handle to a numpy array stored in a shared memory block."""
+
+    def __init__(self, name, shape, dtype):
+        """Constructor.
+
+        Args:
+            name (str): Name of the shared memory block
+            shape (Tuple[int]): Shape of the array
+            dtype (str): Numpy type string of the array
+        """
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+
+    def __repr__(self):
+        return 'SharedArray(%r, %r, %r)' % (self.name, self.shape, self.dtype)
+
+def share(array : np.ndarray) -> SharedArray:
+    """Copy an array into a new shared memory block.
+
+    The block is owned by the calling process with a reference count of one.
+
+    Args:
+        array (np.ndarray): Array to share
+
+    Returns:
+        SharedArray: Handle to the shared array
+    """
+    array = np.ascontiguousarray(array)
+    # Zero sized blocks are not allowed
+    shm = SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+    with _lock:
+        _blocks[shm.name] = [shm, 1]
+    return SharedArray(shm.name, array.shape, array.dtype.str)
+
+def attach(handle : SharedArray) -> np.ndarray:
+    """Map a shared array into this process without copying it.
+
+    Increases the reference count of the block.
+
+    Args:
+        handle (SharedArray): Handle to the shared array
+
+    Returns:
+        np.ndarray: Array backed by the shared memory block
+    """
+    with _lock:
+        entry = _blocks.get(handle.name)
+        if entry is None:
+            entry = _blocks[handle.name] = [SharedMemory(name=handle.name), 0]
+        entry[1] += 1
+    return np.ndarray(handle.shape, np.dtype(handle.dtype), buffer=entry[0].buf)
+
+def release(handle : SharedArray, unlink=False):
+    """Decrease the reference count of a shared array.
+
+    If the count drops to zero, the block is closed in this process and, if set, unlinked.
+
+    Args:
+        handle (SharedArray): Handle to the shared array
+        unlink (bool, optional): Destroy the block as soon as it is not used by this process anymore. Defaults to False.
+    """
+    with _lock:
+        entry = _blocks.get(handle.name)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del _blocks[handle.name]
+        if unlink:
+            entry[0].unlink()
+        _deferred.append(entry[0])
+        # Close this and all earlier blocks, which are not referenced by any array anymore
+        for shm in list(_deferred):
+            try:
+                shm.close()
+                _deferred.remove(shm)
+            except BufferError:
+                pass
+
+def peek(message, field):
+    """Returns an array field of a message without decoding lazily loaded images (see ImageMessage.stored).
+
+    Args:
+        message (object): The message
+        field (str): One of ARRAY_FIELDS
+
+    Returns:
+        object: The stored value or None, if the message has no such field
+    """
+    stored = getattr(message, 'stored', None)
+    if stored is not None:
+        return stored(field)
+    return getattr(message, field, None)
+
+def _as_list(messages, batch_processing):
+    """Return the given message(s) as list."""
+    return list(messages) if batch_processing else [messages]
+
+def export_messages(messages, batch_processing=False, detach=False):
+    """Move the arrays of the given message(s) into shared memory.
+
+    The messages themselves are not changed. Shallow copies holding SharedArray
+    handles instead of the arrays are returned.
+
+    Args:
+        messages (object|List[object]): Message or list of messages
+        batch_processing (bool, optional): Whether messages is a list. Defaults to False.
+        detach (bool, optional): Close the blocks in this process right away, because they are
+            consumed and unlinked by another process. Defaults to False.
+
+    Returns:
+        object|List[object]: Copies of the message(s) carrying SharedArray handles
+    """
+    result = []
+    handles = []
+    try:
+        for message in _as_list(messages, batch_processing):
+            exported = copy.copy(message)
+            for field in ARRAY_FIELDS:
+                array = peek(message, field)
+                if isinstance(array, np.ndarray):
+                    handle = share(array)
+                    handles.append(handle)
+                    setattr(exported, field, handle)
+            result.append(exported)
+    except BaseException:
+        # Destroy the blocks of the messages exported before the failure
+        for handle in handles:
+            release(handle, unlink=True)
+        raise
+    if detach:
+        for handle in handles:
+            release(handle)
+    return result if batch_processing else result[0]
+
+def import_messages(messages, batch_processing=False):
+    """Replace the SharedArray handles of the given message(s) by arrays mapped to the shared memory.
+
+    No data is copied. The returned handles must be released when the arrays are not used anymore.
+
+    Args:
+        messages (object|List[object]): Message or list of messages carrying SharedArray handles
+        batch_processing (bool, optional): Whether messages is a list. Defaults to False.
+
+    Returns:
+        List[SharedArray]: The attached handles
+    """
+    handles = []
+    for message in _as_list(messages, batch_processing):
+        for field in ARRAY_FIELDS:
+            handle = peek(message, field)
+            if isinstance(handle, SharedArray):
+                setattr(message, field, attach(handle))
+                handles.append(handle)
+    return handles
+
+def receive_messages(messages, batch_processing=False):
+    """Replace the SharedArray handles of the given message(s) by private copies and destroy the blocks.
+
+    Args:
+        messages (object|List[object]): Message or list of messages carrying SharedArray handles
+        batch_processing (bool, optional): Whether messages is a list. Defaults to False.
+
+    Returns:
+        object|List[object]: The given message(s)
+    """
+    for message in _as_list(messages, batch_processing):
+        for field in ARRAY_FIELDS:
+            handle = peek(message, field)
+            if isinstance(handle, SharedArray):
+                setattr(message, field, np.array(attach(handle)))
+                release(handle, unlink=True)
+    return messages
+
+def discard_messages(messages, batch_processing=False):
+    """Destroy the blocks of message(s) exported with detach, which never reached the consuming process.
+
+    The messages must not be used afterwards.
+
+    Args:
+        messages (object|List[object]): Message or list of messages returned by export_messages
+        batch_processing (bool, optional): Whether messages is a list. Defaults to False.
+    """
+    for handle in import_messages(messages, batch_processing):
+        release(handle, unlink=True)
+
+def release_messages(messages, batch_processing=False, unlink=True):
+    """Release the SharedArray handles of exported message(s).
+
+    Args:
+        messages (object|List[object]): Message or list of messages returned by export_messages
+        batch_processing (bool, optional): Whether messages is a list. Defaults to False.
+        unlink (bool, optional): Destroy the blocks. Defaults to True.
+    """
+    for message in _as_list(messages, batch_processing):
+        for field in ARRAY_FIELDS:
+            handle = peek(message, field)
+            if isinstance(handle, SharedArray):
+                release(handle, unlink=unlink)
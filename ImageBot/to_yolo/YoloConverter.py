@@ -11,16 +11,23 @@ from queue import Queue
 
 import os
 
-from ..Config import CLASS_ID
+from ..Config import CLASS_ID, INTERMEDIATE_PACKED
 from ..infrastructure.ImageMessage import ImageMessage
+from ..infrastructure.ShardStore import ShardStore
+from ..infrastructure.dtypes import as_uint8
 from ..infrastructure.filter import load_image
 from ..image_processing.masks import mask_bounding_box
 
 
-def to_yolo_dataset(source_folder, target_folder, test_training_split=0.3):
+def to_yolo_dataset(source_folder, target_folder, test_training_split=0.3, packed=INTERMEDIATE_PACKED):
 
-    # Get all filenames
-    filenames = [f.replace('_mask.png', "") for f in os.listdir(source_folder) if f.endswith('_mask.png')]
+    # Get all filenames or, if the source is a shard store, all message ids
+    store = None
+    if packed:
+        store = ShardStore(source_folder)
+        filenames = store.ids()
+    else:
+        filenames = [f.replace('_mask.png', "") for f in os.listdir(source_folder) if f.endswith('_mask.png')]
 
     # First shuffle the list
     random.shuffle(filenames)
@@ -45,8 +52,16 @@ def to_yolo_dataset(source_folder, target_folder, test_training_split=0.3):
     
     # Helper function to save the file
     def save_message(filename, parent_path):
-        image = cv2.imread(os.path.join(source_folder, filename + ".png"), cv2.IMREAD_GRAYSCALE)
-        mask = cv2.imread(os.path.join(source_folder, filename + "_mask.png"), cv2.IMREAD_GRAYSCALE)
+        if store is not None:
+            message = store.read(filename)
+            image = as_uint8(message.image)
+            if image.ndim == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            mask = as_uint8(message.mask)
+            filename = message.metadata['stored_name']
+        else:
+            image = cv2.imread(os.path.join(source_folder, filename + ".png"), cv2.IMREAD_GRAYSCALE)
+            mask = cv2.imread(os.path.join(source_folder, filename + "_mask.png"), cv2.IMREAD_GRAYSCALE)
 
         # Save the image
         cv2.imwrite(os.path.join(parent_path, "images", filename + ".png"), image)